@@ -9,7 +9,13 @@ from aiogram.types import BotCommand, LabeledPrice, PreCheckoutQuery
 
 from config import TELEGRAM_TOKEN, LOG_LEVEL
 from database.models import init_db
+from database.connection import db
+from database.async_operations import async_db
 from services.scheduler import setup_scheduler
+from services.horoscope_delivery import horoscope_delivery
+from services.delivery_jobs import delivery_job_queue
+from services.subscription_expiry import subscription_expiry
+from services.llm_client import llm_client
 
 # Настраиваем логирование
 logging.basicConfig(
@@ -70,11 +76,15 @@ async def register_handlers():
 # Регистрируем middleware
 async def register_middleware():
     from middleware.subscription import SubscriptionMiddleware
+    from middleware.rate_limit import RateLimitMiddleware
     
     # Регистрируем middleware
     dp.message.middleware(SubscriptionMiddleware())
     dp.callback_query.middleware(SubscriptionMiddleware())
     
+    # Все исходящие сообщения бота проходят через ограничитель частоты отправки
+    bot.session.middleware(RateLimitMiddleware())
+    
     logger.info("Middleware зарегистрирован")
 
 # Функция запуска бота
@@ -99,8 +109,11 @@ async def main():
     await register_handlers()
     
     try:
-        # Запускаем планировщик
+        # Запускаем планировщик, доставку гороскопов и трекер окончания подписок
         scheduler.start()
+        horoscope_delivery.start(bot)
+        delivery_job_queue.start(bot)
+        subscription_expiry.start(bot)
         
         # Запускаем бота
         logger.info("Бот запущен")
@@ -111,8 +124,18 @@ async def main():
         
         await dp.start_polling(bot)
     finally:
-        # Останавливаем планировщик
+        # Останавливаем планировщик и доставку гороскопов
         scheduler.shutdown()
+        await horoscope_delivery.stop()
+        await delivery_job_queue.stop()
+        await subscription_expiry.stop()
+        
+        # Закрываем HTTP-сессию OpenAI
+        await llm_client.close()
+        
+        # Дожидаемся запросов к базе данных и закрываем соединения
+        async_db.shutdown()
+        db.close_all()
         
         # Закрываем соединение бота
         await bot.session.close()
@@ -13,14 +13,33 @@ ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "adminparol")
 
 # Настройки базы данных
 DB_FILE = os.getenv("DB_FILE", "astrology_bot.db")
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "65536"))  # Кэш страниц SQLite на соединение
+DB_MMAP_SIZE_MB = int(os.getenv("DB_MMAP_SIZE_MB", "256"))  # Размер отображения файла базы в память
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))  # Ожидание блокировки другим процессом
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))  # Потоков для запросов к базе
+DB_QUEUE_SIZE = int(os.getenv("DB_QUEUE_SIZE", "256"))  # Максимум запросов к базе в очереди
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))  # Время жизни пользователя в кэше
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))  # Максимум пользователей в кэше
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "90"))  # Через сколько дней сообщения переносятся в сжатый архив
+MESSAGE_ARCHIVE_BATCH_SIZE = int(os.getenv("MESSAGE_ARCHIVE_BATCH_SIZE", "500"))  # Сообщений за одну транзакцию архивации
+MESSAGE_ARCHIVE_VACUUM_PAGES = int(os.getenv("MESSAGE_ARCHIVE_VACUUM_PAGES", "2000"))  # Свободных страниц, возвращаемых за шаг incremental_vacuum
 
 # Настройки OpenAI
 OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-4o")
 MAX_TOKENS = int(os.getenv("MAX_TOKENS", "2000"))
 COST_PER_1000_TOKENS = float(os.getenv("COST_PER_1000_TOKENS", "0.002"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "100"))  # Одновременных запросов к модели
+LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "90"))  # Таймаут одного запроса в секундах
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "100"))  # Размер пула HTTP-соединений
+LLM_KEEPALIVE_TIMEOUT = float(os.getenv("LLM_KEEPALIVE_TIMEOUT", "30"))  # Время жизни простаивающего соединения
+INTERPRETATION_CACHE_TTL_DAYS = int(os.getenv("INTERPRETATION_CACHE_TTL_DAYS", "30"))  # Срок хранения интерпретаций натальных карт
+INTERPRETATION_CACHE_MEMORY_SIZE = int(os.getenv("INTERPRETATION_CACHE_MEMORY_SIZE", "512"))  # Интерпретаций в памяти
+INTERPRETATION_CACHE_MAX_ROWS = int(os.getenv("INTERPRETATION_CACHE_MAX_ROWS", "20000"))  # Интерпретаций в базе
 
 # Настройки диалога
 MAX_MESSAGES = int(os.getenv("MAX_MESSAGES", "10"))
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))  # Минимальный интервал между правками сообщения при потоковом ответе
+STREAM_MIN_CHARS = int(os.getenv("STREAM_MIN_CHARS", "40"))  # Минимум новых символов для очередной правки
 
 # Настройки подписок
 FREE_MESSAGES_LIMIT = int(os.getenv("FREE_MESSAGES_LIMIT", "3"))
@@ -37,11 +56,43 @@ TRIBUTE_SECRET_KEY = os.getenv("TRIBUTE_SECRET_KEY", "")
 TRIBUTE_PROJECT_ID = os.getenv("TRIBUTE_PROJECT_ID", "")
 TG_STARS_MULTIPLIER = float(os.getenv("TG_STARS_MULTIPLIER", "100"))  # 100 звезд за 1 доллар
 
+# Лимиты отправки сообщений в Telegram
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # Сообщений в секунду на весь бот
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))  # Сообщений в секунду в один личный чат
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))  # Допустимая серия сообщений в личный чат
+TELEGRAM_GROUP_RATE_PER_MINUTE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MINUTE", "20"))  # Сообщений в минуту в одну группу
+TELEGRAM_GROUP_BURST = int(os.getenv("TELEGRAM_GROUP_BURST", "3"))  # Допустимая серия сообщений в группу
+TELEGRAM_SEND_MAX_RETRIES = int(os.getenv("TELEGRAM_SEND_MAX_RETRIES", "3"))  # Повторов отправки после ответа 429
+TELEGRAM_MAX_RETRY_AFTER = float(os.getenv("TELEGRAM_MAX_RETRY_AFTER", "60"))  # Максимальное ожидание retry_after для повтора, секунд
+
 # Настройки планировщика
 DEFAULT_HOROSCOPE_TIME = os.getenv("DEFAULT_HOROSCOPE_TIME", "08:00")
+HOROSCOPE_DELIVERY_WINDOW_MINUTES = int(os.getenv("HOROSCOPE_DELIVERY_WINDOW_MINUTES", "10"))  # Окно предварительной загрузки доставок
+HOROSCOPE_DELIVERY_BATCH_SIZE = int(os.getenv("HOROSCOPE_DELIVERY_BATCH_SIZE", "1000"))  # Пользователей за один запрос движка доставки
+HOROSCOPE_DELIVERY_MAX_DELAY_HOURS = float(os.getenv("HOROSCOPE_DELIVERY_MAX_DELAY_HOURS", "6"))  # Максимальное опоздание доставки после простоя
+HOROSCOPE_PREGENERATION_TIME = os.getenv("HOROSCOPE_PREGENERATION_TIME", "03:15")  # Время подготовки гороскопов на следующий день
+HOROSCOPE_PREGENERATION_PAGE_SIZE = int(os.getenv("HOROSCOPE_PREGENERATION_PAGE_SIZE", "1000"))  # Пользователей на страницу при подготовке гороскопов
+DELIVERY_WORKERS = int(os.getenv("DELIVERY_WORKERS", "50"))  # Параллельных доставок при рассылке гороскопов
+DELIVERY_LLM_CONCURRENCY = int(os.getenv("DELIVERY_LLM_CONCURRENCY", "20"))  # Одновременных генераций при рассылке
+DELIVERY_TELEGRAM_CONCURRENCY = int(os.getenv("DELIVERY_TELEGRAM_CONCURRENCY", "25"))  # Одновременных отправок в Telegram при рассылке
+DELIVERY_JOB_BATCH_SIZE = int(os.getenv("DELIVERY_JOB_BATCH_SIZE", "200"))  # Заданий доставки, забираемых из очереди за раз
+DELIVERY_JOB_LEASE_SECONDS = int(os.getenv("DELIVERY_JOB_LEASE_SECONDS", "900"))  # Аренда задания, после которой оно выдается повторно
+DELIVERY_JOB_MAX_ATTEMPTS = int(os.getenv("DELIVERY_JOB_MAX_ATTEMPTS", "5"))  # Попыток доставки до перевода задания в dead
+DELIVERY_JOB_RETRY_BASE_SECONDS = int(os.getenv("DELIVERY_JOB_RETRY_BASE_SECONDS", "60"))  # Первая пауза перед повтором, дальше удваивается
+DELIVERY_JOB_RETRY_MAX_SECONDS = int(os.getenv("DELIVERY_JOB_RETRY_MAX_SECONDS", "3600"))  # Максимальная пауза перед повтором
+DELIVERY_JOB_POLL_SECONDS = int(os.getenv("DELIVERY_JOB_POLL_SECONDS", "30"))  # Период проверки очереди без новых заданий
+DELIVERY_JOB_RETENTION_DAYS = int(os.getenv("DELIVERY_JOB_RETENTION_DAYS", "7"))  # Сколько дней хранить завершенные задания
+MONTHLY_ROLLOUT_WINDOW_HOURS = float(os.getenv("MONTHLY_ROLLOUT_WINDOW_HOURS", "48"))  # Окно рассылки месячных гороскопов до конца месяца
+MONTHLY_ROLLOUT_CONCURRENCY = int(os.getenv("MONTHLY_ROLLOUT_CONCURRENCY", "5"))  # Одновременных генераций месячных гороскопов
+MONTHLY_ROLLOUT_PAGE_SIZE = int(os.getenv("MONTHLY_ROLLOUT_PAGE_SIZE", "500"))  # Пользователей за один шаг планирования рассылки
+SUBSCRIPTION_EXPIRY_WINDOW_HOURS = float(os.getenv("SUBSCRIPTION_EXPIRY_WINDOW_HOURS", "24"))  # Окно предварительной загрузки окончаний подписок
+SUBSCRIPTION_EXPIRY_BATCH_SIZE = int(os.getenv("SUBSCRIPTION_EXPIRY_BATCH_SIZE", "500"))  # Подписок за один запрос трекера окончаний
 
 # Пути к ephemeris
 EPHE_PATH = os.getenv("EPHE_PATH", "ephemeris/")
+EPHEMERIS_CACHE_RESOLUTION_MINUTES = int(os.getenv("EPHEMERIS_CACHE_RESOLUTION_MINUTES", "10"))  # Шаг кэша транзитов
+EPHEMERIS_CACHE_SIZE = int(os.getenv("EPHEMERIS_CACHE_SIZE", "256"))  # Максимум интервалов в кэше транзитов
+EPHEMERIS_TABLE_PATH = os.getenv("EPHEMERIS_TABLE_PATH", "ephemeris/planets_1900_2100.cheb")  # Предрасчитанная таблица эфемерид
 
 # Настройки логирования
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
@@ -50,6 +101,7 @@ LOG_DIR = os.getenv("LOG_DIR", "logs")
 # Настройки административной панели
 ADMIN_PORT = int(os.getenv("ADMIN_PORT", "8080"))
 ADMIN_TELEGRAM_ID = os.getenv("ADMIN_TELEGRAM_ID", "")  # ID администратора в Telegram для уведомлений
+ADMIN_USERS_PAGE_SIZE = int(os.getenv("ADMIN_USERS_PAGE_SIZE", "20"))  # Пользователей на страницу в списке админ-панели
 
 # Настройки отчетов об ошибках
 ERROR_REPORT_THRESHOLD = int(os.getenv("ERROR_REPORT_THRESHOLD", "5"))  # Порог для уведомления о повторяющихся ошибках
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+Асинхронный фасад над database/operations.py.
+
+Каждая публичная функция operations доступна здесь под тем же именем как
+корутина: запрос выполняется в пуле потоков базы данных, поэтому ожидание
+fsync или блокировки записи не останавливает event loop.
+
+    from database import async_operations
+    user = await async_operations.get_user(user_id)
+"""
+import asyncio
+import functools
+import inspect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import DB_EXECUTOR_WORKERS, DB_QUEUE_SIZE
+from database import operations
+
+logger = logging.getLogger(__name__)
+
+class AsyncDatabase:
+    """
+    Исполнитель запросов к базе данных.
+
+    Запросы выполняются в выделенном пуле из workers потоков (у каждого свое
+    соединение, см. database/connection.py). В пул передается не больше
+    max_queue запросов одновременно: остальные корутины ждут на семафоре,
+    а не накапливаются в очереди исполнителя без предела. Для каждой операции собираются число вызовов,
+    ошибки, среднее и максимальное время выполнения.
+    """
+
+    def __init__(self, workers=DB_EXECUTOR_WORKERS, max_queue=DB_QUEUE_SIZE):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = None
+        self._slots = None
+        self._slots_loop = None
+        self._lock = threading.Lock()
+        self._queued = 0  # Запросы, ожидающие места в очереди или выполнения
+        self._running = 0
+        self._max_depth = 0
+        self._operations = {}
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+        return self._executor
+
+    def _get_slots(self):
+        """Семафор очереди создается для текущего event loop"""
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._slots_loop is not loop:
+            self._slots = asyncio.Semaphore(self.max_queue)
+            self._slots_loop = loop
+        return self._slots
+
+    def _call(self, func, args, kwargs, submitted):
+        """Выполняется в потоке пула"""
+        with self._lock:
+            self._running += 1
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            self._record(func.__name__, started, submitted, failed=True)
+            raise
+        finally:
+            with self._lock:
+                self._running -= 1
+        self._record(func.__name__, started, submitted)
+        return result
+
+    def _record(self, name, started, submitted, failed=False):
+        finished = time.perf_counter()
+        with self._lock:
+            stats = self._operations.setdefault(name, {
+                "calls": 0,
+                "errors": 0,
+                "total_time": 0.0,
+                "max_time": 0.0,
+                "total_wait": 0.0
+            })
+            duration = finished - started
+            stats["calls"] += 1
+            stats["errors"] += failed
+            stats["total_time"] += duration
+            stats["max_time"] = max(stats["max_time"], duration)
+            stats["total_wait"] += started - submitted
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет синхронную функцию базы данных в пуле потоков"""
+        submitted = time.perf_counter()
+        with self._lock:
+            self._queued += 1
+            self._max_depth = max(self._max_depth, self._queued)
+        try:
+            async with self._get_slots():
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(
+                    self._get_executor(),
+                    self._call, func, args, kwargs, submitted
+                )
+        finally:
+            with self._lock:
+                self._queued -= 1
+
+    def get_stats(self):
+        """
+        Возвращает метрики: глубину очереди и время выполнения по операциям
+
+        avg_time/max_time - время выполнения запроса в потоке,
+        avg_wait - время от вызова до начала выполнения (ожидание в очереди)
+        """
+        with self._lock:
+            total_calls = sum(stats["calls"] for stats in self._operations.values())
+            total_time = sum(stats["total_time"] for stats in self._operations.values())
+            operations_stats = {
+                name: {
+                    "calls": stats["calls"],
+                    "errors": stats["errors"],
+                    "avg_time": stats["total_time"] / stats["calls"],
+                    "max_time": stats["max_time"],
+                    "avg_wait": stats["total_wait"] / stats["calls"]
+                }
+                for name, stats in self._operations.items()
+            }
+            return {
+                "queue_depth": self._queued,
+                "running": self._running,
+                "max_queue_depth": self._max_depth,
+                "workers": self.workers,
+                "max_queue": self.max_queue,
+                "total_calls": total_calls,
+                "avg_time": total_time / total_calls if total_calls else 0,
+                "operations": operations_stats
+            }
+
+    def shutdown(self):
+        """Останавливает пул потоков, дождавшись начатых запросов"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+# Общий исполнитель для импорта
+async_db = AsyncDatabase()
+
+def _make_async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await async_db.run(func, *args, **kwargs)
+    return wrapper
+
+# Асинхронные версии всех публичных функций operations
+for _name, _func in inspect.getmembers(operations, inspect.isfunction):
+    if _func.__module__ == operations.__name__ and not _name.startswith("_"):
+        globals()[_name] = _make_async(_func)
@@ -0,0 +1,147 @@
+"""
+Замер запросов выборки пользователей для доставки гороскопов на большой базе.
+
+Создает отдельную базу с count синтетическими пользователями и сравнивает
+прежний поиск пользователей слота (SELECT * по horoscope_time без индекса)
+с выборками движка доставки и подготовки гороскопов по частичным индексам.
+
+    python -m database.benchmark --path /tmp/bench.db --users 1000000
+"""
+import argparse
+import logging
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from database import models
+from database.connection import db
+from database import operations
+
+logger = logging.getLogger(__name__)
+
+# Поиск пользователей слота до появления next_delivery_at: выполнялся 48 раз в сутки.
+# NOT INDEXED воспроизводит план прежней схемы, в которой подходящих индексов не было
+LEGACY_SLOT_QUERY = "SELECT * FROM users NOT INDEXED WHERE horoscope_time = ? AND horoscope_city IS NOT NULL"
+
+def populate(path, count, scheduled_share=0.3, chart_size=3000):
+    """Заполняет базу count пользователями, у доли scheduled_share настроен гороскоп"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    rng = random.Random(42)
+    chart = "x" * chart_size
+    now = datetime.utcnow()
+
+    def rows():
+        for i in range(count):
+            scheduled = rng.random() < scheduled_share
+            minute = rng.randrange(48) * 30
+            horoscope_time = f"{minute // 60:02d}:{minute % 60:02d}" if scheduled else None
+            next_delivery_at = (
+                (now + timedelta(minutes=rng.randrange(24 * 60))).strftime(operations.DELIVERY_TIME_FORMAT)
+                if scheduled else None
+            )
+            yield (
+                f"{i:08d}", f"user{i}", chart, 55.75, 37.62,
+                horoscope_time, "Москва" if scheduled else None,
+                55.75 if scheduled else None, 37.62 if scheduled else None,
+                "Europe/Moscow" if scheduled else None, next_delivery_at
+            )
+
+    conn.executemany(
+        """
+        INSERT INTO users (user_id, username, natal_chart, latitude, longitude, horoscope_time, horoscope_city,
+                           horoscope_latitude, horoscope_longitude, horoscope_tz_name, next_delivery_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows()
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+def _timed(func, repeat):
+    """Среднее время вызова func в миллисекундах"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return (time.perf_counter() - started) / repeat * 1000, result
+
+def _plan(conn, query, params):
+    return "; ".join(row["detail"] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params).fetchall())
+
+def run_benchmark(repeat=3):
+    """
+    Выполняет замеры на базе, на которую указывает database.connection.db
+
+    Returns:
+        list: Строки отчета (название, время в мс, число строк, план запроса)
+    """
+    now = datetime.utcnow()
+    report = []
+    with db.read() as conn:
+        elapsed, rows = _timed(lambda: conn.execute(LEGACY_SLOT_QUERY, ("08:00",)).fetchall(), repeat)
+        report.append(("Прежний слот (SELECT *, без индекса)", elapsed, len(rows),
+                       _plan(conn, LEGACY_SLOT_QUERY, ("08:00",))))
+
+    start = now.strftime(operations.DELIVERY_TIME_FORMAT)
+    end = (now + timedelta(minutes=30)).strftime(operations.DELIVERY_TIME_FORMAT)
+    elapsed, rows = _timed(lambda: operations.get_horoscope_deliveries_between(start, end, 1000000), repeat)
+    with db.read() as conn:
+        plan = _plan(
+            conn,
+            "SELECT user_id, next_delivery_at FROM users WHERE next_delivery_at >= ? AND next_delivery_at < ? "
+            "ORDER BY next_delivery_at LIMIT ?",
+            (start, end, 1000000)
+        )
+    report.append(("Окно доставок 30 мин (покрывающий индекс)", elapsed, len(rows), plan))
+
+    user_ids = [row["user_id"] for row in rows[:1000]]
+    elapsed, users = _timed(lambda: operations.get_users_by_ids(user_ids), repeat)
+    report.append(("1000 пользователей, все столбцы", elapsed, len(users), ""))
+    elapsed, users = _timed(lambda: operations.get_users_by_ids(user_ids, operations.HOROSCOPE_USER_COLUMNS), repeat)
+    report.append(("1000 пользователей, HOROSCOPE_USER_COLUMNS", elapsed, len(users), ""))
+
+    def pregeneration_pages():
+        cursor, total = None, 0
+        while True:
+            page = operations.get_users_for_horoscope_pregeneration("2000-01-01", cursor, 1000)
+            if not page:
+                return total
+            cursor = page[-1]["user_id"]
+            total += len(page)
+
+    elapsed, total = _timed(pregeneration_pages, 1)
+    report.append(("Все пользователи с гороскопом страницами по 1000", elapsed, total, ""))
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description="Замер выборок пользователей для доставки гороскопов")
+    parser.add_argument("--path", default="benchmark.db", help="Файл базы для замеров (будет перезаписан)")
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.path + suffix):
+            os.remove(args.path + suffix)
+
+    # Замеры идут на отдельной базе, рабочая база не затрагивается
+    models.DB_FILE = args.path
+    db.db_file = args.path
+    if not models.init_db():
+        return 1
+
+    started = time.perf_counter()
+    populate(args.path, args.users)
+    logger.info(f"Создано {args.users} пользователей за {time.perf_counter() - started:.1f} с")
+
+    for name, elapsed, rows, plan in run_benchmark(args.repeat):
+        print(f"{name:50} {elapsed:10.2f} мс {rows:10} строк  {plan}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
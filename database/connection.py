@@ -0,0 +1,112 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from config import DB_FILE, DB_CACHE_SIZE_KB, DB_MMAP_SIZE_MB, DB_BUSY_TIMEOUT_MS
+
+logger = logging.getLogger(__name__)
+
+def dict_factory(cursor, row):
+    """Конвертирует строки SQLite в словари"""
+    d = {}
+    for idx, col in enumerate(cursor.description):
+        d[col[0]] = row[idx]
+    return d
+
+class ConnectionManager:
+    """
+    Долгоживущие соединения с SQLite.
+
+    Каждый поток получает одно постоянное соединение с настроенными
+    PRAGMA (WAL, synchronous=NORMAL, кэш страниц, mmap, busy_timeout), поэтому
+    операции не платят за открытие файла и разбор схемы на каждый запрос.
+
+    Чтения в режиме WAL идут параллельно и не блокируют запись. Записи внутри
+    процесса сериализуются общей блокировкой и выполняются в транзакции
+    BEGIN IMMEDIATE: обработчики ждут своей очереди на блокировке, а не
+    получают SQLITE_BUSY. busy_timeout остается для других процессов
+    (админ-панель, разовые скрипты).
+    """
+
+    def __init__(self, db_file=DB_FILE, cache_size_kb=DB_CACHE_SIZE_KB, mmap_size_mb=DB_MMAP_SIZE_MB,
+                 busy_timeout_ms=DB_BUSY_TIMEOUT_MS):
+        self.db_file = db_file
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size_mb = mmap_size_mb
+        self.busy_timeout_ms = busy_timeout_ms
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self):
+        """Открывает соединение и применяет настройки"""
+        # isolation_level=None: транзакциями управляет write(), чтения идут без BEGIN
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.busy_timeout_ms / 1000,
+            isolation_level=None,
+            check_same_thread=False
+        )
+        conn.row_factory = dict_factory
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{self.cache_size_kb}")
+        conn.execute(f"PRAGMA mmap_size={self.mmap_size_mb * 1024 * 1024}")
+        conn.execute(f"PRAGMA busy_timeout={self.busy_timeout_ms}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+
+        with self._connections_lock:
+            self._connections.append(conn)
+        logger.debug(f"Открыто соединение с базой данных для потока {threading.current_thread().name}")
+        return conn
+
+    def connection(self):
+        """Возвращает соединение текущего потока"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def read(self):
+        """Соединение для чтения"""
+        yield self.connection()
+
+    @contextmanager
+    def write(self):
+        """
+        Соединение для записи внутри транзакции
+
+        Транзакция фиксируется при выходе из блока и откатывается при
+        исключении. Вложенные вызовы выполняются в уже открытой транзакции.
+        """
+        with self._write_lock:
+            conn = self.connection()
+            if conn.in_transaction:
+                yield conn
+                return
+
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close_all(self):
+        """Закрывает все открытые соединения"""
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.warning(f"Ошибка при закрытии соединения с базой данных: {e}")
+        self._local = threading.local()
+
+# Общий менеджер соединений для импорта
+db = ConnectionManager()
@@ -0,0 +1,49 @@
+"""
+Обслуживание файла базы данных.
+
+Включение режима auto_vacuum=INCREMENTAL для существующей базы, чтобы
+место после архивации сообщений возвращалось через incremental_vacuum.
+Переключение выполняет полный VACUUM: он блокирует базу на все время
+работы и требует свободного места на диске примерно в размер файла,
+поэтому запускается вручную при остановленном боте:
+    python -m database.maintenance
+"""
+import logging
+import sqlite3
+import time
+
+from database import models
+
+logger = logging.getLogger(__name__)
+
+def enable_incremental_vacuum(path=None):
+    """
+    Переводит базу в режим auto_vacuum=INCREMENTAL
+
+    Returns:
+        bool: True, если режим был включен сейчас, False, если уже был включен
+    """
+    conn = sqlite3.connect(path or models.DB_FILE, isolation_level=None)
+    try:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+    finally:
+        conn.close()
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if not models.init_db():
+        return 1
+    started = time.perf_counter()
+    if enable_incremental_vacuum():
+        logger.info(f"Режим auto_vacuum=INCREMENTAL включен за {time.perf_counter() - started:.1f} с")
+    else:
+        logger.info("Режим auto_vacuum=INCREMENTAL уже включен")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
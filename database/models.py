@@ -2,12 +2,143 @@ import sqlite3
 from datetime import datetime
 from config import DB_FILE
 
+# Счетчики статистики и запросы, по которым они рассчитываются заново (при создании и сверке).
+# Между сверками счетчики поддерживают триггеры, созданные в init_db
+STATS_COUNTER_QUERIES = {
+    "users": "SELECT COUNT(*) FROM users",
+    "paid_users": "SELECT COUNT(*) FROM users WHERE subscription_type != 'free'",
+    "api_cost": "SELECT COALESCE(SUM(total_cost), 0) FROM users",
+    "messages": "SELECT (SELECT COUNT(*) FROM messages) + (SELECT COALESCE(SUM(message_count), 0) FROM messages_archive)",
+    "compatibility_analyses": "SELECT COUNT(*) FROM compatibility_analyses",
+    "horoscopes": "SELECT COUNT(*) FROM horoscopes WHERE status != 'pending_delivery'"
+}
+
+def _stats_delta(name, expression):
+    return f"UPDATE stats_counters SET value = value + ({expression}) WHERE name = '{name}';"
+
+# Триггеры, изменяющие счетчики в той же транзакции, что и сами данные
+STATS_TRIGGERS = {
+    "trg_stats_users_insert": ("AFTER INSERT ON users", [
+        _stats_delta("users", "1"),
+        _stats_delta("paid_users", "COALESCE(NEW.subscription_type != 'free', 0)"),
+        _stats_delta("api_cost", "COALESCE(NEW.total_cost, 0)")
+    ]),
+    "trg_stats_users_delete": ("AFTER DELETE ON users", [
+        _stats_delta("users", "-1"),
+        _stats_delta("paid_users", "-COALESCE(OLD.subscription_type != 'free', 0)"),
+        _stats_delta("api_cost", "-COALESCE(OLD.total_cost, 0)")
+    ]),
+    "trg_stats_users_update": (
+        "AFTER UPDATE OF subscription_type, total_cost ON users "
+        "WHEN OLD.subscription_type IS NOT NEW.subscription_type OR OLD.total_cost IS NOT NEW.total_cost",
+        [
+            _stats_delta(
+                "paid_users",
+                "COALESCE(NEW.subscription_type != 'free', 0) - COALESCE(OLD.subscription_type != 'free', 0)"
+            ),
+            _stats_delta("api_cost", "COALESCE(NEW.total_cost, 0) - COALESCE(OLD.total_cost, 0)")
+        ]
+    ),
+    "trg_stats_messages_insert": ("AFTER INSERT ON messages", [_stats_delta("messages", "1")]),
+    "trg_stats_messages_delete": ("AFTER DELETE ON messages", [_stats_delta("messages", "-1")]),
+    # Перенос в архив не меняет общее число сообщений
+    "trg_stats_messages_archive_insert": (
+        "AFTER INSERT ON messages_archive", [_stats_delta("messages", "NEW.message_count")]
+    ),
+    "trg_stats_messages_archive_delete": (
+        "AFTER DELETE ON messages_archive", [_stats_delta("messages", "-OLD.message_count")]
+    ),
+    "trg_stats_compatibility_insert": (
+        "AFTER INSERT ON compatibility_analyses", [_stats_delta("compatibility_analyses", "1")]
+    ),
+    "trg_stats_compatibility_delete": (
+        "AFTER DELETE ON compatibility_analyses", [_stats_delta("compatibility_analyses", "-1")]
+    ),
+    "trg_stats_horoscopes_insert": (
+        "AFTER INSERT ON horoscopes", [_stats_delta("horoscopes", "COALESCE(NEW.status != 'pending_delivery', 0)")]
+    ),
+    "trg_stats_horoscopes_delete": (
+        "AFTER DELETE ON horoscopes", [_stats_delta("horoscopes", "-COALESCE(OLD.status != 'pending_delivery', 0)")]
+    ),
+    "trg_stats_horoscopes_update": (
+        "AFTER UPDATE OF status ON horoscopes WHEN OLD.status IS NOT NEW.status",
+        [_stats_delta(
+            "horoscopes",
+            "COALESCE(NEW.status != 'pending_delivery', 0) - COALESCE(OLD.status != 'pending_delivery', 0)"
+        )]
+    )
+}
+
+def _search_text(column):
+    """Текст для полнотекстового индекса: ё и е не различаются (регистр приводит токенизатор unicode61)"""
+    return f"replace(replace(COALESCE({column}, ''), 'ё', 'е'), 'Ё', 'Е')"
+
+# Полнотекстовые индексы: таблица FTS5 -> (столбцы, запрос заполнения по основной таблице).
+# rowid контакта - contact_id, пользователя - числовой Telegram ID: обычный rowid
+# таблицы users может измениться после VACUUM
+SEARCH_TABLES = {
+    "contacts_fts": (
+        "owner, person_name, relationship",
+        f"SELECT contact_id, user_id, {_search_text('person_name')}, {_search_text('relationship')} FROM contacts"
+    ),
+    "users_fts": (
+        "username, first_name, last_name",
+        f"SELECT CAST(user_id AS INTEGER), {_search_text('username')}, {_search_text('first_name')}, "
+        f"{_search_text('last_name')} FROM users"
+    )
+}
+
+# Триггеры, обновляющие полнотекстовые индексы в той же транзакции, что и данные
+SEARCH_TRIGGERS = {
+    "trg_search_contacts_insert": ("AFTER INSERT ON contacts", [
+        "INSERT INTO contacts_fts (rowid, owner, person_name, relationship) VALUES "
+        f"(NEW.contact_id, NEW.user_id, {_search_text('NEW.person_name')}, {_search_text('NEW.relationship')});"
+    ]),
+    "trg_search_contacts_delete": ("AFTER DELETE ON contacts", [
+        "DELETE FROM contacts_fts WHERE rowid = OLD.contact_id;"
+    ]),
+    "trg_search_contacts_update": ("AFTER UPDATE OF user_id, person_name, relationship ON contacts", [
+        "DELETE FROM contacts_fts WHERE rowid = OLD.contact_id;",
+        "INSERT INTO contacts_fts (rowid, owner, person_name, relationship) VALUES "
+        f"(NEW.contact_id, NEW.user_id, {_search_text('NEW.person_name')}, {_search_text('NEW.relationship')});"
+    ]),
+    "trg_search_users_insert": ("AFTER INSERT ON users", [
+        "INSERT INTO users_fts (rowid, username, first_name, last_name) VALUES "
+        f"(CAST(NEW.user_id AS INTEGER), {_search_text('NEW.username')}, {_search_text('NEW.first_name')}, "
+        f"{_search_text('NEW.last_name')});"
+    ]),
+    "trg_search_users_delete": ("AFTER DELETE ON users", [
+        "DELETE FROM users_fts WHERE rowid = CAST(OLD.user_id AS INTEGER);"
+    ]),
+    # Только при смене имен: last_activity и счетчики меняются на каждое сообщение
+    "trg_search_users_update": ("AFTER UPDATE OF user_id, username, first_name, last_name ON users", [
+        "DELETE FROM users_fts WHERE rowid = CAST(OLD.user_id AS INTEGER);",
+        "INSERT INTO users_fts (rowid, username, first_name, last_name) VALUES "
+        f"(CAST(NEW.user_id AS INTEGER), {_search_text('NEW.username')}, {_search_text('NEW.first_name')}, "
+        f"{_search_text('NEW.last_name')});"
+    ])
+}
+
 def init_db():
     """Инициализирует базу данных и создает необходимые таблицы"""
     try:
         conn = sqlite3.connect(DB_FILE)
         cur = conn.cursor()
         
+        # Место, освобожденное архивацией сообщений, возвращается по частям через
+        # PRAGMA incremental_vacuum. В новой базе режим задается до создания таблиц, в
+        # существующей требует VACUUM и включается отдельно: python -m database.maintenance
+        cur.execute("PRAGMA auto_vacuum")
+        if cur.fetchone()[0] != 2:
+            cur.execute("SELECT COUNT(*) FROM sqlite_master")
+            if cur.fetchone()[0] == 0:
+                cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            else:
+                print(
+                    "Место после архивации сообщений не возвращается: режим auto_vacuum=INCREMENTAL "
+                    "не включен (python -m database.maintenance)"
+                )
+        
         # Таблица пользователей
         cur.execute("""
         CREATE TABLE IF NOT EXISTS users (
@@ -22,6 +153,7 @@ def init_db():
             longitude REAL,
             tz_name TEXT,
             natal_chart TEXT,
+            natal_chart_data BLOB,
             subscription_type TEXT DEFAULT 'free',
             subscription_end_date TEXT,
             free_messages_left INTEGER DEFAULT 3,
@@ -29,6 +161,9 @@ def init_db():
             horoscope_city TEXT,
             horoscope_latitude REAL,
             horoscope_longitude REAL,
+            horoscope_tz_name TEXT,  -- временная зона города гороскопа
+            next_delivery_at TEXT,  -- ближайшая доставка ежедневного гороскопа (UTC)
+            delivery_minute_utc INTEGER,  -- минута суток UTC ближайшей доставки
             registration_date TEXT DEFAULT CURRENT_TIMESTAMP,
             last_activity TEXT DEFAULT CURRENT_TIMESTAMP,
             input_tokens INTEGER DEFAULT 0,
@@ -51,6 +186,7 @@ def init_db():
             tz_name TEXT,
             relationship TEXT,
             natal_chart TEXT,
+            natal_chart_data BLOB,
             created_at TEXT DEFAULT CURRENT_TIMESTAMP,
             UNIQUE(user_id, person_name)
         )
@@ -81,6 +217,22 @@ def init_db():
         )
         """)
         
+        # Архив сообщений старше MESSAGE_RETENTION_DAYS: сообщения одного пользователя из
+        # одной порции архивации хранятся одной записью в виде сжатого zlib JSON
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS messages_archive (
+            chunk_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            first_message_id INTEGER,
+            last_message_id INTEGER,
+            first_created_at TEXT,
+            last_created_at TEXT,
+            message_count INTEGER,
+            data BLOB,  -- zlib(JSON [[message_id, direction, content, tokens, cost, created_at], ...])
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        
         # Таблица транзакций подписки с обновленной структурой
         cur.execute("""
         CREATE TABLE IF NOT EXISTS subscription_transactions (
@@ -93,6 +245,8 @@ def init_db():
             start_date TEXT,
             end_date TEXT,
             additional_data TEXT, -- JSON данные для хранения доп. информации о платеже
+            payload TEXT,  -- payload счета Telegram
+            telegram_payment_charge_id TEXT,  -- идентификатор оплаты Telegram
             created_at TEXT DEFAULT CURRENT_TIMESTAMP
         )
         """)
@@ -104,7 +258,10 @@ def init_db():
             user_id TEXT,
             horoscope_text TEXT,
             horoscope_type TEXT,  -- 'daily' или 'monthly'
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            status TEXT DEFAULT 'delivered',  -- 'delivered' или 'pending_delivery' (подготовлен заранее)
+            target_date TEXT,  -- дата, на которую подготовлен гороскоп
+            settings_hash TEXT  -- отпечаток настроек, с которыми подготовлен гороскоп
         )
         """)
         
@@ -118,12 +275,82 @@ def init_db():
         )
         """)
         
+        # Кэш интерпретаций натальных карт (ключ - хэш карты, модели и версии промпта)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS interpretation_cache (
+            cache_key TEXT PRIMARY KEY,
+            interpretation TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            last_access TEXT DEFAULT CURRENT_TIMESTAMP,
+            hits INTEGER DEFAULT 0
+        )
+        """)
+        
+        # Очередь доставок гороскопов (см. services/delivery_jobs.py)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS delivery_jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            idempotency_key TEXT UNIQUE,  -- тип:пользователь:дата, одна доставка на пользователя и дату
+            user_id TEXT,
+            job_type TEXT,  -- 'daily' или 'monthly'
+            target_date TEXT,  -- местная дата (или месяц) гороскопа
+            scheduled_at TEXT,  -- запланированный момент доставки (UTC)
+            status TEXT DEFAULT 'pending',  -- 'pending', 'running', 'done', 'skipped', 'dead'
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TEXT,  -- для 'running' - окончание аренды (UTC)
+            lease_owner TEXT,
+            last_error TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        
+        # Состояние задач планировщика, переживающее перезапуск (например, курсор рассылки)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS scheduler_state (
+            name TEXT PRIMARY KEY,
+            value TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        
+        # Счетчики статистики для админ-панели (поддерживаются триггерами STATS_TRIGGERS)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0,
+            reconciled_at TEXT  -- время последней сверки с таблицами
+        )
+        """)
+        
+        # Ежедневные снимки счетчиков для истории
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT,
+            name TEXT,
+            value REAL,
+            PRIMARY KEY (day, name)
+        )
+        """)
+        
         # Индексы для ускорения запросов
-        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)")
+        # История пользователя выбирается по (user_id, created_at) без сортировки
+        cur.execute("DROP INDEX IF EXISTS idx_messages_user_id")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages(user_id, created_at)")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_archive_user ON messages_archive(user_id, last_created_at)"
+        )
         cur.execute("CREATE INDEX IF NOT EXISTS idx_contacts_user_id ON contacts(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_horoscopes_user_id ON horoscopes(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON subscription_transactions(user_id)")
         cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_status ON subscription_transactions(status)")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_interpretation_cache_last_access ON interpretation_cache(last_access)")
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_delivery_jobs_ready
+        ON delivery_jobs(next_attempt_at)
+        WHERE status IN ('pending', 'running')
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_delivery_jobs_status ON delivery_jobs(status, updated_at)")
         
         # Проверяем, нужно ли добавить column additional_data в таблицу subscription_transactions
         # если она уже существует, но без этого поля
@@ -134,6 +361,148 @@ def init_db():
             cur.execute("ALTER TABLE subscription_transactions ADD COLUMN additional_data TEXT")
             conn.commit()
         
+        # payload счета и идентификатор оплаты в отдельных уникальных столбцах: поиск
+        # по индексу вместо LIKE по JSON, повторная обработка оплаты невозможна
+        payment_columns_added = False
+        try:
+            cur.execute("SELECT payload FROM subscription_transactions LIMIT 1")
+        except sqlite3.OperationalError:
+            cur.execute("ALTER TABLE subscription_transactions ADD COLUMN payload TEXT")
+            cur.execute("ALTER TABLE subscription_transactions ADD COLUMN telegram_payment_charge_id TEXT")
+            conn.commit()
+            payment_columns_added = True
+        cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_payload
+        ON subscription_transactions(payload)
+        WHERE payload IS NOT NULL
+        """)
+        cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_transactions_charge_id
+        ON subscription_transactions(telegram_payment_charge_id)
+        WHERE telegram_payment_charge_id IS NOT NULL
+        """)
+        if payment_columns_added:
+            # Заполняем столбцы из JSON транзакций, сохраненных раньше. При повторе payload
+            # (чего быть не должно) значение получает только первая транзакция
+            cur.execute("""
+            UPDATE OR IGNORE subscription_transactions
+            SET payload = json_extract(additional_data, '$.invoice_id')
+            WHERE json_valid(additional_data)
+            AND json_extract(additional_data, '$.invoice_id') IS NOT NULL
+            """)
+            cur.execute("""
+            UPDATE OR IGNORE subscription_transactions
+            SET telegram_payment_charge_id = json_extract(additional_data, '$.telegram_payment_charge_id')
+            WHERE json_valid(additional_data)
+            AND json_extract(additional_data, '$.telegram_payment_charge_id') IS NOT NULL
+            """)
+            conn.commit()
+        
+        # Двоичная запись натальной карты (см. services/natal_chart.py) рядом с текстовой
+        for table in ("users", "contacts"):
+            try:
+                cur.execute(f"SELECT natal_chart_data FROM {table} LIMIT 1")
+            except sqlite3.OperationalError:
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN natal_chart_data BLOB")
+                conn.commit()
+        
+        # Статус и отпечаток настроек для гороскопов, подготовленных заранее
+        for column, definition in (
+            ("status", "TEXT DEFAULT 'delivered'"),
+            ("target_date", "TEXT"),
+            ("settings_hash", "TEXT")
+        ):
+            try:
+                cur.execute(f"SELECT {column} FROM horoscopes LIMIT 1")
+            except sqlite3.OperationalError:
+                cur.execute(f"ALTER TABLE horoscopes ADD COLUMN {column} {definition}")
+                conn.commit()
+        
+        # Время ближайшей доставки гороскопа: планировщик выбирает пользователей по диапазону
+        try:
+            cur.execute("SELECT next_delivery_at FROM users LIMIT 1")
+        except sqlite3.OperationalError:
+            cur.execute("ALTER TABLE users ADD COLUMN next_delivery_at TEXT")
+            conn.commit()
+        # Время доставки хранится в UTC по временной зоне города гороскопа. Доставки,
+        # рассчитанные ранее по часам сервера, сбрасываются и пересчитываются при запуске
+        try:
+            cur.execute("SELECT horoscope_tz_name FROM users LIMIT 1")
+        except sqlite3.OperationalError:
+            cur.execute("ALTER TABLE users ADD COLUMN horoscope_tz_name TEXT")
+            cur.execute("ALTER TABLE users ADD COLUMN delivery_minute_utc INTEGER")
+            cur.execute("UPDATE users SET next_delivery_at = NULL")
+            conn.commit()
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_delivery_minute_utc
+        ON users(delivery_minute_utc)
+        WHERE delivery_minute_utc IS NOT NULL
+        """)
+        # Покрывающий индекс: выборка доставок движком не читает строки users
+        cur.execute("DROP INDEX IF EXISTS idx_users_next_delivery_at")
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_next_delivery
+        ON users(next_delivery_at, user_id, horoscope_time, horoscope_tz_name)
+        WHERE next_delivery_at IS NOT NULL
+        """)
+        # Пользователи с настроенным ежедневным гороскопом (постраничный обход без просмотра остальных)
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_horoscope_scheduled
+        ON users(user_id)
+        WHERE horoscope_time IS NOT NULL AND horoscope_city IS NOT NULL
+        """)
+        
+        # Окончания платных подписок: истекающие и истекшие выбираются диапазоном по индексу
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_subscription_end_date
+        ON users(subscription_end_date)
+        WHERE subscription_type != 'free'
+        """)
+        
+        # Пользователи, активные за период, считаются диапазоном по индексу, по нему же
+        # постранично выводится список пользователей в админ-панели (ключ last_activity, user_id)
+        cur.execute("DROP INDEX IF EXISTS idx_users_last_activity")
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_users_activity ON users(last_activity, user_id)")
+        
+        # Активные подписки по типам для экрана финансов
+        cur.execute("""
+        CREATE INDEX IF NOT EXISTS idx_users_paid_subscription_type
+        ON users(subscription_type)
+        WHERE subscription_type != 'free'
+        """)
+        
+        # Счетчики статистики: отсутствующие рассчитываются по таблицам, дальше их ведут триггеры
+        for name, query in STATS_COUNTER_QUERIES.items():
+            cur.execute(
+                f"INSERT OR IGNORE INTO stats_counters (name, value, reconciled_at) "
+                f"SELECT ?, ({query}), CURRENT_TIMESTAMP",
+                (name,)
+            )
+        for trigger, (event, statements) in STATS_TRIGGERS.items():
+            body = "\n".join(statements)
+            cur.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger} {event} BEGIN\n{body}\nEND")
+        
+        # Полнотекстовый поиск контактов и пользователей: префиксы слов без учета регистра и ё/е.
+        # Новые таблицы заполняются по основным, дальше их ведут триггеры SEARCH_TRIGGERS
+        for table, (columns, fill_query) in SEARCH_TABLES.items():
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+            if cur.fetchone() is None:
+                cur.execute(
+                    f"CREATE VIRTUAL TABLE {table} USING fts5("
+                    f"{columns}, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+                )
+                cur.execute(f"INSERT INTO {table} (rowid, {columns}) {fill_query}")
+        for trigger, (event, statements) in SEARCH_TRIGGERS.items():
+            body = "\n".join(statements)
+            cur.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger} {event} BEGIN\n{body}\nEND")
+        
+        # Не больше одного ожидающего отправки гороскопа на пользователя и дату
+        cur.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_horoscopes_pending
+        ON horoscopes(target_date, user_id, horoscope_type)
+        WHERE status = 'pending_delivery'
+        """)
+        
         conn.commit()
         conn.close()
         return True
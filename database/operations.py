@@ -1,602 +1,1607 @@
-import sqlite3
+import json
+import re
+import zlib
 from datetime import datetime, timedelta
-from config import DB_FILE
+from database.connection import db
+from database.models import STATS_COUNTER_QUERIES
+from database.user_cache import user_cache
+from utils.date_parser import next_local_time_utc, utc_to_local
 
-def dict_factory(cursor, row):
-    """Конвертирует строки SQLite в словари"""
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+# Формат next_delivery_at (UTC): строки в этом формате сравниваются как время
+DELIVERY_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
 
-def get_connection():
-    """Создает соединение с базой данных с row_factory"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = dict_factory
-    return conn
+# Столбцы users, нужные для генерации и доставки гороскопов (без двоичной карты и служебных полей)
+HOROSCOPE_USER_COLUMNS = (
+    "user_id", "natal_chart", "latitude", "longitude", "horoscope_latitude", "horoscope_longitude",
+    "horoscope_time", "horoscope_tz_name", "subscription_type"
+)
+
+# Столбцы строки списка пользователей в админ-панели
+ADMIN_USER_COLUMNS = ("user_id", "username", "first_name", "last_name", "subscription_type", "last_activity")
 
 # --- Операции с пользователями ---
 
 def get_user(user_id):
-    """Получает данные пользователя по ID"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-    user = cur.fetchone()
-    conn.close()
+    """Получает данные пользователя по ID (через кэш пользователей)"""
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
+    
+    token = user_cache.read_token()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        user = cur.fetchone()
+    user_cache.fill(user, token)
     return user
 
 def create_user(user_id, username, first_name, last_name):
     """Создает нового пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO users (user_id, username, first_name, last_name, free_messages_left)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            username = excluded.username,
-            first_name = excluded.first_name,
-            last_name = excluded.last_name,
-            last_activity = CURRENT_TIMESTAMP
-        """,
-        (user_id, username, first_name, last_name, 3)
-    )
-    conn.commit()
-    conn.close()
-    return get_user(user_id)
-
-def update_user_birth_info(user_id, birth_date, birth_time, city, latitude, longitude, tz_name, natal_chart):
-    """Обновляет информацию о рождении пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE users SET
-            birth_date = ?,
-            birth_time = ?,
-            city = ?,
-            latitude = ?,
-            longitude = ?,
-            tz_name = ?,
-            natal_chart = ?,
-            last_activity = CURRENT_TIMESTAMP
-        WHERE user_id = ?
-        """,
-        (birth_date, birth_time, city, latitude, longitude, tz_name, natal_chart, user_id)
-    )
-    conn.commit()
-    conn.close()
-    return get_user(user_id)
-
-def update_user_horoscope_settings(user_id, time, city, latitude, longitude):
-    """Обновляет настройки гороскопа пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE users SET
-            horoscope_time = ?,
-            horoscope_city = ?,
-            horoscope_latitude = ?,
-            horoscope_longitude = ?,
-            last_activity = CURRENT_TIMESTAMP
-        WHERE user_id = ?
-        """,
-        (time, city, latitude, longitude, user_id)
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO users (user_id, username, first_name, last_name, free_messages_left)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_name = excluded.last_name,
+                last_activity = CURRENT_TIMESTAMP
+            RETURNING *
+            """,
+            (user_id, username, first_name, last_name, 3)
+        )
+        user = cur.fetchone()
+        user_cache.put(user)
+    return user
+
+def update_user_birth_info(user_id, birth_date, birth_time, city, latitude, longitude, tz_name, natal_chart,
+                           natal_chart_data=None):
+    """
+    Обновляет информацию о рождении пользователя
+    
+    natal_chart - текст карты для вывода, natal_chart_data - двоичная запись
+    карты (NatalChart.to_bytes) для численных расчетов
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET
+                birth_date = ?,
+                birth_time = ?,
+                city = ?,
+                latitude = ?,
+                longitude = ?,
+                tz_name = ?,
+                natal_chart = ?,
+                natal_chart_data = ?,
+                last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+            RETURNING *
+            """,
+            (birth_date, birth_time, city, latitude, longitude, tz_name, natal_chart, natal_chart_data, user_id)
+        )
+        user = cur.fetchone()
+        user_cache.put(user)
+    return user
+
+def update_user_horoscope_settings(user_id, time, city, latitude, longitude, tz_name="UTC"):
+    """
+    Обновляет настройки гороскопа пользователя
+
+    time - местное время доставки в зоне tz_name. Время ближайшей доставки
+    (next_delivery_at, UTC) пересчитывается по новым настройкам.
+    """
+    next_delivery_at, delivery_minute = (
+        _next_delivery(time, tz_name, datetime.utcnow()) if time and city else (None, None)
     )
-    conn.commit()
-    conn.close()
-    return get_user(user_id)
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET
+                horoscope_time = ?,
+                horoscope_city = ?,
+                horoscope_latitude = ?,
+                horoscope_longitude = ?,
+                horoscope_tz_name = ?,
+                next_delivery_at = ?,
+                delivery_minute_utc = ?,
+                last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+            RETURNING *
+            """,
+            (time, city, latitude, longitude, tz_name, next_delivery_at, delivery_minute, user_id)
+        )
+        user = cur.fetchone()
+        user_cache.put(user)
+    return user
 
 def update_user_tokens(user_id, input_tokens, output_tokens, cost):
     """Обновляет статистику использования токенов пользователем"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE users SET
-            input_tokens = input_tokens + ?,
-            output_tokens = output_tokens + ?,
-            total_cost = total_cost + ?,
-            last_activity = CURRENT_TIMESTAMP
-        WHERE user_id = ?
-        """,
-        (input_tokens, output_tokens, cost, user_id)
-    )
-    conn.commit()
-    conn.close()
-    return get_user(user_id)
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET
+                input_tokens = input_tokens + ?,
+                output_tokens = output_tokens + ?,
+                total_cost = total_cost + ?,
+                last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+            RETURNING *
+            """,
+            (input_tokens, output_tokens, cost, user_id)
+        )
+        user = cur.fetchone()
+        user_cache.put(user)
+    return user
 
 def decrement_free_messages(user_id):
     """Уменьшает количество бесплатных сообщений"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE users SET
-            free_messages_left = MAX(0, free_messages_left - 1),
-            last_activity = CURRENT_TIMESTAMP
-        WHERE user_id = ? AND subscription_type = 'free'
-        """,
-        (user_id,)
-    )
-    conn.commit()
-    conn.close()
-    return get_user(user_id)
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET
+                free_messages_left = MAX(0, free_messages_left - 1),
+                last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND subscription_type = 'free'
+            RETURNING *
+            """,
+            (user_id,)
+        )
+        user = cur.fetchone()
+        user_cache.put(user)
+    # Для платных пользователей строка не обновляется
+    return user or get_user(user_id)
+
+def has_active_subscription(user):
+    """
+    Действует ли платная подписка пользователя
+
+    Истекшие подписки переводит на бесплатный план services/subscription_expiry.py,
+    но если трекер запаздывает или остановлен, подписка с прошедшей датой
+    окончания уже не дает доступа.
+    """
+    if user.get('subscription_type', 'free') == 'free' or not user.get('subscription_end_date'):
+        return False
+    return datetime.fromisoformat(user['subscription_end_date']) > datetime.now()
 
-def check_user_can_message(user_id):
-    """Проверяет, может ли пользователь отправлять сообщения"""
-    user = get_user(user_id)
+def check_user_can_message(user_id, user=None):
+    """
+    Проверяет, может ли пользователь отправлять сообщения
+    
+    user - уже загруженная строка пользователя (например, снимок из middleware),
+    чтобы не читать её повторно
+    """
+    if user is None:
+        user = get_user(user_id)
     if not user:
         return False
     
-    if user['subscription_type'] != 'free':
-        # Проверяем, не истекла ли подписка
-        if user['subscription_end_date']:
-            end_date = datetime.fromisoformat(user['subscription_end_date'])
-            if end_date > datetime.now():
-                return True
-            else:
-                # Подписка истекла, возвращаем к бесплатному плану
-                conn = get_connection()
-                cur = conn.cursor()
-                cur.execute(
-                    """
-                    UPDATE users SET
-                        subscription_type = 'free',
-                        subscription_end_date = NULL
-                    WHERE user_id = ?
-                    """,
-                    (user_id,)
-                )
-                conn.commit()
-                conn.close()
+    if has_active_subscription(user):
+        return True
     
     # Для бесплатного плана проверяем лимит сообщений
     return user['free_messages_left'] > 0
 
-def update_user_subscription(user_id, subscription_type, months=1):
-    """Обновляет подписку пользователя"""
-    end_date = datetime.now() + timedelta(days=30*months)
-    
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE users SET
-            subscription_type = ?,
-            subscription_end_date = ?,
-            last_activity = CURRENT_TIMESTAMP
-        WHERE user_id = ?
-        """,
-        (subscription_type, end_date.isoformat(), user_id)
-    )
-    conn.commit()
-    conn.close()
-    return get_user(user_id)
-
-def get_users_with_horoscope_at_time(current_time):
-    """Получает пользователей, для которых нужно отправить гороскоп в указанное время"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT * FROM users 
-        WHERE horoscope_time = ? 
-        AND horoscope_city IS NOT NULL
-        """,
-        (current_time,)
-    )
-    users = cur.fetchall()
-    conn.close()
-    return users
+def update_user_subscription(user_id, subscription_type, months=1):
+    """Обновляет подписку пользователя"""
+    end_date = datetime.now() + timedelta(days=30*months)
+    
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET
+                subscription_type = ?,
+                subscription_end_date = ?,
+                last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = ?
+            RETURNING *
+            """,
+            (subscription_type, end_date.isoformat(), user_id)
+        )
+        user = cur.fetchone()
+        user_cache.put(user)
+    return user
+
+def get_subscriptions_expiring_between(start, end, limit=None):
+    """
+    Получает пользователей, чья платная подписка заканчивается в интервале (start, end]
+
+    Returns:
+        list: Строки пользователей по возрастанию subscription_end_date
+    """
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT * FROM users
+            WHERE subscription_type != 'free'
+            AND subscription_end_date > ? AND subscription_end_date <= ?
+            ORDER BY subscription_end_date
+            LIMIT ?
+            """,
+            (start.isoformat(), end.isoformat(), -1 if limit is None else limit)
+        )
+        users = cur.fetchall()
+    return users
+
+def expire_subscriptions(now, limit=500):
+    """
+    Переводит на бесплатный план пользователей, чья подписка закончилась к now
+
+    Returns:
+        list: Строки пользователей после изменения
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE users SET
+                subscription_type = 'free',
+                subscription_end_date = NULL
+            WHERE user_id IN (
+                SELECT user_id FROM users
+                WHERE subscription_type != 'free' AND subscription_end_date <= ?
+                LIMIT ?
+            )
+            RETURNING *
+            """,
+            (now.isoformat(), limit)
+        )
+        users = cur.fetchall()
+    for user in users:
+        user_cache.put(user)
+    return users
+
+def _next_delivery(horoscope_time, tz_name, after):
+    """
+    Ближайшая после after (UTC) доставка в местное время horoscope_time зоны tz_name
+
+    Returns:
+        tuple: (время UTC в формате DELIVERY_TIME_FORMAT, минута суток UTC)
+    """
+    moment = next_local_time_utc(horoscope_time, tz_name, after)
+    return moment.strftime(DELIVERY_TIME_FORMAT), moment.hour * 60 + moment.minute
+
+def schedule_missing_horoscope_deliveries(resolve_tz=None):
+    """
+    Рассчитывает next_delivery_at для пользователей с настроенным гороскопом, у которых его нет
+
+    Пользователям без временной зоны гороскопа она определяется по координатам
+    города функцией resolve_tz(lat, lon) (например, services.geo.get_timezone_name).
+
+    Returns:
+        int: Количество запланированных пользователей
+    """
+    now = datetime.utcnow()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id, horoscope_time, horoscope_tz_name, horoscope_latitude, horoscope_longitude
+            FROM users
+            WHERE next_delivery_at IS NULL
+            AND horoscope_time IS NOT NULL
+            AND horoscope_city IS NOT NULL
+            """
+        )
+        rows = cur.fetchall()
+
+        records = []
+        for row in rows:
+            tz_name = row["horoscope_tz_name"]
+            if not tz_name:
+                if resolve_tz and row["horoscope_latitude"] is not None and row["horoscope_longitude"] is not None:
+                    tz_name = resolve_tz(row["horoscope_latitude"], row["horoscope_longitude"])
+                else:
+                    tz_name = "UTC"
+            records.append((tz_name, *_next_delivery(row["horoscope_time"], tz_name, now), row["user_id"]))
+
+        cur.executemany(
+            """
+            UPDATE users SET horoscope_tz_name = ?, next_delivery_at = ?, delivery_minute_utc = ?
+            WHERE user_id = ?
+            """,
+            records
+        )
+    if rows:
+        user_cache.invalidate()
+    return len(rows)
+
+def get_horoscope_deliveries_between(start, end, limit=10000):
+    """
+    Получает запланированные доставки гороскопов в интервале [start, end)
+
+    Returns:
+        list: Строки с полями user_id и next_delivery_at по возрастанию времени
+    """
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id, next_delivery_at FROM users
+            WHERE next_delivery_at >= ? AND next_delivery_at < ?
+            ORDER BY next_delivery_at
+            LIMIT ?
+            """,
+            (start, end, limit)
+        )
+        deliveries = cur.fetchall()
+    return deliveries
+
+def claim_due_horoscope_deliveries(now, limit=1000, missed_before=None):
+    """
+    Забирает пользователей, которым пора отправить ежедневный гороскоп (now - наивное время UTC)
+
+    В той же транзакции next_delivery_at переносится на следующую доставку,
+    а в очередь delivery_jobs добавляется задание доставки, поэтому
+    повторный вызов (или другой процесс) не отправит гороскоп дважды, а
+    остановка бота после вызова не потеряет доставку. Доставки, запланированные
+    раньше missed_before (бот был остановлен), переносятся без задания.
+
+    Returns:
+        dict: claimed - забрано пользователей, enqueued - добавлено заданий, missed - пропущено доставок
+    """
+    result = {"claimed": 0, "enqueued": 0, "missed": 0}
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id, horoscope_time, horoscope_tz_name, next_delivery_at FROM users
+            WHERE next_delivery_at <= ?
+            ORDER BY next_delivery_at
+            LIMIT ?
+            """,
+            (now.strftime(DELIVERY_TIME_FORMAT), limit)
+        )
+        due = cur.fetchall()
+
+        missed_before = missed_before.strftime(DELIVERY_TIME_FORMAT) if missed_before else None
+        for row in due:
+            # Следующая доставка считается от текущего момента (в том числе после долгого простоя)
+            # по местному времени, поэтому смещение UTC меняется вместе с переходом на летнее время
+            cur.execute(
+                "UPDATE users SET next_delivery_at = ?, delivery_minute_utc = ? WHERE user_id = ? RETURNING *",
+                (*_next_delivery(row["horoscope_time"], row["horoscope_tz_name"], now), row["user_id"])
+            )
+            user_cache.put(cur.fetchone())
+            result["claimed"] += 1
+
+            due_at = row["next_delivery_at"]
+            if missed_before and due_at < missed_before:
+                result["missed"] += 1
+                continue
+
+            local_date = utc_to_local(
+                datetime.strptime(due_at, DELIVERY_TIME_FORMAT), row["horoscope_tz_name"]
+            ).date().isoformat()
+            result["enqueued"] += _insert_delivery_job(cur, row["user_id"], "daily", local_date, due_at)
+    return result
+
+def get_horoscope_delivery_histogram():
+    """
+    Распределение доставок гороскопов по минутам суток UTC
+
+    Returns:
+        list: Строки с полями delivery_minute_utc и users по убыванию числа пользователей
+    """
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT delivery_minute_utc, COUNT(*) AS users FROM users
+            WHERE delivery_minute_utc IS NOT NULL
+            GROUP BY delivery_minute_utc
+            ORDER BY users DESC
+            """
+        )
+        histogram = cur.fetchall()
+    return histogram
+
+def get_users_page(after=None, before=None, limit=20):
+    """
+    Страница списка пользователей для админ-панели, от недавно активных к давним
+
+    Постраничный вывод по ключу (last_activity, user_id) через индекс
+    idx_users_activity: стоимость страницы не зависит от ее номера и
+    размера таблицы. Выбираются только столбцы ADMIN_USER_COLUMNS.
+
+    Args:
+        after: Ключ (last_activity, user_id) последней строки текущей страницы - следующая страница
+        before: Ключ первой строки текущей страницы - предыдущая страница
+        limit: Размер страницы
+
+    Returns:
+        dict: users - строки страницы, has_prev/has_next - есть ли соседние страницы
+    """
+    columns = ", ".join(ADMIN_USER_COLUMNS)
+    with db.read() as conn:
+        cur = conn.cursor()
+        if before is not None:
+            # Предыдущая страница читается в обратном порядке и переворачивается
+            cur.execute(
+                f"""
+                SELECT {columns} FROM users
+                WHERE (last_activity, user_id) > (?, ?)
+                ORDER BY last_activity, user_id
+                LIMIT ?
+                """,
+                (*before, limit + 1)
+            )
+            users = cur.fetchall()
+            has_prev = len(users) > limit
+            return {"users": users[:limit][::-1], "has_prev": has_prev, "has_next": True}
+
+        if after is not None:
+            cur.execute(
+                f"""
+                SELECT {columns} FROM users
+                WHERE (last_activity, user_id) < (?, ?)
+                ORDER BY last_activity DESC, user_id DESC
+                LIMIT ?
+                """,
+                (*after, limit + 1)
+            )
+        else:
+            cur.execute(
+                f"SELECT {columns} FROM users ORDER BY last_activity DESC, user_id DESC LIMIT ?",
+                (limit + 1,)
+            )
+        users = cur.fetchall()
+    return {"users": users[:limit], "has_prev": after is not None, "has_next": len(users) > limit}
+
+def search_users(text, limit=20):
+    """
+    Ищет пользователей по началу слов username, имени или фамилии
+
+    Поиск по индексу users_fts без учета регистра и ё/е, "@" перед username
+    не мешает. Возвращает столбцы ADMIN_USER_COLUMNS, лучшие совпадения первыми.
+    """
+    query = _fts_prefix_query(text)
+    if query is None:
+        return []
+    columns = ", ".join(f"users.{column}" for column in ADMIN_USER_COLUMNS)
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {columns} FROM users_fts
+            JOIN users ON users.user_id = CAST(users_fts.rowid AS TEXT)
+            WHERE users_fts MATCH ?
+            ORDER BY users_fts.rank
+            LIMIT ?
+            """,
+            (query, limit)
+        )
+        return cur.fetchall()
+
+def get_subscription_counts():
+    """Число активных подписок по типам (по частичному индексу idx_users_paid_subscription_type)"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT subscription_type, COUNT(*) as count FROM users
+            WHERE subscription_type != 'free'
+            GROUP BY subscription_type
+            """
+        )
+        return {row["subscription_type"]: row["count"] for row in cur.fetchall()}
+
+# --- Операции с контактами ---
+
+def add_contact(user_id, person_name, birth_date, birth_time, city, latitude, longitude, tz_name, relationship, natal_chart,
+                natal_chart_data=None):
+    """Добавляет или обновляет контакт для совместимости"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO contacts 
+            (user_id, person_name, birth_date, birth_time, city, latitude, longitude, tz_name, relationship, natal_chart,
+             natal_chart_data)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, person_name) DO UPDATE SET
+                birth_date = excluded.birth_date,
+                birth_time = excluded.birth_time,
+                city = excluded.city,
+                latitude = excluded.latitude,
+                longitude = excluded.longitude,
+                tz_name = excluded.tz_name,
+                relationship = excluded.relationship,
+                natal_chart = excluded.natal_chart,
+                natal_chart_data = excluded.natal_chart_data
+            """,
+            (user_id, person_name, birth_date, birth_time, city, latitude, longitude, tz_name, relationship, natal_chart,
+             natal_chart_data)
+        )
+        contact_id = cur.lastrowid
+    return contact_id
+
+def get_contacts(user_id):
+    """Получает все контакты пользователя"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM contacts WHERE user_id = ? ORDER BY person_name", (user_id,))
+        contacts = cur.fetchall()
+    return contacts
+
+def get_contact(contact_id):
+    """Получает данные контакта по ID"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM contacts WHERE contact_id = ?", (contact_id,))
+        contact = cur.fetchone()
+    return contact
+
+def delete_contact(contact_id, user_id):
+    """Удаляет контакт пользователя"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM contacts WHERE contact_id = ? AND user_id = ?", (contact_id, user_id))
+        deleted = cur.rowcount > 0
+    return deleted
+
+def _fts_phrase(value):
+    """Строка в кавычках для запроса FTS5"""
+    return '"' + str(value).replace('"', '""') + '"'
+
+def _fts_prefix_query(text):
+    """
+    Запрос FTS5: каждое слово текста как префикс, все слова обязательны
+
+    ё заменяется на е так же, как в индексируемом тексте (см. _search_text в models).
+    Возвращает None, если в тексте нет слов.
+    """
+    words = re.findall(r"\w+", text.replace("ё", "е").replace("Ё", "Е"))
+    if not words:
+        return None
+    return " ".join(f"{_fts_phrase(word)}*" for word in words)
+
+def search_contacts(user_id, text, limit=10):
+    """
+    Ищет контакты пользователя по началу слов имени или отношения
+
+    Поиск по индексу contacts_fts без учета регистра (включая кириллицу) и ё/е:
+    "ма" находит "Мама" и "Мария Иванова". Время не зависит от числа контактов.
+    """
+    query = _fts_prefix_query(text)
+    if query is None:
+        return []
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT contacts.* FROM contacts_fts
+            JOIN contacts ON contacts.contact_id = contacts_fts.rowid
+            WHERE contacts_fts MATCH ?
+            ORDER BY contacts_fts.rank
+            LIMIT ?
+            """,
+            (f"owner : {_fts_phrase(user_id)} AND {{person_name relationship}} : ({query})", limit)
+        )
+        return cur.fetchall()
+
+def find_contact_by_name_or_relationship(user_id, text):
+    """Ищет контакт по имени или отношению"""
+    return search_contacts(user_id, text)
+
+# --- Двоичные записи натальных карт ---
+
+def get_rows_without_natal_chart_data(table):
+    """
+    Возвращает пользователей или контакты с данными рождения, но без двоичной записи карты
+    
+    Args:
+        table: 'users' или 'contacts'
+    """
+    key = {"users": "user_id", "contacts": "contact_id"}[table]
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {key} AS row_id, birth_date, birth_time, latitude, longitude, tz_name
+            FROM {table}
+            WHERE natal_chart_data IS NULL
+              AND birth_date IS NOT NULL AND birth_time IS NOT NULL
+              AND latitude IS NOT NULL AND longitude IS NOT NULL
+            """
+        )
+        rows = cur.fetchall()
+    return rows
+
+def set_natal_chart_data(table, records):
+    """
+    Сохраняет двоичные записи карт пачкой
+    
+    Args:
+        table: 'users' или 'contacts'
+        records: Список пар (id строки, natal_chart_data)
+    """
+    key = {"users": "user_id", "contacts": "contact_id"}[table]
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            f"UPDATE {table} SET natal_chart_data = ? WHERE {key} = ?",
+            [(data, row_id) for row_id, data in records]
+        )
+        if table == "users":
+            for row_id, _ in records:
+                user_cache.invalidate(row_id)
+    return len(records)
+
+# --- Операции с сообщениями ---
+
+def add_message(user_id, direction, content, tokens=0, cost=0):
+    """Добавляет сообщение в историю"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO messages (user_id, direction, content, tokens, cost)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (user_id, direction, content, tokens, cost)
+        )
+        message_id = cur.lastrowid
+    return message_id
+
+def get_user_messages(user_id, limit=20):
+    """Получает историю сообщений пользователя"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT * FROM messages 
+            WHERE user_id = ? 
+            ORDER BY created_at DESC 
+            LIMIT ?
+            """,
+            (user_id, limit)
+        )
+        messages = cur.fetchall()
+    # Возвращаем в обратном порядке, чтобы самые старые были вначале
+    return list(reversed(messages))
+
+def archive_old_messages(before, limit=500):
+    """
+    Переносит порцию сообщений старше before в messages_archive
+
+    message_id растет вместе с created_at, поэтому старые сообщения - начало
+    таблицы: читается не больше limit первых строк, и запрос не зависит от
+    размера таблицы. Сообщения каждого пользователя из порции сохраняются
+    одной записью, сжатой zlib, и удаляются в той же транзакции.
+
+    Returns:
+        int: Число перенесенных сообщений (меньше limit - старых сообщений не осталось)
+    """
+    # created_at заполняет CURRENT_TIMESTAMP: UTC в том же формате, что и next_delivery_at
+    before = before.strftime(DELIVERY_TIME_FORMAT)
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT message_id, user_id, direction, content, tokens, cost, created_at
+            FROM messages ORDER BY message_id LIMIT ?
+            """,
+            (limit,)
+        )
+        messages = []
+        for message in cur.fetchall():
+            if message["created_at"] >= before:
+                break
+            messages.append(message)
+        if not messages:
+            return 0
+        
+        chunks = {}
+        for message in messages:
+            chunks.setdefault(message["user_id"], []).append(message)
+        for user_id, chunk in chunks.items():
+            data = [
+                [m["message_id"], m["direction"], m["content"], m["tokens"], m["cost"], m["created_at"]]
+                for m in chunk
+            ]
+            cur.execute(
+                """
+                INSERT INTO messages_archive
+                (user_id, first_message_id, last_message_id, first_created_at, last_created_at, message_count, data)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    user_id, chunk[0]["message_id"], chunk[-1]["message_id"],
+                    chunk[0]["created_at"], chunk[-1]["created_at"], len(chunk),
+                    zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+                )
+            )
+        cur.execute("DELETE FROM messages WHERE message_id <= ?", (messages[-1]["message_id"],))
+    return len(messages)
+
+def get_archived_messages(user_id, limit=100):
+    """Получает последние limit архивных сообщений пользователя (самые старые вначале)"""
+    messages = []
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT data FROM messages_archive WHERE user_id = ? ORDER BY last_created_at DESC",
+            (user_id,)
+        )
+        for row in cur:
+            chunk = json.loads(zlib.decompress(row["data"]))
+            messages[:0] = [
+                dict(zip(("message_id", "direction", "content", "tokens", "cost", "created_at"), item), user_id=user_id)
+                for item in chunk
+            ]
+            if len(messages) >= limit:
+                break
+    return messages[-limit:]
+
+def incremental_vacuum(pages):
+    """
+    Возвращает файловой системе до pages свободных страниц базы
+
+    Returns:
+        int: Число свободных страниц, оставшихся в файле
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute("PRAGMA freelist_count")
+        free_pages = list(cur.fetchone().values())[0]
+        # Каждый шаг PRAGMA incremental_vacuum освобождает одну страницу, а модуль sqlite3
+        # выполняет у запроса без результата только первый шаг
+        for _ in range(min(pages, free_pages)):
+            cur.execute("PRAGMA incremental_vacuum(1)")
+        cur.execute("PRAGMA freelist_count")
+        return list(cur.fetchone().values())[0]
+
+# --- Операции с гороскопами ---
+
+def add_horoscope(user_id, horoscope_text, horoscope_type='daily'):
+    """Сохраняет гороскоп в базу данных"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO horoscopes (user_id, horoscope_text, horoscope_type)
+            VALUES (?, ?, ?)
+            """,
+            (user_id, horoscope_text, horoscope_type)
+        )
+        horoscope_id = cur.lastrowid
+    return horoscope_id
+
+def get_last_horoscope(user_id, horoscope_type='daily'):
+    """Получает последний гороскоп пользователя указанного типа"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT * FROM horoscopes 
+            WHERE user_id = ? AND horoscope_type = ? 
+            AND status != 'pending_delivery'
+            ORDER BY created_at DESC 
+            LIMIT 1
+            """,
+            (user_id, horoscope_type)
+        )
+        horoscope = cur.fetchone()
+    return horoscope
+
+def save_pending_horoscope(user_id, horoscope_text, target_date, settings_hash, horoscope_type='daily'):
+    """
+    Сохраняет гороскоп, подготовленный заранее, со статусом pending_delivery
+
+    Ранее подготовленный гороскоп пользователя на ту же дату заменяется.
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            DELETE FROM horoscopes
+            WHERE target_date = ? AND user_id = ? AND horoscope_type = ?
+            AND status = 'pending_delivery'
+            """,
+            (target_date, user_id, horoscope_type)
+        )
+        cur.execute(
+            """
+            INSERT INTO horoscopes (user_id, horoscope_text, horoscope_type, status, target_date, settings_hash)
+            VALUES (?, ?, ?, 'pending_delivery', ?, ?)
+            """,
+            (user_id, horoscope_text, horoscope_type, target_date, settings_hash)
+        )
+        horoscope_id = cur.lastrowid
+    return horoscope_id
+
+def get_users_for_horoscope_pregeneration(target_date, after_user_id=None, limit=1000, horoscope_type='daily'):
+    """
+    Получает страницу пользователей с настроенным ежедневным гороскопом
+
+    Пользователи обходятся по индексу idx_users_horoscope_scheduled в порядке
+    user_id начиная после after_user_id; возвращаются только столбцы
+    HOROSCOPE_USER_COLUMNS. В поле pending_settings_hash возвращается
+    отпечаток настроек уже подготовленного на target_date гороскопа
+    (или NULL, если его нет).
+    """
+    columns = ", ".join(f"u.{column}" for column in HOROSCOPE_USER_COLUMNS)
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {columns}, h.settings_hash AS pending_settings_hash
+            FROM users u
+            LEFT JOIN horoscopes h
+                ON h.target_date = ? AND h.user_id = u.user_id AND h.horoscope_type = ?
+                AND h.status = 'pending_delivery'
+            WHERE u.horoscope_time IS NOT NULL
+            AND u.horoscope_city IS NOT NULL
+            AND u.user_id > ?
+            ORDER BY u.user_id
+            LIMIT ?
+            """,
+            (target_date, horoscope_type, after_user_id or "", limit)
+        )
+        users = cur.fetchall()
+    return users
+
+def get_pending_horoscopes(user_ids, horoscope_type='daily'):
+    """Получает подготовленные гороскопы указанных пользователей (на все даты)"""
+    horoscopes = []
+    with db.read() as conn:
+        cur = conn.cursor()
+        # Список разбивается на части, чтобы не превысить лимит параметров SQLite
+        for offset in range(0, len(user_ids), 500):
+            chunk = user_ids[offset:offset + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(
+                f"""
+                SELECT * FROM horoscopes
+                WHERE user_id IN ({placeholders}) AND horoscope_type = ?
+                AND status = 'pending_delivery'
+                """,
+                (*chunk, horoscope_type)
+            )
+            horoscopes.extend(cur.fetchall())
+    return horoscopes
+
+def mark_horoscope_delivered(horoscope_id):
+    """Отмечает подготовленный гороскоп как отправленный"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        # created_at показывается пользователю как время отправки
+        cur.execute(
+            """
+            UPDATE horoscopes SET status = 'delivered', created_at = CURRENT_TIMESTAMP
+            WHERE horoscope_id = ? AND status = 'pending_delivery'
+            """,
+            (horoscope_id,)
+        )
+        updated = cur.rowcount > 0
+    return updated
+
+def delete_pending_horoscope(horoscope_id):
+    """Удаляет подготовленный гороскоп (например, устаревший после изменения настроек)"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM horoscopes WHERE horoscope_id = ? AND status = 'pending_delivery'",
+            (horoscope_id,)
+        )
+        deleted = cur.rowcount > 0
+    return deleted
+
+def delete_expired_pending_horoscopes(before_date):
+    """Удаляет неотправленные подготовленные гороскопы на даты раньше before_date"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM horoscopes WHERE status = 'pending_delivery' AND target_date < ?",
+            (before_date,)
+        )
+        deleted = cur.rowcount
+    return deleted
+
+# --- Операции с очередью доставок ---
+
+def _delivery_job_key(user_id, job_type, target_date):
+    """Ключ идемпотентности задания: одна доставка гороскопа типа job_type пользователю на target_date"""
+    return f"{job_type}:{user_id}:{target_date}"
+
+def _insert_delivery_job(cur, user_id, job_type, target_date, scheduled_at):
+    """Добавляет задание, если задания с тем же ключом еще нет. Возвращает 1, если добавлено"""
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO delivery_jobs
+            (idempotency_key, user_id, job_type, target_date, scheduled_at, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        (_delivery_job_key(user_id, job_type, target_date), user_id, job_type, target_date, scheduled_at, scheduled_at)
+    )
+    return cur.rowcount
+
+def enqueue_delivery_jobs(job_type, target_date, jobs, state=None):
+    """
+    Добавляет задания доставки гороскопа
+
+    Задания, уже существующие для той же даты (повторный запуск рассылки),
+    не дублируются.
+
+    Args:
+        jobs: Список пар (user_id, запланированное время в UTC)
+        state: Пара (name, value), которая сохраняется в scheduler_state в той же
+            транзакции (курсор планирования рассылки)
+
+    Returns:
+        int: Количество добавленных заданий
+    """
+    enqueued = 0
+    with db.write() as conn:
+        cur = conn.cursor()
+        for user_id, scheduled_at in jobs:
+            enqueued += _insert_delivery_job(
+                cur, user_id, job_type, target_date, scheduled_at.strftime(DELIVERY_TIME_FORMAT)
+            )
+        if state is not None:
+            _set_scheduler_state(cur, *state)
+    return enqueued
+
+def claim_delivery_jobs(worker_id, now, lease_seconds, limit=100, max_attempts=5):
+    """
+    Берет в работу задания, время которых наступило (now - наивное время UTC)
+
+    Задание получает аренду на lease_seconds: next_attempt_at становится
+    временем её окончания. Если процесс остановится, не завершив задание,
+    после окончания аренды оно снова будет выдано. Задания, исчерпавшие
+    max_attempts попыток без завершения, переводятся в dead.
+
+    Returns:
+        list: Строки заданий
+    """
+    now_str = now.strftime(DELIVERY_TIME_FORMAT)
+    lease_until = (now + timedelta(seconds=lease_seconds)).strftime(DELIVERY_TIME_FORMAT)
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE delivery_jobs
+            SET status = 'dead', lease_owner = NULL, updated_at = CURRENT_TIMESTAMP,
+                last_error = COALESCE(last_error, 'аренда истекла')
+            WHERE status = 'running' AND next_attempt_at <= ? AND attempts >= ?
+            """,
+            (now_str, max_attempts)
+        )
+        cur.execute(
+            """
+            UPDATE delivery_jobs
+            SET status = 'running', lease_owner = ?, next_attempt_at = ?,
+                attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id IN (
+                SELECT job_id FROM delivery_jobs
+                WHERE status IN ('pending', 'running') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at
+                LIMIT ?
+            )
+            RETURNING *
+            """,
+            (worker_id, lease_until, now_str, limit)
+        )
+        jobs = cur.fetchall()
+    return jobs
+
+def complete_delivery_job(job_id, worker_id, status='done'):
+    """
+    Завершает задание со статусом done (гороскоп отправлен) или skipped (не хватает данных)
+
+    Returns:
+        bool: False, если аренда задания уже перешла к другому процессу
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE delivery_jobs
+            SET status = ?, lease_owner = NULL, next_attempt_at = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND status = 'running' AND lease_owner = ?
+            """,
+            (status, job_id, worker_id)
+        )
+        updated = cur.rowcount > 0
+    return updated
+
+def fail_delivery_job(job_id, worker_id, error, retry_at=None):
+    """
+    Записывает ошибку задания
+
+    Если передан retry_at (наивное время UTC), задание будет повторено
+    в это время, иначе переводится в dead.
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE delivery_jobs
+            SET status = ?, next_attempt_at = ?, last_error = ?, lease_owner = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE job_id = ? AND status = 'running' AND lease_owner = ?
+            """,
+            (
+                "pending" if retry_at else "dead",
+                retry_at.strftime(DELIVERY_TIME_FORMAT) if retry_at else None,
+                str(error)[:1000],
+                job_id,
+                worker_id
+            )
+        )
+        updated = cur.rowcount > 0
+    return updated
+
+def release_delivery_jobs(worker_id, now):
+    """
+    Возвращает в очередь задания, арендованные процессом worker_id (при его остановке)
 
-def get_all_users():
-    """Получает всех пользователей для административных целей"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users ORDER BY last_activity DESC")
-    users = cur.fetchall()
-    conn.close()
-    return users
+    Задания снова готовы к выдаче в момент now (наивное время UTC), прерванная
+    попытка не учитывается, поэтому перезапущенный процесс продолжает рассылку
+    сразу, не дожидаясь окончания аренды.
 
-# --- Операции с контактами ---
+    Returns:
+        int: Число возвращенных заданий
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE delivery_jobs
+            SET status = 'pending', lease_owner = NULL, next_attempt_at = ?,
+                attempts = MAX(attempts - 1, 0), updated_at = CURRENT_TIMESTAMP
+            WHERE status = 'running' AND lease_owner = ?
+            """,
+            (now.strftime(DELIVERY_TIME_FORMAT), worker_id)
+        )
+        released = cur.rowcount
+    return released
 
-def add_contact(user_id, person_name, birth_date, birth_time, city, latitude, longitude, tz_name, relationship, natal_chart):
-    """Добавляет или обновляет контакт для совместимости"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO contacts 
-        (user_id, person_name, birth_date, birth_time, city, latitude, longitude, tz_name, relationship, natal_chart)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(user_id, person_name) DO UPDATE SET
-            birth_date = excluded.birth_date,
-            birth_time = excluded.birth_time,
-            city = excluded.city,
-            latitude = excluded.latitude,
-            longitude = excluded.longitude,
-            tz_name = excluded.tz_name,
-            relationship = excluded.relationship,
-            natal_chart = excluded.natal_chart
-        """,
-        (user_id, person_name, birth_date, birth_time, city, latitude, longitude, tz_name, relationship, natal_chart)
-    )
-    conn.commit()
-    contact_id = cur.lastrowid
-    conn.close()
-    return contact_id
+def get_next_delivery_job_at():
+    """Время ближайшего задания или окончания аренды (в формате DELIVERY_TIME_FORMAT) или None"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT MIN(next_attempt_at) AS next_attempt_at FROM delivery_jobs WHERE status IN ('pending', 'running')"
+        )
+        row = cur.fetchone()
+    return row["next_attempt_at"] if row else None
 
-def get_contacts(user_id):
-    """Получает все контакты пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM contacts WHERE user_id = ? ORDER BY person_name", (user_id,))
-    contacts = cur.fetchall()
-    conn.close()
-    return contacts
+def get_delivery_job_stats():
+    """Количество заданий доставки по статусам"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT status, COUNT(*) AS jobs FROM delivery_jobs GROUP BY status")
+        stats = {row["status"]: row["jobs"] for row in cur.fetchall()}
+    return stats
 
-def get_contact(contact_id):
-    """Получает данные контакта по ID"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM contacts WHERE contact_id = ?", (contact_id,))
-    contact = cur.fetchone()
-    conn.close()
-    return contact
+def get_dead_delivery_jobs(limit=50):
+    """Последние задания, доставка которых не удалась"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT * FROM delivery_jobs WHERE status = 'dead' ORDER BY updated_at DESC LIMIT ?",
+            (limit,)
+        )
+        jobs = cur.fetchall()
+    return jobs
 
-def delete_contact(contact_id, user_id):
-    """Удаляет контакт пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM contacts WHERE contact_id = ? AND user_id = ?", (contact_id, user_id))
-    deleted = cur.rowcount > 0
-    conn.commit()
-    conn.close()
-    return deleted
+def delete_finished_delivery_jobs(before):
+    """
+    Удаляет завершенные задания, обновленные раньше before (наивное время UTC)
 
-def find_contact_by_name_or_relationship(user_id, text):
-    """Ищет контакт по имени или отношению"""
-    conn = get_connection()
-    cur = conn.cursor()
-    text_pattern = f"%{text}%"
-    cur.execute(
-        """
-        SELECT * FROM contacts 
-        WHERE user_id = ? AND (
-            LOWER(person_name) LIKE LOWER(?) OR 
-            LOWER(relationship) LIKE LOWER(?)
+    Задания dead остаются для разбора. Завершенные задания нужны только
+    как ключи идемпотентности и после окончания дня доставки не используются.
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM delivery_jobs WHERE status IN ('done', 'skipped') AND updated_at < ?",
+            (before.strftime(DELIVERY_TIME_FORMAT),)
         )
-        """,
-        (user_id, text_pattern, text_pattern)
-    )
-    contacts = cur.fetchall()
-    conn.close()
-    return contacts
+        deleted = cur.rowcount
+    return deleted
 
-# --- Операции с сообщениями ---
+def get_users_by_ids(user_ids, columns=None):
+    """
+    Получает строки пользователей по списку id
 
-def add_message(user_id, direction, content, tokens=0, cost=0):
-    """Добавляет сообщение в историю"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO messages (user_id, direction, content, tokens, cost)
-        VALUES (?, ?, ?, ?, ?)
-        """,
-        (user_id, direction, content, tokens, cost)
-    )
-    conn.commit()
-    message_id = cur.lastrowid
-    conn.close()
-    return message_id
+    columns - список столбцов (например, HOROSCOPE_USER_COLUMNS), по умолчанию все
+    """
+    projection = ", ".join(columns) if columns else "*"
+    users = []
+    with db.read() as conn:
+        cur = conn.cursor()
+        # Список разбивается на части, чтобы не превысить лимит параметров SQLite
+        for offset in range(0, len(user_ids), 500):
+            chunk = user_ids[offset:offset + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            cur.execute(f"SELECT {projection} FROM users WHERE user_id IN ({placeholders})", chunk)
+            users.extend(cur.fetchall())
+    return users
 
-def get_user_messages(user_id, limit=20):
-    """Получает историю сообщений пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT * FROM messages 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC 
-        LIMIT ?
-        """,
-        (user_id, limit)
-    )
-    messages = cur.fetchall()
-    conn.close()
-    # Возвращаем в обратном порядке, чтобы самые старые были вначале
-    return list(reversed(messages))
+def get_paid_user_ids_after(after_user_id, limit=500):
+    """
+    Страница id пользователей с подпиской, следующих за after_user_id
 
-# --- Операции с гороскопами ---
+    Постраничный обход по первичному ключу не зависит от изменений уже
+    пройденных строк и продолжается с сохраненного курсора.
+    """
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT user_id FROM users
+            WHERE user_id > ? AND subscription_type != 'free'
+            ORDER BY user_id
+            LIMIT ?
+            """,
+            (after_user_id or "", limit)
+        )
+        user_ids = [row["user_id"] for row in cur.fetchall()]
+    return user_ids
 
-def add_horoscope(user_id, horoscope_text, horoscope_type='daily'):
-    """Сохраняет гороскоп в базу данных"""
-    conn = get_connection()
-    cur = conn.cursor()
+def _set_scheduler_state(cur, name, value):
     cur.execute(
         """
-        INSERT INTO horoscopes (user_id, horoscope_text, horoscope_type)
-        VALUES (?, ?, ?)
+        INSERT INTO scheduler_state (name, value, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at
         """,
-        (user_id, horoscope_text, horoscope_type)
+        (name, value)
     )
-    conn.commit()
-    horoscope_id = cur.lastrowid
-    conn.close()
-    return horoscope_id
 
-def get_last_horoscope(user_id, horoscope_type='daily'):
-    """Получает последний гороскоп пользователя указанного типа"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT * FROM horoscopes 
-        WHERE user_id = ? AND horoscope_type = ? 
-        ORDER BY created_at DESC 
-        LIMIT 1
-        """,
-        (user_id, horoscope_type)
-    )
-    horoscope = cur.fetchone()
-    conn.close()
-    return horoscope
+def get_scheduler_state(name):
+    """Получает сохраненное значение состояния планировщика или None"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM scheduler_state WHERE name = ?", (name,))
+        row = cur.fetchone()
+    return row["value"] if row else None
+
+def set_scheduler_state(name, value):
+    """Сохраняет значение состояния планировщика"""
+    with db.write() as conn:
+        _set_scheduler_state(conn.cursor(), name, value)
 
 # --- Операции с подписками ---
 
-def add_subscription_transaction(user_id, subscription_type, amount, status, payment_method, months=1):
-    """Сохраняет транзакцию подписки"""
+def add_subscription_transaction(user_id, subscription_type, amount, status, payment_method, months=1,
+                                 payload=None, telegram_payment_charge_id=None):
+    """
+    Сохраняет транзакцию подписки
+
+    Транзакция со статусом completed активирует подписку в той же
+    транзакции базы. Если оплата с тем же telegram_payment_charge_id (или
+    счет с тем же payload) уже сохранена, ничего не меняется.
+
+    Returns:
+        int: ID транзакции или None для повторной оплаты
+    """
     start_date = datetime.now().isoformat()
     end_date = (datetime.now() + timedelta(days=30*months)).isoformat()
     
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO subscription_transactions 
-        (user_id, subscription_type, amount, status, payment_method, start_date, end_date)
-        VALUES (?, ?, ?, ?, ?, ?, ?)
-        """,
-        (user_id, subscription_type, amount, status, payment_method, start_date, end_date)
-    )
-    conn.commit()
-    transaction_id = cur.lastrowid
-    conn.close()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO subscription_transactions 
+            (user_id, subscription_type, amount, status, payment_method, start_date, end_date,
+             payload, telegram_payment_charge_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (user_id, subscription_type, amount, status, payment_method, start_date, end_date,
+             payload, telegram_payment_charge_id)
+        )
+        if cur.rowcount == 0:
+            return None
+        transaction_id = cur.lastrowid
     
-    if status == 'completed':
-        update_user_subscription(user_id, subscription_type, months)
+        if status == 'completed':
+            update_user_subscription(user_id, subscription_type, months)
     
     return transaction_id
 
 def get_user_transactions(user_id):
     """Получает историю транзакций пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT * FROM subscription_transactions 
-        WHERE user_id = ? 
-        ORDER BY created_at DESC
-        """,
-        (user_id,)
-    )
-    transactions = cur.fetchall()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT * FROM subscription_transactions 
+            WHERE user_id = ? 
+            ORDER BY created_at DESC
+            """,
+            (user_id,)
+        )
+        transactions = cur.fetchall()
     return transactions
 
+# --- Кэш интерпретаций ---
+
+def get_cached_interpretation(cache_key, ttl_days):
+    """
+    Возвращает запись кэша (interpretation, created_at в UTC), если она не старше ttl_days,
+    и отмечает обращение к ней
+    """
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT interpretation, created_at FROM interpretation_cache
+            WHERE cache_key = ? AND created_at > datetime('now', ?)
+            """,
+            (cache_key, f"-{ttl_days} days")
+        )
+        row = cur.fetchone()
+    
+    # Промахи не требуют записи, поэтому блокировка записи берется только при попадании
+    if row:
+        with db.write() as conn:
+            conn.execute(
+                "UPDATE interpretation_cache SET last_access = CURRENT_TIMESTAMP, hits = hits + 1 WHERE cache_key = ?",
+                (cache_key,)
+            )
+    return row
+
+def save_cached_interpretation(cache_key, interpretation, ttl_days, max_rows):
+    """
+    Сохраняет интерпретацию в кэш
+    
+    Заодно удаляет устаревшие записи и, если записей больше max_rows,
+    давно не запрашивавшиеся.
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO interpretation_cache (cache_key, interpretation)
+            VALUES (?, ?)
+            ON CONFLICT(cache_key) DO UPDATE SET
+                interpretation = excluded.interpretation,
+                created_at = CURRENT_TIMESTAMP,
+                last_access = CURRENT_TIMESTAMP
+            """,
+            (cache_key, interpretation)
+        )
+        cur.execute(
+            "DELETE FROM interpretation_cache WHERE created_at <= datetime('now', ?)",
+            (f"-{ttl_days} days",)
+        )
+        cur.execute(
+            """
+            DELETE FROM interpretation_cache WHERE cache_key IN (
+                SELECT cache_key FROM interpretation_cache
+                ORDER BY last_access DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            (max_rows,)
+        )
+
+def get_interpretation_cache_size():
+    """Возвращает количество интерпретаций в кэше"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT COUNT(*) as count FROM interpretation_cache")
+        count = cur.fetchone()["count"]
+    return count
+
 # --- Операции для административной панели ---
 
 def get_admin_by_username(username):
     """Получает администратора по имени пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM admins WHERE username = ?", (username,))
-    admin = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM admins WHERE username = ?", (username,))
+        admin = cur.fetchone()
     return admin
 
 def add_compatibility_analysis(user_id, contact_id, analysis_text):
     """Сохраняет анализ совместимости"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO compatibility_analyses 
-        (user_id, contact_id, analysis_text)
-        VALUES (?, ?, ?)
-        """,
-        (user_id, contact_id, analysis_text)
-    )
-    conn.commit()
-    analysis_id = cur.lastrowid
-    conn.close()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO compatibility_analyses 
+            (user_id, contact_id, analysis_text)
+            VALUES (?, ?, ?)
+            """,
+            (user_id, contact_id, analysis_text)
+        )
+        analysis_id = cur.lastrowid
     return analysis_id
 
 def get_user_compatibility_analyses(user_id):
     """Получает анализы совместимости пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT ca.*, c.person_name, c.relationship
-        FROM compatibility_analyses ca
-        JOIN contacts c ON ca.contact_id = c.contact_id
-        WHERE ca.user_id = ?
-        ORDER BY ca.created_at DESC
-        """,
-        (user_id,)
-    )
-    analyses = cur.fetchall()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT ca.*, c.person_name, c.relationship
+            FROM compatibility_analyses ca
+            JOIN contacts c ON ca.contact_id = c.contact_id
+            WHERE ca.user_id = ?
+            ORDER BY ca.created_at DESC
+            """,
+            (user_id,)
+        )
+        analyses = cur.fetchall()
     return analyses
 
-def get_total_stats():
-    """Получает общую статистику для админ-панели"""
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    stats = {}
-    
-    # Общее число пользователей
-    cur.execute("SELECT COUNT(*) as count FROM users")
-    stats['total_users'] = cur.fetchone()['count']
-    
-    # Число активных пользователей (активность за последние 7 дней)
+def _count_active_users(cur):
+    """Число пользователей, активных за последние 7 дней (диапазон по idx_users_activity)"""
     seven_days_ago = (datetime.now() - timedelta(days=7)).isoformat()
     cur.execute(
         "SELECT COUNT(*) as count FROM users WHERE last_activity > ?",
         (seven_days_ago,)
     )
-    stats['active_users'] = cur.fetchone()['count']
-    
-    # Число пользователей с платной подпиской
-    cur.execute(
-        "SELECT COUNT(*) as count FROM users WHERE subscription_type != 'free'"
-    )
-    stats['paid_users'] = cur.fetchone()['count']
-    
-    # Общая сумма затрат на OpenAI API
-    cur.execute("SELECT SUM(total_cost) as total FROM users")
-    stats['total_api_cost'] = cur.fetchone()['total'] or 0
-    
-    # Общее количество сообщений
-    cur.execute("SELECT COUNT(*) as count FROM messages")
-    stats['total_messages'] = cur.fetchone()['count']
-    
-    # Общее количество расчетов совместимости
-    cur.execute("SELECT COUNT(*) as count FROM compatibility_analyses")
-    stats['total_compatibility_analyses'] = cur.fetchone()['count']
+    return cur.fetchone()['count']
+
+def get_total_stats():
+    """
+    Получает общую статистику для админ-панели
+
+    Итоги читаются из stats_counters, которые ведут триггеры, поэтому время
+    не зависит от размера таблиц messages, horoscopes и compatibility_analyses.
+    """
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT name, value FROM stats_counters")
+        counters = {row["name"]: row["value"] for row in cur.fetchall()}
     
-    # Общее количество гороскопов
-    cur.execute("SELECT COUNT(*) as count FROM horoscopes")
-    stats['total_horoscopes'] = cur.fetchone()['count']
+        stats = {
+            'total_users': int(counters.get('users', 0)),
+            'active_users': _count_active_users(cur),
+            'paid_users': int(counters.get('paid_users', 0)),
+            'total_api_cost': counters.get('api_cost', 0),
+            'total_messages': int(counters.get('messages', 0)),
+            'total_compatibility_analyses': int(counters.get('compatibility_analyses', 0)),
+            'total_horoscopes': int(counters.get('horoscopes', 0))
+        }
     
-    conn.close()
     return stats
 
+def reconcile_stats_counters():
+    """
+    Сверяет счетчики статистики с таблицами и исправляет расхождения
+
+    Расхождения возможны после изменений в обход триггеров (ручное
+    редактирование базы, восстановление из копии). Пересчет выполняется
+    полными запросами, поэтому вызывается редко, в часы низкой нагрузки.
+
+    Returns:
+        dict: Исправленные счетчики: имя -> (было, стало)
+    """
+    drift = {}
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT name, value FROM stats_counters")
+        stored = {row["name"]: row["value"] for row in cur.fetchall()}
+        for name, query in STATS_COUNTER_QUERIES.items():
+            cur.execute(query)
+            actual = list(cur.fetchone().values())[0] or 0
+            if abs(stored.get(name, 0) - actual) > 1e-6:
+                drift[name] = (stored.get(name), actual)
+            cur.execute(
+                """
+                INSERT INTO stats_counters (name, value, reconciled_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(name) DO UPDATE SET value = excluded.value, reconciled_at = excluded.reconciled_at
+                """,
+                (name, actual)
+            )
+    return drift
+
+def rollup_daily_stats(day):
+    """Сохраняет снимок счетчиков и числа активных пользователей за день day (YYYY-MM-DD)"""
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT OR REPLACE INTO stats_daily (day, name, value) SELECT ?, name, value FROM stats_counters",
+            (day,)
+        )
+        cur.execute(
+            "INSERT OR REPLACE INTO stats_daily (day, name, value) VALUES (?, 'active_users', ?)",
+            (day, _count_active_users(cur))
+        )
+
+def get_daily_stats(name, days=30):
+    """Значения счетчика name по дням за последние days снимков"""
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT day, value FROM stats_daily WHERE name = ? ORDER BY day DESC LIMIT ?",
+            (name, days)
+        )
+        rows = cur.fetchall()
+    return list(reversed(rows))
+
 # --- Новые функции для обработки платежей ---
 
 def check_user_has_active_payment(user_id):
     """Проверяет, есть ли у пользователя активный платеж"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT * FROM subscription_transactions 
-        WHERE user_id = ? AND status = 'pending'
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (user_id,)
-    )
-    transaction = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT * FROM subscription_transactions 
+            WHERE user_id = ? AND status = 'pending'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (user_id,)
+        )
+        transaction = cur.fetchone()
     return transaction is not None
 
 def get_pending_transaction(user_id):
     """Получает активный платеж пользователя со статусом 'pending'"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        SELECT * FROM subscription_transactions 
-        WHERE user_id = ? AND status = 'pending'
-        ORDER BY created_at DESC
-        LIMIT 1
-        """,
-        (user_id,)
-    )
-    transaction = cur.fetchone()
-    conn.close()
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT * FROM subscription_transactions 
+            WHERE user_id = ? AND status = 'pending'
+            ORDER BY created_at DESC
+            LIMIT 1
+            """,
+            (user_id,)
+        )
+        transaction = cur.fetchone()
     return transaction
 
 def cancel_pending_transactions(user_id):
     """Отменяет все незавершенные транзакции пользователя"""
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE subscription_transactions
-        SET status = 'cancelled'
-        WHERE user_id = ? AND status = 'pending'
-        """,
-        (user_id,)
-    )
-    cancelled = cur.rowcount
-    conn.commit()
-    conn.close()
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            UPDATE subscription_transactions
+            SET status = 'cancelled'
+            WHERE user_id = ? AND status = 'pending'
+            """,
+            (user_id,)
+        )
+        cancelled = cur.rowcount
     return cancelled
 
 def update_transaction_status(transaction_id, status, additional_data=None):
-    """Обновляет статус транзакции и опционально дополнительные данные"""
-    conn = get_connection()
-    cur = conn.cursor()
-    
-    # Базовый запрос на обновление статуса
-    query = """
-    UPDATE subscription_transactions
-    SET status = ?
-    WHERE transaction_id = ?
     """
-    params = (status, transaction_id)
+    Обновляет статус транзакции и опционально дополнительные данные
+
+    Значения invoice_id и telegram_payment_charge_id из additional_data
+    сохраняются также в индексированные столбцы payload и
+    telegram_payment_charge_id и не стираются последующими обновлениями.
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
     
-    # Если есть дополнительные данные, сохраняем их в виде JSON
-    if additional_data:
-        import json
-        json_data = json.dumps(additional_data)
+        # Базовый запрос на обновление статуса
         query = """
         UPDATE subscription_transactions
-        SET status = ?, additional_data = ?
+        SET status = ?
         WHERE transaction_id = ?
         """
-        params = (status, json_data, transaction_id)
+        params = (status, transaction_id)
+    
+        # Если есть дополнительные данные, сохраняем их в виде JSON
+        if additional_data:
+            import json
+            json_data = json.dumps(additional_data)
+            query = """
+            UPDATE subscription_transactions
+            SET status = ?, additional_data = ?,
+                payload = COALESCE(?, payload),
+                telegram_payment_charge_id = COALESCE(?, telegram_payment_charge_id)
+            WHERE transaction_id = ?
+            """
+            params = (
+                status,
+                json_data,
+                additional_data.get("invoice_id"),
+                additional_data.get("telegram_payment_charge_id"),
+                transaction_id
+            )
     
-    cur.execute(query, params)
-    updated = cur.rowcount > 0
-    conn.commit()
-    conn.close()
+        cur.execute(query, params)
+        updated = cur.rowcount > 0
     return updated
 
 def get_transaction_by_payload(payload):
     """Находит транзакцию по payload платежа"""
-    conn = get_connection()
-    cur = conn.cursor()
-    # Ищем в дополнительных данных или в других полях
-    try:
-        cur.execute(
-            """
-            SELECT * FROM subscription_transactions 
-            WHERE additional_data LIKE ? 
-            ORDER BY created_at DESC 
-            LIMIT 1
-            """,
-            (f'%"invoice_id":"{payload}"%',)
-        )
+    with db.read() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM subscription_transactions WHERE payload = ?", (payload,))
         transaction = cur.fetchone()
-        
+    
         if not transaction:
             # Пробуем найти по transaction_id если payload является числом
             try:
                 transaction_id = int(payload)
+            except (ValueError, TypeError):
+                transaction_id = None
+            if transaction_id is not None:
                 cur.execute(
-                    """
-                    SELECT * FROM subscription_transactions 
-                    WHERE transaction_id = ?
-                    """,
+                    "SELECT * FROM subscription_transactions WHERE transaction_id = ?",
                     (transaction_id,)
                 )
                 transaction = cur.fetchone()
-            except (ValueError, TypeError):
-                pass
-            
-    except Exception as e:
-        print(f"Ошибка при поиске транзакции: {e}")
-        transaction = None
         
-    conn.close()
-    return transaction
\ No newline at end of file
+    return transaction
+
+def _parse_subscription_payload(payload):
+    """
+    Разбирает payload счета подписки вида sub_<план>_<transaction_id>
+
+    План сам содержит подчеркивание (1_month), поэтому ID отделяется справа.
+
+    Returns:
+        tuple: (план, transaction_id) или None
+    """
+    if not payload or not payload.startswith("sub_"):
+        return None
+    plan, _, transaction_id = payload[len("sub_"):].rpartition("_")
+    if not plan or not transaction_id.isdigit():
+        return None
+    return plan, int(transaction_id)
+
+def complete_subscription_payment(payload, telegram_payment_charge_id):
+    """
+    Отмечает транзакцию счета payload оплаченной и активирует подписку
+
+    Выполняется в одной транзакции базы. Оплата с уже сохраненным
+    telegram_payment_charge_id (повторная доставка successful_payment)
+    подписку повторно не продлевает.
+
+    Returns:
+        dict: transaction - строка транзакции, duplicate - оплата уже была обработана;
+            None, если транзакция счета не найдена
+    """
+    with db.write() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT * FROM subscription_transactions WHERE telegram_payment_charge_id = ?",
+            (telegram_payment_charge_id,)
+        )
+        transaction = cur.fetchone()
+        if transaction:
+            return {"transaction": transaction, "duplicate": True}
+        
+        cur.execute("SELECT * FROM subscription_transactions WHERE payload = ?", (payload,))
+        transaction = cur.fetchone()
+        if not transaction:
+            # Счета, выставленные до сохранения payload в транзакцию
+            parsed = _parse_subscription_payload(payload)
+            if parsed:
+                cur.execute(
+                    "SELECT * FROM subscription_transactions WHERE transaction_id = ? AND subscription_type = ?",
+                    (parsed[1], parsed[0])
+                )
+                transaction = cur.fetchone()
+        if not transaction:
+            return None
+        if transaction["status"] == "completed":
+            return {"transaction": transaction, "duplicate": True}
+        
+        cur.execute(
+            """
+            UPDATE subscription_transactions
+            SET status = 'completed', telegram_payment_charge_id = ?, payload = COALESCE(payload, ?)
+            WHERE transaction_id = ?
+            RETURNING *
+            """,
+            (telegram_payment_charge_id, payload, transaction["transaction_id"])
+        )
+        transaction = cur.fetchone()
+        
+        # Срок подписки хранится в транзакции: 30 дней на месяц
+        days = (datetime.fromisoformat(transaction["end_date"]) - datetime.fromisoformat(transaction["start_date"])).days
+        update_user_subscription(transaction["user_id"], transaction["subscription_type"], max(1, round(days / 30)))
+    return {"transaction": transaction, "duplicate": False}
@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+
+from config import USER_CACHE_TTL_SECONDS, USER_CACHE_SIZE
+
+class UserCache:
+    """
+    Кэш строк таблицы users.
+
+    get_user читает из кэша, а функции operations, изменяющие users,
+    записывают в него строку, полученную через RETURNING (write-through),
+    поэтому кэш не отстает от изменений внутри процесса. TTL ограничивает
+    устаревание при изменениях из других процессов. Отдаются копии строк,
+    чтобы изменения в обработчиках не попадали в кэш.
+    """
+
+    def __init__(self, ttl_seconds=USER_CACHE_TTL_SECONDS, max_size=USER_CACHE_SIZE):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self._entries = OrderedDict()  # user_id -> (время записи, строка)
+        self._lock = threading.Lock()
+        self._writes = 0  # Счетчик записей, защищает от сохранения устаревшей строки
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """Возвращает копию строки пользователя или None"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                stored_at, user = entry
+                if time.monotonic() - stored_at < self.ttl_seconds:
+                    self._entries.move_to_end(user_id)
+                    self.hits += 1
+                    return dict(user)
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def read_token(self):
+        """Возвращает отметку, которую нужно передать в fill после чтения строки из базы"""
+        with self._lock:
+            return self._writes
+
+    def fill(self, user, token):
+        """
+        Сохраняет строку, прочитанную из базы
+
+        Если после получения token строки изменялись, прочитанное значение
+        могло устареть и не сохраняется.
+        """
+        if not user:
+            return
+        with self._lock:
+            if token == self._writes:
+                self._store(user)
+
+    def put(self, user):
+        """Сохраняет актуальную строку пользователя после её изменения"""
+        if not user:
+            return
+        with self._lock:
+            self._writes += 1
+            self._store(user)
+
+    def _store(self, user):
+        self._entries[user["user_id"]] = (time.monotonic(), dict(user))
+        self._entries.move_to_end(user["user_id"])
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """Удаляет пользователя из кэша (или весь кэш, если user_id не указан)"""
+        with self._lock:
+            self._writes += 1
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def get_stats(self):
+        """Возвращает статистику попаданий в кэш"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0,
+                "size": len(self._entries),
+                "max_size": self.max_size
+            }
+
+# Общий кэш пользователей для импорта
+user_cache = UserCache()
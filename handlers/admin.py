@@ -5,12 +5,104 @@ from aiogram.fsm.context import FSMContext
 import logging
 
 from states.user_states import AdminStates
-from utils.keyboards import get_main_menu, get_admin_menu, get_admin_user_actions
-from database import operations
-from config import ADMIN_USERNAME, ADMIN_PASSWORD
+from utils.keyboards import get_main_menu, get_admin_menu, get_admin_user_actions, get_admin_users_pagination
+from database import async_operations
+from database.async_operations import async_db
+from services.interpretation_cache import interpretation_cache
+from middleware.rate_limit import telegram_rate_limiter
+from config import ADMIN_USERNAME, ADMIN_PASSWORD, ADMIN_USERS_PAGE_SIZE, SUBSCRIPTION_PRICES
 
 logger = logging.getLogger(__name__)
 
+# Названия планов для экрана финансов
+PLAN_NAMES = {
+    "1_week": "1 неделя",
+    "1_month": "1 месяц",
+    "3_month": "3 месяца",
+    "1_year": "1 год"
+}
+
+async def build_stats_message():
+    """Формирует текст статистики бота (после входа и по кнопке «📊 Статистика»)"""
+    stats = await async_operations.get_total_stats()
+    cache_stats = interpretation_cache.get_stats()
+    db_stats = async_db.get_stats()
+    send_stats = telegram_rate_limiter.get_stats()
+    delivery_histogram = await async_operations.get_horoscope_delivery_histogram()
+    job_stats = await async_operations.get_delivery_job_stats()
+    delivery_peak = (
+        f"{delivery_histogram[0]['delivery_minute_utc'] // 60:02d}:{delivery_histogram[0]['delivery_minute_utc'] % 60:02d} UTC "
+        f"({delivery_histogram[0]['users']} польз.)" if delivery_histogram else "нет"
+    )
+    
+    return (
+        "📊 Статистика бота:\n\n"
+        f"👥 Пользователей: {stats['total_users']}\n"
+        f"👤 Активных за 7 дней: {stats['active_users']}\n"
+        f"💎 С подпиской: {stats['paid_users']}\n"
+        f"💬 Сообщений: {stats['total_messages']}\n"
+        f"💞 Проверок совместимости: {stats['total_compatibility_analyses']}\n"
+        f"🔮 Гороскопов: {stats['total_horoscopes']}\n"
+        f"💰 Расходы на API: ${stats['total_api_cost']:.2f}\n"
+        f"🧠 Кэш интерпретаций: {cache_stats['hit_rate']:.0%} попаданий "
+        f"({cache_stats['memory_hits'] + cache_stats['db_hits']} из "
+        f"{cache_stats['memory_hits'] + cache_stats['db_hits'] + cache_stats['misses']}), "
+        f"записей: {await async_operations.get_interpretation_cache_size()}\n"
+        f"🗄 База данных: очередь {db_stats['queue_depth']} (макс. {db_stats['max_queue_depth']}), "
+        f"среднее время запроса {db_stats['avg_time'] * 1000:.1f} мс\n"
+        f"📨 Telegram: отправлено {send_stats['sent']}, в очереди {send_stats['waiting']}, "
+        f"повторов после 429: {send_stats['retries']}, ожидание ответов "
+        f"{send_stats['priorities']['interactive']['avg_wait'] * 1000:.0f} мс, рассылок "
+        f"{send_stats['priorities']['bulk']['avg_wait'] * 1000:.0f} мс\n"
+        f"⏰ Доставка гороскопов: {sum(row['users'] for row in delivery_histogram)} польз., "
+        f"пик {delivery_peak}\n"
+        f"📬 Очередь доставок: ожидают {job_stats.get('pending', 0) + job_stats.get('running', 0)}, "
+        f"не доставлено {job_stats.get('dead', 0)}"
+    )
+
+async def show_users_page(state: FSMContext, after=None, before=None):
+    """
+    Загружает страницу списка пользователей и запоминает ее в состоянии
+
+    Ключи первой и последней строки страницы нужны для перехода на соседние
+    страницы, ID пользователей - для выбора пользователя по номеру.
+
+    Returns:
+        tuple: Текст страницы и инлайн клавиатура навигации (None, если пользователей нет)
+    """
+    page = await async_operations.get_users_page(after, before, ADMIN_USERS_PAGE_SIZE)
+    users = page["users"]
+    if not users:
+        return None, None
+    
+    await state.update_data(
+        admin_user_ids=[user["user_id"] for user in users],
+        admin_users_first=[users[0]["last_activity"], users[0]["user_id"]],
+        admin_users_last=[users[-1]["last_activity"], users[-1]["user_id"]]
+    )
+    
+    users_text = format_users_list("👥 Список пользователей", users)
+    return users_text, get_admin_users_pagination(page["has_prev"], page["has_next"])
+
+def format_users_list(title, users):
+    """Форматирует нумерованный список пользователей для выбора по номеру"""
+    users_text = f"{title}:\n\n"
+    
+    for i, user in enumerate(users, 1):
+        username = user.get("username", "")
+        first_name = user.get("first_name", "")
+        last_name = user.get("last_name", "")
+        subscription_type = user.get("subscription_type", "free")
+        
+        user_name = username or f"{first_name} {last_name}"
+        subscription_emoji = "💎" if subscription_type != "free" else "🆓"
+        
+        users_text += f"{i}. {subscription_emoji} {user_name} (ID: {user['user_id']})\n"
+    
+    users_text += "\nВыберите пользователя, указав его номер, ID или имя:"
+    
+    return users_text
+
 async def admin_command(message: types.Message, state: FSMContext):
     """Обработчик команды /admin для входа в административную панель"""
     await message.answer(
@@ -67,19 +159,7 @@ async def process_admin_password(message: types.Message, state: FSMContext):
         )
         await state.set_state(AdminStates.admin_active)
         
-        # Получаем общую статистику
-        stats = operations.get_total_stats()
-        
-        stats_message = (
-            "📊 Статистика бота:\n\n"
-            f"👥 Пользователей: {stats['total_users']}\n"
-            f"👤 Активных за 7 дней: {stats['active_users']}\n"
-            f"💎 С подпиской: {stats['paid_users']}\n"
-            f"💬 Сообщений: {stats['total_messages']}\n"
-            f"💞 Проверок совместимости: {stats['total_compatibility_analyses']}\n"
-            f"🔮 Гороскопов: {stats['total_horoscopes']}\n"
-            f"💰 Расходы на API: ${stats['total_api_cost']:.2f}"
-        )
+        stats_message = await build_stats_message()
         
         await message.answer(stats_message, reply_markup=get_admin_menu())
     else:
@@ -99,75 +179,46 @@ async def admin_menu_handler(message: types.Message, state: FSMContext):
         return
     
     if message.text == "👥 Пользователи":
-        # Получаем список пользователей
-        users = operations.get_all_users()
+        # Первая страница списка пользователей
+        users_text, pagination = await show_users_page(state)
         
-        if not users:
+        if not users_text:
             await message.answer("Пользователи не найдены.", reply_markup=get_admin_menu())
             return
         
-        # Формируем список пользователей
-        users_text = "👥 Список пользователей:\n\n"
-        
-        for i, user in enumerate(users[:20], 1):  # Показываем только первые 20 пользователей
-            username = user.get("username", "")
-            first_name = user.get("first_name", "")
-            last_name = user.get("last_name", "")
-            subscription_type = user.get("subscription_type", "free")
-            messages_count = user.get("input_tokens", 0) + user.get("output_tokens", 0)
-            
-            user_name = username or f"{first_name} {last_name}"
-            subscription_emoji = "💎" if subscription_type != "free" else "🆓"
-            
-            users_text += f"{i}. {subscription_emoji} {user_name} (ID: {user['user_id']})\n"
-        
-        users_text += "\nВыберите пользователя, указав его номер или ID:"
-        
-        await message.answer(users_text, reply_markup=get_admin_menu())
+        await message.answer(users_text, reply_markup=pagination)
         await state.set_state(AdminStates.selecting_user)
     
     elif message.text == "📊 Статистика":
-        # Получаем общую статистику
-        stats = operations.get_total_stats()
-        
-        stats_message = (
-            "📊 Статистика бота:\n\n"
-            f"👥 Пользователей: {stats['total_users']}\n"
-            f"👤 Активных за 7 дней: {stats['active_users']}\n"
-            f"💎 С подпиской: {stats['paid_users']}\n"
-            f"💬 Сообщений: {stats['total_messages']}\n"
-            f"💞 Проверок совместимости: {stats['total_compatibility_analyses']}\n"
-            f"🔮 Гороскопов: {stats['total_horoscopes']}\n"
-            f"💰 Расходы на API: ${stats['total_api_cost']:.2f}"
-        )
+        stats_message = await build_stats_message()
         
         await message.answer(stats_message, reply_markup=get_admin_menu())
     
     elif message.text == "💰 Финансы":
         # Получаем финансовую статистику
-        stats = operations.get_total_stats()
+        stats = await async_operations.get_total_stats()
         
-        # Получаем список активных подписок
-        users = operations.get_all_users()
-        subscription_counts = {"1_month": 0, "3_month": 0, "1_year": 0}
+        # Получаем число активных подписок по типам
+        subscription_counts = await async_operations.get_subscription_counts()
         
-        for user in users:
-            if user.get("subscription_type") != "free":
-                subscription_counts[user.get("subscription_type", "1_month")] += 1
+        # Планы без цены (например, выданные вручную) в доход не входят
+        plans = list(SUBSCRIPTION_PRICES) + sorted(set(subscription_counts) - set(SUBSCRIPTION_PRICES))
+        plans_text = ""
+        revenue = 0
         
-        # Рассчитываем приблизительный доход
-        revenue = (
-            subscription_counts["1_month"] * 4.99 +
-            subscription_counts["3_month"] * 9.99 +
-            subscription_counts["1_year"] * 29.99
-        )
+        for plan in plans:
+            count = subscription_counts.get(plan, 0)
+            price = SUBSCRIPTION_PRICES.get(plan)
+            if price is None:
+                plans_text += f"  - {PLAN_NAMES.get(plan, plan)}: {count}\n"
+                continue
+            revenue += count * price
+            plans_text += f"  - {PLAN_NAMES.get(plan, plan)} (${price:.2f}): {count}\n"
         
         finance_message = (
             "💰 Финансовая статистика:\n\n"
             f"💎 Активных подписок: {stats['paid_users']}\n"
-            f"  - 1 месяц ($4.99): {subscription_counts['1_month']}\n"
-            f"  - 3 месяца ($9.99): {subscription_counts['3_month']}\n"
-            f"  - 1 год ($29.99): {subscription_counts['1_year']}\n\n"
+            f"{plans_text}\n"
             f"💵 Приблизительный доход: ${revenue:.2f}\n"
             f"💸 Расходы на API: ${stats['total_api_cost']:.2f}\n\n"
             f"📈 Прибыль: ${revenue - stats['total_api_cost']:.2f}"
@@ -201,19 +252,29 @@ async def select_user_handler(message: types.Message, state: FSMContext):
     # Пытаемся определить ID пользователя
     user_id = None
     
-    # Если введен номер пользователя из списка
-    if message.text.isdigit():
-        index = int(message.text) - 1
-        users = operations.get_all_users()
-        
-        if 0 <= index < len(users):
-            user_id = users[index]["user_id"]
+    # Если введен номер пользователя из показанной страницы списка
+    data = await state.get_data()
+    page_user_ids = data.get("admin_user_ids", [])
+    
+    if message.text.isdigit() and 0 < int(message.text) <= len(page_user_ids):
+        user_id = page_user_ids[int(message.text) - 1]
     else:
         # Если введен ID пользователя напрямую
         user_id = message.text.strip()
     
     if user_id:
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
+        
+        if not user:
+            # Не ID - ищем по username, имени и фамилии
+            found = await async_operations.search_users(user_id, ADMIN_USERS_PAGE_SIZE)
+            if len(found) == 1:
+                user_id = found[0]["user_id"]
+                user = await async_operations.get_user(user_id)
+            elif found:
+                await state.update_data(admin_user_ids=[user["user_id"] for user in found])
+                await message.answer(format_users_list("🔎 Найденные пользователи", found))
+                return
         
         if user:
             # Сохраняем ID пользователя в состоянии
@@ -239,13 +300,32 @@ async def select_user_handler(message: types.Message, state: FSMContext):
             reply_markup=get_admin_menu()
         )
 
+async def users_page_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Обработчик перехода по страницам списка пользователей"""
+    data = await state.get_data()
+    
+    if callback.data == "admin_users:next" and data.get("admin_users_last"):
+        users_text, pagination = await show_users_page(state, after=data["admin_users_last"])
+    elif callback.data == "admin_users:prev" and data.get("admin_users_first"):
+        users_text, pagination = await show_users_page(state, before=data["admin_users_first"])
+    else:
+        users_text = None
+    
+    if not users_text:
+        await callback.answer("Страница недоступна, откройте список пользователей заново")
+        return
+    
+    await callback.message.edit_text(users_text, reply_markup=pagination)
+    await state.set_state(AdminStates.selecting_user)
+    await callback.answer()
+
 async def user_action_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик действий с пользователем через inline кнопки"""
     action, user_id = callback.data.split(":")
     
     if action == "admin_messages":
         # Показываем историю сообщений пользователя
-        messages = operations.get_user_messages(user_id)
+        messages = await async_operations.get_user_messages(user_id)
         
         if not messages:
             await callback.answer("У пользователя нет сообщений")
@@ -270,14 +350,14 @@ async def user_action_callback(callback: types.CallbackQuery, state: FSMContext)
     
     elif action == "admin_subscription":
         # Показываем информацию о подписке пользователя
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
         
         if not user:
             await callback.answer("Пользователь не найден")
             return
         
         # Получаем историю транзакций
-        transactions = operations.get_user_transactions(user_id)
+        transactions = await async_operations.get_user_transactions(user_id)
         
         # Форматируем информацию о подписке
         subscription_text = (
@@ -304,7 +384,7 @@ async def user_action_callback(callback: types.CallbackQuery, state: FSMContext)
     
     elif action == "admin_natal":
         # Показываем натальную карту пользователя
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
         
         if not user:
             await callback.answer("Пользователь не найден")
@@ -441,6 +521,9 @@ def register_handlers(dp: Dispatcher):
     # Обработчик выбора пользователя
     dp.message.register(select_user_handler, AdminStates.selecting_user)
     
+    # Обработчик перехода по страницам списка пользователей
+    dp.callback_query.register(users_page_callback, F.data.in_(["admin_users:prev", "admin_users:next"]))
+    
     # Обработчик действий с пользователем через inline кнопки
     dp.callback_query.register(
         user_action_callback,
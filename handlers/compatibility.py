@@ -24,8 +24,9 @@ from services.ephemeris import (
     get_aspects_between_charts,
     format_aspects
 )
+from services.natal_chart import NatalChart
 from services.openai_service import generate_compatibility_analysis
-from database import operations
+from database import async_operations
 from handlers.start import back_to_menu_handler
 
 logger = logging.getLogger(__name__)
@@ -33,7 +34,7 @@ logger = logging.getLogger(__name__)
 async def compatibility_command(message: types.Message, state: FSMContext):
     """Обработчик команды /compatibility и нажатия на кнопку совместимости"""
     user_id = str(message.from_user.id)
-    user = operations.get_user(user_id)
+    user = await async_operations.get_user(user_id)
     
     # Проверяем, есть ли у пользователя натальная карта
     if not user or not user.get("natal_chart"):
@@ -45,7 +46,7 @@ async def compatibility_command(message: types.Message, state: FSMContext):
         return
     
     # Получаем контакты пользователя
-    contacts = operations.get_contacts(user_id)
+    contacts = await async_operations.get_contacts(user_id)
     
     # Показываем меню совместимости
     await message.answer(
@@ -71,7 +72,7 @@ async def compatibility_action_handler(message: types.Message, state: FSMContext
         await state.set_state(CompatibilityStates.waiting_for_partner_name)
     
     elif message.text == "📋 Мои контакты":
-        contacts = operations.get_contacts(user_id)
+        contacts = await async_operations.get_contacts(user_id)
         
         if not contacts:
             await message.answer(
@@ -120,7 +121,7 @@ async def contact_selection_handler(message: types.Message, state: FSMContext):
         contact_name = message.text[2:].strip()
         
         user_id = str(message.from_user.id)
-        contacts = operations.get_contacts(user_id)
+        contacts = await async_operations.get_contacts(user_id)
         
         selected_contact = None
         for contact in contacts:
@@ -161,7 +162,7 @@ async def contact_action_callback(callback: types.CallbackQuery, state: FSMConte
     contact_id = int(contact_id)
     
     user_id = str(callback.from_user.id)
-    contact = operations.get_contact(contact_id)
+    contact = await async_operations.get_contact(contact_id)
     
     if not contact or contact['user_id'] != user_id:
         await callback.answer("Контакт не найден или не принадлежит вам.")
@@ -169,7 +170,7 @@ async def contact_action_callback(callback: types.CallbackQuery, state: FSMConte
     
     if action == "compatibility":
         # Получаем натальную карту пользователя
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
         
         if not user or not user.get("natal_chart"):
             await callback.answer("Сначала необходимо рассчитать вашу натальную карту.")
@@ -201,13 +202,13 @@ async def contact_action_callback(callback: types.CallbackQuery, state: FSMConte
         )
         
         # Сохраняем анализ в базу
-        operations.add_compatibility_analysis(user_id, contact_id, analysis)
+        await async_operations.add_compatibility_analysis(user_id, contact_id, analysis)
         
         # Проверяем, является ли пользователь премиум
         is_premium = user.get("subscription_type") != "free"
         
         # Получаем количество контактов
-        contacts_count = len(operations.get_contacts(user_id))
+        contacts_count = len(await async_operations.get_contacts(user_id))
         
         # Если это второй или более контакт, и пользователь на бесплатном тарифе,
         # отправляем заблюренное сообщение и предложение
@@ -264,12 +265,12 @@ async def contact_action_callback(callback: types.CallbackQuery, state: FSMConte
     
     elif action == "delete_contact":
         # Удаляем контакт
-        if operations.delete_contact(contact_id, user_id):
+        if await async_operations.delete_contact(contact_id, user_id):
             await callback.answer("Контакт успешно удалён")
             await callback.message.edit_text(f"Контакт {contact['person_name']} был удалён.")
             
             # Возвращаемся к списку контактов
-            contacts = operations.get_contacts(user_id)
+            contacts = await async_operations.get_contacts(user_id)
             
             if contacts:
                 await callback.message.answer(
@@ -308,7 +309,7 @@ async def process_partner_name(message: types.Message, state: FSMContext):
     
     # Проверяем, есть ли уже контакт с таким именем
     user_id = str(message.from_user.id)
-    contacts = operations.get_contacts(user_id)
+    contacts = await async_operations.get_contacts(user_id)
     
     existing_contact = None
     for contact in contacts:
@@ -358,12 +359,12 @@ async def process_existing_contact_action(message: types.Message, state: FSMCont
     
     if message.text == "Использовать существующие":
         # Используем существующий контакт
-        contact = operations.get_contact(existing_contact_id)
+        contact = await async_operations.get_contact(existing_contact_id)
         
         if contact:
             # Переходим к расчету совместимости
             user_id = str(message.from_user.id)
-            user = operations.get_user(user_id)
+            user = await async_operations.get_user(user_id)
             
             if not user or not user.get("natal_chart"):
                 await message.answer(
@@ -393,13 +394,13 @@ async def process_existing_contact_action(message: types.Message, state: FSMCont
             )
             
             # Сохраняем анализ в базу
-            operations.add_compatibility_analysis(user_id, existing_contact_id, analysis)
+            await async_operations.add_compatibility_analysis(user_id, existing_contact_id, analysis)
             
             # Проверяем, является ли пользователь премиум
             is_premium = user.get("subscription_type") != "free"
             
             # Получаем количество контактов
-            contacts_count = len(operations.get_contacts(user_id))
+            contacts_count = len(await async_operations.get_contacts(user_id))
             
             # Если это второй или более контакт, и пользователь на бесплатном тарифе,
             # отправляем заблюренное сообщение и предложение
@@ -502,7 +503,7 @@ async def process_partner_birth_date(message: types.Message, state: FSMContext):
         
         # Переходим к вводу времени
         contact_id = data.get('contact_id')
-        contact = operations.get_contact(contact_id)
+        contact = await async_operations.get_contact(contact_id)
         
         await message.answer(
             f"Введите время рождения {partner_name} (или оставьте текущее):",
@@ -520,7 +521,7 @@ async def process_partner_birth_date(message: types.Message, state: FSMContext):
     if message.text == "↩️ Отмена" and edit_mode:
         # Отменяем редактирование и возвращаемся к списку контактов
         user_id = str(message.from_user.id)
-        contacts = operations.get_contacts(user_id)
+        contacts = await async_operations.get_contacts(user_id)
         
         await message.answer(
             "Редактирование отменено.",
@@ -568,7 +569,7 @@ async def process_partner_birth_time(message: types.Message, state: FSMContext):
     if message.text == "↩️ Отмена" and edit_mode:
         # Отменяем редактирование и возвращаемся к списку контактов
         user_id = str(message.from_user.id)
-        contacts = operations.get_contacts(user_id)
+        contacts = await async_operations.get_contacts(user_id)
         
         await message.answer(
             "Редактирование отменено.",
@@ -587,7 +588,7 @@ async def process_partner_birth_time(message: types.Message, state: FSMContext):
         
         # Переходим к вводу города
         contact_id = data.get('contact_id')
-        contact = operations.get_contact(contact_id)
+        contact = await async_operations.get_contact(contact_id)
         
         await message.answer(
             f"Введите город рождения {partner_name} (или оставьте текущий):",
@@ -647,7 +648,7 @@ async def process_partner_birth_city(message: types.Message, state: FSMContext):
     if message.text == "↩️ Отмена" and edit_mode:
         # Отменяем редактирование и возвращаемся к списку контактов
         user_id = str(message.from_user.id)
-        contacts = operations.get_contacts(user_id)
+        contacts = await async_operations.get_contacts(user_id)
         
         await message.answer(
             "Редактирование отменено.",
@@ -666,7 +667,7 @@ async def process_partner_birth_city(message: types.Message, state: FSMContext):
         
         # Переходим к вводу отношения
         contact_id = data.get('contact_id')
-        contact = operations.get_contact(contact_id)
+        contact = await async_operations.get_contact(contact_id)
         
         await message.answer(
             f"Укажите, кем {partner_name} приходится вам (например, 'девушка', 'муж', 'друг', 'коллега' и т.д.) "
@@ -750,7 +751,7 @@ async def process_partner_relationship(message: types.Message, state: FSMContext
     if message.text == "↩️ Отмена" and edit_mode:
         # Отменяем редактирование и возвращаемся к списку контактов
         user_id = str(message.from_user.id)
-        contacts = operations.get_contacts(user_id)
+        contacts = await async_operations.get_contacts(user_id)
         
         await message.answer(
             "Редактирование отменено.",
@@ -896,10 +897,11 @@ async def proceed_with_compatibility_calculation(message: types.Message, state:
         return
     
     formatted_partner_chart = format_natal_chart(partner_planets, partner_houses)
+    partner_chart_data = NatalChart.from_positions(partner_planets, partner_houses).to_bytes()
     
     # Получаем натальную карту пользователя
     user_id = str(message.from_user.id)
-    user = operations.get_user(user_id)
+    user = await async_operations.get_user(user_id)
     
     if not user or not user.get("natal_chart"):
         await message.answer(
@@ -914,7 +916,7 @@ async def proceed_with_compatibility_calculation(message: types.Message, state:
     # Сохраняем или обновляем контакт в базе данных
     if edit_mode and contact_id:
         # Обновляем существующий контакт
-        operations.add_contact(
+        await async_operations.add_contact(
             user_id,
             partner_name,
             partner_birth_date,
@@ -924,12 +926,13 @@ async def proceed_with_compatibility_calculation(message: types.Message, state:
             partner_lon,
             partner_tz_name,
             partner_relationship,
-            formatted_partner_chart
+            formatted_partner_chart,
+            partner_chart_data
         )
         logger.info(f"Контакт {partner_name} обновлен пользователем {message.from_user.id}")
     else:
         # Добавляем новый контакт
-        contact_id = operations.add_contact(
+        contact_id = await async_operations.add_contact(
             user_id,
             partner_name,
             partner_birth_date,
@@ -939,7 +942,8 @@ async def proceed_with_compatibility_calculation(message: types.Message, state:
             partner_lon,
             partner_tz_name,
             partner_relationship,
-            formatted_partner_chart
+            formatted_partner_chart,
+            partner_chart_data
         )
         logger.info(f"Новый контакт {partner_name} добавлен пользователем {message.from_user.id}")
     
@@ -952,13 +956,13 @@ async def proceed_with_compatibility_calculation(message: types.Message, state:
     )
     
     # Сохраняем анализ в базу
-    operations.add_compatibility_analysis(user_id, contact_id, analysis)
+    await async_operations.add_compatibility_analysis(user_id, contact_id, analysis)
     
     # Проверяем, является ли пользователь премиум
     is_premium = user.get("subscription_type") != "free"
     
     # Получаем количество контактов
-    contacts_count = len(operations.get_contacts(user_id))
+    contacts_count = len(await async_operations.get_contacts(user_id))
     
     # Если это второй или более контакт, и пользователь на бесплатном тарифе,
     # отправляем заблюренное сообщение и предложение
@@ -995,7 +999,7 @@ async def unlock_compatibility_callback(callback: types.CallbackQuery, state: FS
     contact_id = int(contact_id)
     
     user_id = str(callback.from_user.id)
-    contact = operations.get_contact(contact_id)
+    contact = await async_operations.get_contact(contact_id)
     
     if not contact or contact['user_id'] != user_id:
         await callback.answer("Контакт не найден или не принадлежит вам.")
@@ -7,18 +7,20 @@ import logging
 from states.user_states import NatalChartStates
 from utils.keyboards import get_main_menu
 from services.openai_service import process_user_dialog
-from database import operations
+from utils.telegram_stream import TelegramStreamWriter
+from database import async_operations
 from config import MAX_MESSAGES
 
 logger = logging.getLogger(__name__)
 
-async def user_dialog_handler(message: types.Message, state: FSMContext):
+async def user_dialog_handler(message: types.Message, state: FSMContext, db_user=None):
     """Обработчик диалога пользователя с ботом в контексте натальной карты"""
     user_id = str(message.from_user.id)
-    user = operations.get_user(user_id)
+    # Снимок пользователя загружен SubscriptionMiddleware
+    user = db_user or await async_operations.get_user(user_id)
     
     # Проверяем, может ли пользователь отправлять сообщения
-    can_message = operations.check_user_can_message(user_id)
+    can_message = await async_operations.check_user_can_message(user_id, user)
     if not can_message:
         # Пользователь исчерпал бесплатный лимит
         subscription_type = user.get("subscription_type", "free")
@@ -63,7 +65,7 @@ async def user_dialog_handler(message: types.Message, state: FSMContext):
     history = await get_or_create_message_history(state)
     
     # Получаем контакты пользователя
-    contacts = operations.get_contacts(user_id)
+    contacts = await async_operations.get_contacts(user_id)
     
     # Получаем натальную карту пользователя
     natal_chart = user.get("natal_chart", "")
@@ -71,13 +73,15 @@ async def user_dialog_handler(message: types.Message, state: FSMContext):
     # Отправляем индикатор набора текста
     await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
     
-    # Обрабатываем сообщение пользователя
+    # Обрабатываем сообщение пользователя, выводя ответ по мере генерации
+    stream_writer = TelegramStreamWriter(message.bot, message.chat.id)
     result = await process_user_dialog(
         user_id,
         message.text,
         natal_chart,
         contacts,
-        history
+        history,
+        stream_writer=stream_writer
     )
     
     # Обновляем историю сообщений
@@ -85,17 +89,10 @@ async def user_dialog_handler(message: types.Message, state: FSMContext):
     history.append({"role": "assistant", "content": result["reply"]})
     await state.update_data(message_history=list(history))
     
-    # Формируем ответное сообщение
-    reply_text = result["reply"]
-    
     # Добавляем информацию об упомянутых контактах, если они есть
     if result["mentioned_contacts"]:
         contacts_info = ", ".join(result["mentioned_contacts"])
-        mention_note = f"\n\n_Учтены данные: {contacts_info}_"
-        reply_text += mention_note
-    
-    # Отправляем ответ пользователю
-    await message.answer(reply_text, reply_markup=get_main_menu())
+        await message.answer(f"_Учтены данные: {contacts_info}_", reply_markup=get_main_menu())
     
     # Если у пользователя бесплатный план, показываем оставшийся лимит
     if user.get("subscription_type") == "free":
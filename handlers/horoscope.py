@@ -13,15 +13,12 @@ from utils.keyboards import (
     get_horoscope_time_keyboard,
     get_back_button
 )
-from utils.date_parser import parse_time_input
-from services.geo import get_location_info, parse_coordinates
-from services.ephemeris import (
-    calculate_planet_positions_utc,
-    calculate_houses_utc,
-    format_natal_chart
-)
+from utils.date_parser import parse_time_input, utc_to_local
+from services.geo import get_location_info, get_timezone_name, parse_coordinates
+from services.ephemeris import calculate_transit_positions, format_natal_chart
 from services.openai_service import generate_daily_horoscope
-from database import operations
+from services.horoscope_delivery import horoscope_delivery
+from database import async_operations
 from handlers.start import back_to_menu_handler
 
 logger = logging.getLogger(__name__)
@@ -29,7 +26,7 @@ logger = logging.getLogger(__name__)
 async def horoscope_command(message: types.Message, state: FSMContext):
     """Обработчик команды /horoscope и нажатия на кнопку гороскопа"""
     user_id = str(message.from_user.id)
-    user = operations.get_user(user_id)
+    user = await async_operations.get_user(user_id)
     
     # Проверяем, есть ли у пользователя натальная карта
     if not user or not user.get("natal_chart"):
@@ -80,16 +77,17 @@ async def horoscope_settings_handler(message: types.Message, state: FSMContext):
     
     elif message.text == "📝 Посмотреть текущие настройки":
         user_id = str(message.from_user.id)
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
         
         if user.get("horoscope_time") and user.get("horoscope_city"):
             # Получаем последний гороскоп пользователя
-            horoscope = operations.get_last_horoscope(user_id)
+            horoscope = await async_operations.get_last_horoscope(user_id)
             
             settings_message = (
                 f"📅 Настройки ежедневного гороскопа\n\n"
                 f"⏰ Время доставки: {user.get('horoscope_time')}\n"
                 f"🌍 Город: {user.get('horoscope_city')}\n"
+                f"🕒 Часовой пояс: {user.get('horoscope_tz_name') or 'UTC'}\n"
                 f"🌐 Координаты: {user.get('horoscope_latitude', 0):.4f}, {user.get('horoscope_longitude', 0):.4f}\n\n"
             )
             
@@ -126,7 +124,7 @@ async def process_horoscope_time(message: types.Message, state: FSMContext):
     
     if message.text == "↩️ Назад":
         user_id = str(message.from_user.id)
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
         
         if user.get("horoscope_time") and user.get("horoscope_city"):
             await message.answer(
@@ -150,17 +148,19 @@ async def process_horoscope_time(message: types.Message, state: FSMContext):
     
     # Проверяем, есть ли уже город в настройках
     user_id = str(message.from_user.id)
-    user = operations.get_user(user_id)
+    user = await async_operations.get_user(user_id)
     
     if user.get("horoscope_city"):
         # Если город уже есть, обновляем только время
-        operations.update_user_horoscope_settings(
+        user = await async_operations.update_user_horoscope_settings(
             user_id,
             parsed_time,
             user.get("horoscope_city"),
             user.get("horoscope_latitude"),
-            user.get("horoscope_longitude")
+            user.get("horoscope_longitude"),
+            user.get("horoscope_tz_name") or get_timezone_name(user.get("horoscope_latitude"), user.get("horoscope_longitude"))
         )
+        horoscope_delivery.reschedule(user)
         
         await message.answer(
             f"✅ Время доставки гороскопа изменено на {parsed_time}.\n\n"
@@ -205,7 +205,8 @@ async def process_horoscope_city(message: types.Message, state: FSMContext):
     await state.update_data(
         horoscope_city=city,
         horoscope_latitude=location_info["lat"],
-        horoscope_longitude=location_info["lon"]
+        horoscope_longitude=location_info["lon"],
+        horoscope_tz_name=location_info["tz_name"]
     )
     logger.info(f"Пользователь {message.from_user.id} выбрал город для гороскопа: {city}")
     
@@ -251,13 +252,15 @@ async def process_coords_choice(message: types.Message, state: FSMContext):
         horoscope_lon = data.get('horoscope_longitude')
         
         user_id = str(message.from_user.id)
-        operations.update_user_horoscope_settings(
+        user = await async_operations.update_user_horoscope_settings(
             user_id,
             horoscope_time,
             horoscope_city,
             horoscope_lat,
-            horoscope_lon
+            horoscope_lon,
+            data.get('horoscope_tz_name') or "UTC"
         )
+        horoscope_delivery.reschedule(user)
         
         await message.answer(
             f"✅ Настройки гороскопа сохранены!\n\n"
@@ -292,13 +295,16 @@ async def process_coords(message: types.Message, state: FSMContext):
         horoscope_city = data.get('horoscope_city')
         
         user_id = str(message.from_user.id)
-        operations.update_user_horoscope_settings(
+        user = await async_operations.update_user_horoscope_settings(
             user_id,
             horoscope_time,
             horoscope_city,
             lat,
-            lon
+            lon,
+            # Временная зона определяется по уточненным координатам
+            get_timezone_name(lat, lon)
         )
+        horoscope_delivery.reschedule(user)
         
         await message.answer(
             f"✅ Настройки гороскопа сохранены!\n\n"
@@ -332,7 +338,7 @@ async def confirm_settings(message: types.Message, state: FSMContext):
     
     if message.text.lower() == "да" or message.text == "✨ Получить свежий гороскоп":
         user_id = str(message.from_user.id)
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
         
         if not user or not user.get("natal_chart"):
             await message.answer(
@@ -347,13 +353,12 @@ async def confirm_settings(message: types.Message, state: FSMContext):
             reply_markup=types.ReplyKeyboardRemove()
         )
         
-        # Рассчитываем текущее положение планет
-        now = datetime.now()
+        # Рассчитываем текущее положение планет (транзиты считаются по UTC)
+        now = datetime.utcnow()
         lat = user.get("horoscope_latitude", 0)
         lon = user.get("horoscope_longitude", 0)
         
-        planets = calculate_planet_positions_utc(now, lat, lon)
-        houses = calculate_houses_utc(now, lat, lon)
+        planets, houses = calculate_transit_positions(now, lat, lon)
         
         if not planets or not houses:
             await message.answer(
@@ -378,11 +383,11 @@ async def confirm_settings(message: types.Message, state: FSMContext):
         )
         
         # Сохраняем гороскоп в базу
-        operations.add_horoscope(user_id, horoscope_text)
+        await async_operations.add_horoscope(user_id, horoscope_text)
         
         # Отправляем гороскоп
         await message.answer(
-            f"🌟 Ваш персональный гороскоп на {now.strftime('%d.%m.%Y')}:\n\n{horoscope_text}",
+            f"🌟 Ваш персональный гороскоп на {utc_to_local(now, user.get('horoscope_tz_name')).strftime('%d.%m.%Y')}:\n\n{horoscope_text}",
             reply_markup=get_main_menu()
         )
         
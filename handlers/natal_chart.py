@@ -21,8 +21,10 @@ from services.ephemeris import (
     calculate_houses_utc, 
     format_natal_chart
 )
+from services.natal_chart import NatalChart
 from services.openai_service import generate_natal_chart_interpretation
-from database import operations
+from utils.telegram_stream import TelegramStreamWriter
+from database import async_operations
 from handlers.start import back_to_menu_handler
 
 logger = logging.getLogger(__name__)
@@ -60,7 +62,7 @@ async def natal_chart_command(message: types.Message, state: FSMContext):
     
     # Проверяем, есть ли у пользователя уже рассчитанная карта
     user_id = str(message.from_user.id)
-    user = operations.get_user(user_id)
+    user = await async_operations.get_user(user_id)
     
     if user and user.get("natal_chart"):
         # У пользователя уже есть натальная карта
@@ -103,28 +105,22 @@ async def natal_chart_action_handler(message: types.Message, state: FSMContext):
         await state.set_state(NatalChartStates.waiting_for_date)
     elif message.text == "👁️ Посмотреть текущую карту":
         user_id = str(message.from_user.id)
-        user = operations.get_user(user_id)
+        user = await async_operations.get_user(user_id)
         
         if user and user.get("natal_chart"):
             chart_text = user["natal_chart"]
             
-            # Имитируем анализ
-            await message.answer(add_astro_emoji("Анализирую вашу натальную карту..."))
-            await typing_action(message, 2, 3)
-            
-            # Получаем интерпретацию натальной карты
-            interpretation = await generate_natal_chart_interpretation(chart_text, user_id)
-            
             # Отправляем карту
             await message.answer(chart_text, reply_markup=get_main_menu())
             
-            # Имитируем печать перед отправкой интерпретации
-            await typing_action(message, 2, 3)
-            
-            await message.answer(
-                add_astro_emoji(f"Интерпретация вашей натальной карты:\n\n{interpretation}"),
-                reply_markup=get_main_menu()
+            # Получаем интерпретацию натальной карты (из кэша или по мере генерации)
+            await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
+            stream_writer = TelegramStreamWriter(
+                message.bot,
+                message.chat.id,
+                prefix=add_astro_emoji("Интерпретация вашей натальной карты:\n\n")
             )
+            await generate_natal_chart_interpretation(chart_text, user_id, stream_writer=stream_writer)
             await state.set_state(NatalChartStates.dialog_active)
         else:
             await message.answer(
@@ -368,7 +364,7 @@ async def proceed_with_calculation(message: types.Message, state: FSMContext):
     
     # Обновляем данные пользователя в базе
     user_id = str(message.from_user.id)
-    operations.update_user_birth_info(
+    await async_operations.update_user_birth_info(
         user_id, 
         date, 
         time_str, 
@@ -376,25 +372,22 @@ async def proceed_with_calculation(message: types.Message, state: FSMContext):
         lat, 
         lon, 
         tz_name, 
-        formatted_chart
+        formatted_chart,
+        NatalChart.from_positions(planets, houses).to_bytes()
     )
     
-    # Получаем интерпретацию натальной карты
-    await message.answer(add_astro_emoji("Натальная карта рассчитана! Анализирую результаты...", "success"))
-    await typing_action(message, 2, 3)
-    
-    interpretation = await generate_natal_chart_interpretation(formatted_chart, user_id)
-    
     # Отправляем результат
+    await message.answer(add_astro_emoji("Натальная карта рассчитана! Анализирую результаты...", "success"))
     await message.answer(formatted_chart, reply_markup=get_main_menu())
     
-    # Имитируем печать перед отправкой интерпретации
-    await typing_action(message, 2, 3)
-    
-    await message.answer(
-        add_astro_emoji(f"Интерпретация вашей натальной карты:\n\n{interpretation}"),
-        reply_markup=get_main_menu()
+    # Получаем интерпретацию натальной карты, выводя её по мере генерации
+    await message.bot.send_chat_action(chat_id=message.chat.id, action="typing")
+    stream_writer = TelegramStreamWriter(
+        message.bot,
+        message.chat.id,
+        prefix=add_astro_emoji("Интерпретация вашей натальной карты:\n\n")
     )
+    await generate_natal_chart_interpretation(formatted_chart, user_id, stream_writer=stream_writer)
     
     await typing_action(message, 1, 2)
     
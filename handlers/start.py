@@ -4,7 +4,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.types import FSInputFile
 
 from utils.keyboards import get_main_menu
-from database import operations
+from database import async_operations
 from states.user_states import NatalChartStates
 
 async def start_command(message: types.Message, state: FSMContext):
@@ -18,7 +18,7 @@ async def start_command(message: types.Message, state: FSMContext):
     first_name = message.from_user.first_name or ""
     last_name = message.from_user.last_name or ""
     
-    operations.create_user(user_id, username, first_name, last_name)
+    await async_operations.create_user(user_id, username, first_name, last_name)
     
     # Формируем приветственное сообщение
     greeting = (
@@ -13,9 +13,9 @@ from utils.keyboards import (
     get_subscription_menu,
     get_back_button
 )
-from database import operations
+from database import async_operations
 from config import SUBSCRIPTION_PRICES, ADMIN_TELEGRAM_ID, TG_STARS_MULTIPLIER
-from services.payment_service import create_payment, telegram_stars_payment
+from services.payment_service import create_payment
 from utils.error_logger import handle_exception, log_error
 from handlers.start import back_to_menu_handler
 
@@ -25,7 +25,7 @@ logger = logging.getLogger(__name__)
 async def subscription_command(message: types.Message, state: FSMContext, **kwargs):
     """Обработчик команды /subscription и нажатия на кнопку подписки"""
     user_id = str(message.from_user.id)
-    user = operations.get_user(user_id)
+    user = await async_operations.get_user(user_id)
     
     # Проверяем, есть ли у пользователя действующая подписка
     has_subscription = False
@@ -38,7 +38,7 @@ async def subscription_command(message: types.Message, state: FSMContext, **kwar
             subscription_end = end_date
     
     # Проверяем, есть ли у пользователя незавершенный платеж
-    has_pending_payment = operations.check_user_has_active_payment(user_id)
+    has_pending_payment = await async_operations.check_user_has_active_payment(user_id)
     
     if has_pending_payment:
         await message.answer(
@@ -116,7 +116,7 @@ async def direct_payment_callback(callback: types.CallbackQuery, state: FSMConte
     )
     
     # Создаем транзакцию в БД
-    transaction_id = operations.add_subscription_transaction(
+    transaction_id = await async_operations.add_subscription_transaction(
         user_id,
         plan,
         SUBSCRIPTION_PRICES.get(plan, 0),
@@ -160,7 +160,7 @@ async def direct_payment_callback(callback: types.CallbackQuery, state: FSMConte
         )
         
         # Обновляем транзакцию с ID инвойса
-        operations.update_transaction_status(
+        await async_operations.update_transaction_status(
             transaction_id, 
             "pending", 
             {"invoice_id": payload}
@@ -176,7 +176,7 @@ async def direct_payment_callback(callback: types.CallbackQuery, state: FSMConte
         )
         
         # Отменяем транзакцию
-        operations.update_transaction_status(transaction_id, "failed", {"error": str(e)})
+        await async_operations.update_transaction_status(transaction_id, "failed", {"error": str(e)})
         await state.clear()
 
 @handle_exception
@@ -189,9 +189,9 @@ async def cancel_payment_callback(callback: types.CallbackQuery, state: FSMConte
     transaction_id = data.get("transaction_id")
     
     if transaction_id:
-        operations.update_transaction_status(transaction_id, "cancelled")
+        await async_operations.update_transaction_status(transaction_id, "cancelled")
     else:
-        operations.cancel_pending_transactions(user_id)
+        await async_operations.cancel_pending_transactions(user_id)
     
     await callback.message.answer(
         "❌ Платеж отменен. Вы можете попробовать снова в любое время.",
@@ -239,51 +239,43 @@ async def process_successful_payment(message: types.Message, state: FSMContext):
         
         logger.info(f"Successful payment from user {user_id}: {payload}, {total_amount} {currency}")
         
-        # Парсим payload для получения плана подписки и ID транзакции
-        if "_" in payload:
-            parts = payload.split("_")
-            if len(parts) >= 3:
-                plan = parts[1]
-                transaction_id = parts[2]
-                
-                # Активируем подписку
-                result = await telegram_stars_payment.process_stars_transfer(user_id, plan, total_amount, transaction_id)
-                
-                if result.get("success"):
-                    # Отправляем сообщение пользователю
-                    await message.answer(
-                        "✅ Оплата успешно получена! Ваша подписка активирована.\n\n"
-                        "Спасибо за поддержку нашего бота. Теперь вам доступны все премиум-функции!",
-                        reply_markup=get_main_menu()
-                    )
-                    
-                    # Переходим в режим диалога
-                    await state.set_state(NatalChartStates.dialog_active)
-                else:
-                    logger.error(f"Failed to process successful payment: {result.get('error')}")
-                    
-                    # Отправляем сообщение пользователю
-                    await message.answer(
-                        "⚠️ Оплата получена, но возникла ошибка при активации подписки.\n\n"
-                        "Пожалуйста, свяжитесь с администратором.",
-                        reply_markup=get_main_menu()
-                    )
-            else:
-                logger.error(f"Invalid payload format: {payload}")
-        else:
+        # Транзакция счета находится по индексу payload; повторная доставка той же
+        # оплаты узнается по telegram_payment_charge_id и подписку не продлевает
+        result = await async_operations.complete_subscription_payment(
+            payload,
+            payment_info.telegram_payment_charge_id
+        )
+        
+        if result is None:
             logger.warning(f"Unknown payload format: {payload}")
             
-            # Активируем подписку по умолчанию
-            operations.update_user_subscription(user_id, "1_month", 1)
-            
-            await message.answer(
-                "✅ Оплата успешно получена! Ваша подписка активирована.\n\n"
-                "Спасибо за поддержку нашего бота. Теперь вам доступны все премиум-функции!",
-                reply_markup=get_main_menu()
+            # Активируем подписку по умолчанию, сохранив оплату для защиты от повтора
+            transaction_id = await async_operations.add_subscription_transaction(
+                user_id,
+                "1_month",
+                SUBSCRIPTION_PRICES.get("1_month", 0),
+                "completed",
+                "telegram_stars",
+                1,
+                payload=payload,
+                telegram_payment_charge_id=payment_info.telegram_payment_charge_id
             )
-            
-            # Переходим в режим диалога
-            await state.set_state(NatalChartStates.dialog_active)
+            if transaction_id is None:
+                logger.info(f"Payment {payment_info.telegram_payment_charge_id} already processed")
+                return
+        elif result["duplicate"]:
+            logger.info(f"Payment {payment_info.telegram_payment_charge_id} already processed")
+            return
+        
+        # Отправляем сообщение пользователю
+        await message.answer(
+            "✅ Оплата успешно получена! Ваша подписка активирована.\n\n"
+            "Спасибо за поддержку нашего бота. Теперь вам доступны все премиум-функции!",
+            reply_markup=get_main_menu()
+        )
+        
+        # Переходим в режим диалога
+        await state.set_state(NatalChartStates.dialog_active)
     except Exception as e:
         logger.error(f"Error processing successful payment: {e}")
         
@@ -0,0 +1,295 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    CopyMessage,
+    EditMessageReplyMarkup,
+    EditMessageText,
+    ForwardMessage,
+    SendAnimation,
+    SendAudio,
+    SendDocument,
+    SendInvoice,
+    SendMediaGroup,
+    SendMessage,
+    SendPhoto,
+    SendSticker,
+    SendVideo,
+    SendVoice
+)
+
+from config import (
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_GROUP_RATE_PER_MINUTE,
+    TELEGRAM_GROUP_BURST,
+    TELEGRAM_SEND_MAX_RETRIES,
+    TELEGRAM_MAX_RETRY_AFTER
+)
+
+logger = logging.getLogger(__name__)
+
+# Методы API, которые отправляют или изменяют сообщения в чате и подпадают под лимиты Telegram
+RATE_LIMITED_METHODS = (
+    SendMessage, SendPhoto, SendDocument, SendAnimation, SendAudio, SendVideo, SendVoice,
+    SendSticker, SendMediaGroup, SendInvoice, CopyMessage, ForwardMessage,
+    EditMessageText, EditMessageReplyMarkup
+)
+
+# Приоритеты отправки: меньшее значение обслуживается раньше
+INTERACTIVE = 0  # Ответы пользователю на его действия
+BULK = 1  # Рассылки планировщика
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Максимум корзин чатов, после которого простаивающие корзины удаляются
+MAX_CHAT_BUCKETS = 10000
+
+_send_priority = contextvars.ContextVar("telegram_send_priority", default=INTERACTIVE)
+
+@contextmanager
+def bulk_priority():
+    """
+    Отправки внутри блока (и в задачах, созданных внутри него) идут с низким приоритетом
+
+        with bulk_priority():
+            await bot.send_message(user_id, text)
+    """
+    token = _send_priority.set(BULK)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше capacity про запас"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Время ожидания следующего токена (0, если токен есть)"""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds, now):
+        """Запрещает отправку на seconds секунд (после ответа 429 от Telegram)"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_idle(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+class TelegramRateLimiter:
+    """
+    Ограничитель исходящих сообщений бота.
+
+    Каждая отправка берет токен из корзины чата (для личных чатов
+    chat_rate сообщений в секунду, для групп group_rate_per_minute в минуту)
+    и из общей корзины бота (global_rate в секунду). Общие токены выдаются
+    по очереди приоритетов: ответы пользователям обслуживаются раньше
+    рассылок, внутри приоритета - в порядке поступления. На ответ 429
+    отправка повторяется после retry_after, а чат блокируется на это время.
+    """
+
+    def __init__(self, global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 group_rate_per_minute=TELEGRAM_GROUP_RATE_PER_MINUTE, group_burst=TELEGRAM_GROUP_BURST,
+                 max_retries=TELEGRAM_SEND_MAX_RETRIES, max_retry_after=TELEGRAM_MAX_RETRY_AFTER):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.group_burst = group_burst
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        # Запас общей корзины - одна секунда трафика
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}  # chat_id -> TokenBucket
+        self._chat_queues = {}  # chat_id -> [блокировка, число ожидающих]
+        self._waiters = []  # Куча [приоритет, номер, future] ожидающих общий токен
+        self._sequence = itertools.count()
+        self._stats = {
+            priority: {"attempts": 0, "sent": 0, "failed": 0, "retries": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for priority in PRIORITY_NAMES
+        }
+
+    def _chat_bucket(self, chat_id):
+        key = str(chat_id)
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) >= MAX_CHAT_BUCKETS:
+                self._prune()
+            # Группы и каналы имеют отрицательный id или @username
+            if key.startswith(("-", "@")):
+                bucket = TokenBucket(self.group_rate, self.group_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[key] = bucket
+        return bucket
+
+    def _prune(self):
+        """Удаляет корзины чатов, в которые давно ничего не отправлялось"""
+        now = time.monotonic()
+        for key in [key for key, bucket in self._chats.items() if bucket.is_idle(now)]:
+            del self._chats[key]
+
+    def _wake_head(self):
+        if self._waiters:
+            future = self._waiters[0][2]
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    async def _acquire_global(self, priority):
+        """Ждет токен общей корзины в порядке приоритета"""
+        entry = [priority, next(self._sequence), None]
+        heapq.heappush(self._waiters, entry)
+        try:
+            while True:
+                if self._waiters[0] is entry:
+                    now = time.monotonic()
+                    delay = self._global.delay(now)
+                    if delay <= 0:
+                        self._global.consume(now)
+                        heapq.heappop(self._waiters)
+                        self._wake_head()
+                        return
+                    # Если за это время придет запрос с более высоким приоритетом,
+                    # он станет первым и разбудит нас, когда получит токен
+                    await asyncio.sleep(delay)
+                else:
+                    entry[2] = asyncio.get_running_loop().create_future()
+                    await entry[2]
+                    entry[2] = None
+        except BaseException:
+            if entry in self._waiters:
+                was_head = self._waiters[0] is entry
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                if was_head:
+                    self._wake_head()
+            raise
+
+    async def acquire(self, chat_id, priority=INTERACTIVE):
+        """Ждет, пока отправка в чат будет разрешена лимитами"""
+        key = str(chat_id)
+        bucket = self._chat_bucket(key)
+
+        # Сообщения в один чат получают токены по очереди, чтобы не нарушался их порядок
+        queue = self._chat_queues.get(key)
+        if queue is None:
+            queue = self._chat_queues[key] = [asyncio.Lock(), 0]
+        queue[1] += 1
+        try:
+            async with queue[0]:
+                while True:
+                    now = time.monotonic()
+                    delay = bucket.delay(now)
+                    if delay <= 0:
+                        bucket.consume(now)
+                        break
+                    await asyncio.sleep(delay)
+        finally:
+            queue[1] -= 1
+            if queue[1] == 0:
+                del self._chat_queues[key]
+        await self._acquire_global(priority)
+
+    async def send(self, make_request, bot, method):
+        """Выполняет запрос к API с учетом лимитов и повторами после 429"""
+        priority = _send_priority.get()
+        stats = self._stats[priority]
+        attempt = 0
+        while True:
+            queued = time.monotonic()
+            await self.acquire(method.chat_id, priority)
+            wait = time.monotonic() - queued
+            stats["attempts"] += 1
+            stats["total_wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                stats["retries"] += 1
+                self._chat_bucket(method.chat_id).block(e.retry_after, time.monotonic())
+                if attempt >= self.max_retries or e.retry_after > self.max_retry_after:
+                    stats["failed"] += 1
+                    raise
+                attempt += 1
+                logger.warning(
+                    f"Telegram ограничил отправку в чат {method.chat_id}, повтор через {e.retry_after} с "
+                    f"(попытка {attempt} из {self.max_retries})"
+                )
+                continue
+            except Exception:
+                stats["failed"] += 1
+                raise
+
+            stats["sent"] += 1
+            return result
+
+    def get_stats(self):
+        """
+        Возвращает метрики по приоритетам
+
+        avg_wait/max_wait - время ожидания разрешения лимитов перед отправкой,
+        retries - ответы 429 от Telegram
+        """
+        waiting = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _ in self._waiters:
+            waiting[PRIORITY_NAMES[priority]] += 1
+
+        priorities = {}
+        for priority, stats in self._stats.items():
+            attempts = stats["attempts"]
+            priorities[PRIORITY_NAMES[priority]] = {
+                "sent": stats["sent"],
+                "failed": stats["failed"],
+                "retries": stats["retries"],
+                "avg_wait": stats["total_wait"] / attempts if attempts else 0.0,
+                "max_wait": stats["max_wait"],
+                "waiting": waiting[PRIORITY_NAMES[priority]]
+            }
+        return {
+            "sent": sum(stats["sent"] for stats in self._stats.values()),
+            "retries": sum(stats["retries"] for stats in self._stats.values()),
+            "waiting": len(self._waiters),
+            "chats": len(self._chats),
+            "priorities": priorities
+        }
+
+# Общий ограничитель для импорта
+telegram_rate_limiter = TelegramRateLimiter()
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: все отправки сообщений проходят через ограничитель"""
+
+    def __init__(self, limiter=telegram_rate_limiter):
+        self.limiter = limiter
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, RATE_LIMITED_METHODS):
+            return await make_request(bot, method)
+        return await self.limiter.send(make_request, bot, method)
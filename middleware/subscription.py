@@ -1,12 +1,12 @@
 from typing import Callable, Dict, Any, Awaitable
-from datetime import datetime
 import logging
 
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery
 from aiogram.dispatcher.event.bases import CancelHandler
 
-from database import operations
+from database import async_operations
+from database.operations import has_active_subscription
 from services.subscription_service import check_channel_subscription
 from config import PREMIUM_CHANNEL_ID
 
@@ -43,19 +43,22 @@ class SubscriptionMiddleware(BaseMiddleware):
             # Пропускаем другие типы событий
             return await handler(event, data)
         
+        # Загружаем пользователя один раз на обновление: снимок доступен
+        # обработчикам как аргумент db_user
+        user = await async_operations.get_user(user_id)
+        data["db_user"] = user
+        
         # Проверяем, нужно ли пропустить проверку для этого сообщения/callback
         if self._should_skip_check(text):
             return await handler(event, data)
         
-        # Получаем данные пользователя
-        user = operations.get_user(user_id)
         if not user:
             # Если пользователя нет в базе, создаем его
             if isinstance(event, Message):
                 username = event.from_user.username or ""
                 first_name = event.from_user.first_name or ""
                 last_name = event.from_user.last_name or ""
-                operations.create_user(user_id, username, first_name, last_name)
+                data["db_user"] = await async_operations.create_user(user_id, username, first_name, last_name)
             return await handler(event, data)
         
         # Проверяем подписку на премиум-канал
@@ -64,21 +67,13 @@ class SubscriptionMiddleware(BaseMiddleware):
         
         # Если пользователь подписан на канал, обновляем его статус подписки
         if has_channel_subscription and user.get("subscription_type") == "free":
-            operations.update_user_subscription(user_id, "channel_premium", 1)  # Обновляем на 1 месяц
+            data["db_user"] = await async_operations.update_user_subscription(user_id, "channel_premium", 1)  # Обновляем на 1 месяц
             logger.info(f"Пользователь {user_id} получил премиум через подписку на канал")
         
-        # Проверяем платную подписку напрямую
-        if user.get("subscription_type") != "free":
-            # Проверяем, не истекла ли подписка
-            if user.get("subscription_end_date"):
-                end_date = datetime.fromisoformat(user.get("subscription_end_date"))
-                if end_date > datetime.now():
-                    # Подписка активна, пропускаем
-                    return await handler(event, data)
-                # Подписка истекла, но пользователь может быть подписан на канал
-                elif not has_channel_subscription:
-                    # Обновляем статус подписки, если нет подписки на канал
-                    operations.update_user_subscription(user_id, "free")
+        # Платная подписка активна. Истекшая подписка (даже если трекер еще не перевел
+        # ее на бесплатный план) проверяется как бесплатный план
+        if has_active_subscription(user):
+            return await handler(event, data)
         
         # Если пользователь подписан на канал, пропускаем проверку лимита сообщений
         if has_channel_subscription:
@@ -0,0 +1,120 @@
+import asyncio
+import logging
+import math
+import time
+
+from config import DELIVERY_WORKERS, DELIVERY_LLM_CONCURRENCY, DELIVERY_TELEGRAM_CONCURRENCY
+from middleware.rate_limit import bulk_priority
+
+logger = logging.getLogger(__name__)
+
+def _percentile(sorted_values, q):
+    """Перцентиль q (0..1) отсортированного списка методом ближайшего ранга"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[max(0, math.ceil(q * len(sorted_values)) - 1)]
+
+class DeliveryPipeline:
+    """
+    Конвейер массовой рассылки гороскопов.
+
+    Пользователи обрабатываются workers корутинами параллельно. Каждая
+    доставка состоит из двух стадий: generate (запрос к модели и сохранение
+    результата) и send (отправка в Telegram). Число одновременных генераций
+    и отправок ограничено отдельными семафорами, поэтому медленная модель не
+    занимает лимит Telegram и наоборот. Ошибка у одного пользователя
+    записывается в отчет и не прерывает рассылку остальным.
+    """
+
+    def __init__(self, workers=DELIVERY_WORKERS, llm_concurrency=DELIVERY_LLM_CONCURRENCY,
+                 telegram_concurrency=DELIVERY_TELEGRAM_CONCURRENCY):
+        self.workers = workers
+        self.llm_concurrency = llm_concurrency
+        self.telegram_concurrency = telegram_concurrency
+        self.last_reports = {}  # название рассылки -> отчет о последнем запуске
+
+    async def run(self, name, users, generate, send=None, on_result=None):
+        """
+        Выполняет рассылку
+
+        Args:
+            name: Название рассылки для логов и отчета
+            users: Список строк пользователей
+            generate: async generate(user) -> текст или None, если пользователя нужно пропустить
+            send: async send(user, text); если не передан, выполняется только
+                генерация (заблаговременная подготовка гороскопов)
+            on_result: async on_result(user, status, error) вызывается после обработки
+                каждого пользователя со статусом delivered, skipped или failed
+
+        Returns:
+            dict: Отчет о рассылке
+        """
+        queue = asyncio.Queue()
+        for user in users:
+            queue.put_nowait(user)
+
+        llm_slots = asyncio.Semaphore(self.llm_concurrency)
+        telegram_slots = asyncio.Semaphore(self.telegram_concurrency)
+        latencies = []
+        counters = {"delivered": 0, "skipped": 0, "failed": 0}
+
+        async def worker():
+            while True:
+                try:
+                    user = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+
+                user_id = user["user_id"]
+                started = time.perf_counter()
+                error = None
+                try:
+                    async with llm_slots:
+                        text = await generate(user)
+                    if text is None:
+                        status = "skipped"
+                    else:
+                        if send is not None:
+                            async with telegram_slots:
+                                await send(user, text)
+                        status = "delivered"
+                        latencies.append(time.perf_counter() - started)
+                except Exception as e:
+                    status = "failed"
+                    error = e
+                    logger.error(f"Рассылка {name}: ошибка доставки пользователю {user_id}: {e}")
+                counters[status] += 1
+
+                if on_result is not None:
+                    try:
+                        await on_result(user, status, error)
+                    except Exception as e:
+                        logger.error(f"Рассылка {name}: ошибка сохранения результата пользователя {user_id}: {e}")
+
+        started = time.perf_counter()
+        # Отправки рассылки пропускают вперед ответы пользователям
+        with bulk_priority():
+            await asyncio.gather(*(worker() for _ in range(min(self.workers, len(users)) or 1)))
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        report = {
+            "name": name,
+            "total": len(users),
+            **counters,
+            "elapsed": elapsed,
+            "throughput": counters["delivered"] / elapsed if elapsed > 0 else 0.0,
+            "p50": _percentile(latencies, 0.5),
+            "p95": _percentile(latencies, 0.95)
+        }
+        self.last_reports[name] = report
+
+        logger.info(
+            f"Рассылка {name} завершена за {elapsed:.1f} с: доставлено {report['delivered']} из {report['total']}, "
+            f"пропущено {report['skipped']}, ошибок {report['failed']}, "
+            f"{report['throughput']:.2f} польз./с, задержка p50 {report['p50']:.2f} с, p95 {report['p95']:.2f} с"
+        )
+        return report
+
+# Общий конвейер рассылки для импорта
+delivery_pipeline = DeliveryPipeline()
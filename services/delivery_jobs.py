@@ -0,0 +1,223 @@
+import asyncio
+import logging
+import os
+import socket
+from datetime import datetime, timedelta
+from itertools import groupby
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
+from config import (
+    DELIVERY_JOB_BATCH_SIZE,
+    DELIVERY_JOB_LEASE_SECONDS,
+    DELIVERY_JOB_MAX_ATTEMPTS,
+    DELIVERY_JOB_RETRY_BASE_SECONDS,
+    DELIVERY_JOB_RETRY_MAX_SECONDS,
+    DELIVERY_JOB_POLL_SECONDS
+)
+from database import async_operations
+from database.operations import DELIVERY_TIME_FORMAT, HOROSCOPE_USER_COLUMNS
+from services.scheduler import send_daily_horoscopes, send_monthly_horoscopes
+
+logger = logging.getLogger(__name__)
+
+# Функции доставки по типу задания: async send(bot, users, now, on_result)
+JOB_HANDLERS = {
+    "daily": send_daily_horoscopes,
+    "monthly": send_monthly_horoscopes
+}
+
+def _batch_key(job):
+    """Ежедневные задания объединяются по моменту доставки (от него зависят транзиты), месячные - по месяцу"""
+    if job["job_type"] == "daily":
+        return job["job_type"], job["scheduled_at"]
+    return job["job_type"], job["target_date"]
+
+class DeliveryJobQueue:
+    """
+    Исполнитель очереди доставок гороскопов (таблица delivery_jobs).
+
+    Каждая доставка - отдельное задание с ключом идемпотентности
+    (тип, пользователь, дата), поэтому повторная постановка в очередь не
+    создает дублей. Исполнитель берет задания в аренду на lease_seconds,
+    отправляет их через конвейер рассылки и сразу после доставки каждому
+    пользователю отмечает задание выполненным. При штатной остановке
+    (stop) невыполненные задания сразу возвращаются в очередь, а если
+    процесс завершился аварийно, они будут выданы снова после окончания
+    аренды; уже отправленные повторно не уйдут. Ошибка доставки
+    откладывает задание с экспоненциальной паузой, после max_attempts
+    попыток (или если пользователь заблокировал бота) оно переводится в dead.
+    """
+
+    def __init__(self, batch_size=DELIVERY_JOB_BATCH_SIZE, lease_seconds=DELIVERY_JOB_LEASE_SECONDS,
+                 max_attempts=DELIVERY_JOB_MAX_ATTEMPTS, retry_base_seconds=DELIVERY_JOB_RETRY_BASE_SECONDS,
+                 retry_max_seconds=DELIVERY_JOB_RETRY_MAX_SECONDS, poll_seconds=DELIVERY_JOB_POLL_SECONDS):
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.poll_seconds = poll_seconds
+        # Аренда принадлежит конкретному процессу: stop() возвращает его задания в очередь,
+        # а задания аварийно завершившегося процесса выдаются заново по окончании аренды
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = None
+        self._task = None
+        self._bot = None
+        self._stats = {"done": 0, "skipped": 0, "retried": 0, "dead": 0}
+
+    def start(self, bot: Bot):
+        """Запускает исполнитель в текущем event loop"""
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info(f"Очередь доставок гороскопов запущена ({self.worker_id})")
+
+    async def stop(self):
+        """
+        Останавливает исполнитель и снимает его аренды
+
+        Прерванные задания возвращаются в pending с готовностью сейчас и без
+        учета прерванной попытки, чтобы перезапущенный процесс (с другим
+        worker_id) взял их сразу, а не через lease_seconds.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            try:
+                released = await async_operations.release_delivery_jobs(self.worker_id, datetime.utcnow())
+                if released:
+                    logger.info(f"Возвращено в очередь прерванных заданий доставки: {released}")
+            except Exception as e:
+                logger.error(f"Ошибка при возврате заданий доставки в очередь: {e}")
+
+    def wake(self):
+        """Сообщает о новых заданиях в очереди"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                jobs = await async_operations.claim_delivery_jobs(
+                    self.worker_id,
+                    datetime.utcnow(),
+                    self.lease_seconds,
+                    self.batch_size,
+                    self.max_attempts
+                )
+                if jobs:
+                    await self._process(jobs)
+                    continue
+                timeout = await self._idle_timeout()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в очереди доставок гороскопов: {e}")
+                timeout = self.poll_seconds
+
+            # Ждем ближайшего задания, нового задания или следующей проверки очереди
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _idle_timeout(self):
+        next_attempt_at = await async_operations.get_next_delivery_job_at()
+        if next_attempt_at is None:
+            return self.poll_seconds
+        delay = (datetime.strptime(next_attempt_at, DELIVERY_TIME_FORMAT) - datetime.utcnow()).total_seconds()
+        return min(self.poll_seconds, max(0.0, delay))
+
+    async def _process(self, jobs):
+        """Выполняет задания, сгруппированные функцией _batch_key"""
+        users = {
+            user["user_id"]: user
+            for user in await async_operations.get_users_by_ids(
+                list({job["user_id"] for job in jobs}), HOROSCOPE_USER_COLUMNS
+            )
+        }
+
+        batches = []
+        jobs = sorted(jobs, key=_batch_key)
+        for (job_type, _), group in groupby(jobs, key=_batch_key):
+            group = list(group)
+            batch = []
+            for job in group:
+                user = users.get(job["user_id"])
+                if user is None or job_type not in JOB_HANDLERS:
+                    await self._fail(job["job_id"], "пользователь не найден" if user is None else "неизвестный тип задания")
+                    continue
+                # Задание передается через строку пользователя, чтобы отметить его по результату
+                batch.append({**user, "job_id": job["job_id"], "job_attempts": job["attempts"]})
+            if batch:
+                batches.append(self._run_batch(
+                    JOB_HANDLERS[job_type],
+                    batch,
+                    datetime.strptime(min(job["scheduled_at"] for job in group), DELIVERY_TIME_FORMAT)
+                ))
+        await asyncio.gather(*batches)
+
+    async def _run_batch(self, handler, batch, now):
+        """
+        Выполняет пакет заданий функцией доставки
+
+        Если функция доставки завершилась ошибкой, задания без результата
+        считаются неудачными и откладываются, а не ждут окончания аренды.
+        """
+        reported = set()
+
+        async def on_result(user, status, error):
+            reported.add(user["job_id"])
+            await self._on_result(user, status, error)
+
+        try:
+            await handler(self._bot, batch, now, on_result)
+        except Exception as e:
+            for user in batch:
+                if user["job_id"] not in reported:
+                    await self._on_result(user, "failed", e)
+
+    async def _on_result(self, user, status, error):
+        job_id = user["job_id"]
+        if status in ("delivered", "skipped"):
+            status = "done" if status == "delivered" else "skipped"
+            await async_operations.complete_delivery_job(job_id, self.worker_id, status)
+            self._stats[status] += 1
+            return
+
+        if self._is_permanent(error) or user["job_attempts"] >= self.max_attempts:
+            await self._fail(job_id, error)
+            return
+
+        delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (user["job_attempts"] - 1))
+        await async_operations.fail_delivery_job(
+            job_id, self.worker_id, error, datetime.utcnow() + timedelta(seconds=delay)
+        )
+        self._stats["retried"] += 1
+        logger.warning(f"Доставка гороскопа пользователю {user['user_id']} будет повторена через {delay} с")
+
+    async def _fail(self, job_id, error):
+        """Переводит задание в dead без повторов"""
+        await async_operations.fail_delivery_job(job_id, self.worker_id, error)
+        self._stats["dead"] += 1
+        logger.error(f"Задание доставки {job_id} переведено в dead: {error}")
+
+    @staticmethod
+    def _is_permanent(error):
+        """Ошибки, которые не исправятся повтором: бот заблокирован или чат не существует"""
+        if isinstance(error, TelegramForbiddenError):
+            return True
+        return isinstance(error, TelegramBadRequest) and "chat not found" in str(error).lower()
+
+    def get_stats(self):
+        """Возвращает счетчики заданий, обработанных этим процессом"""
+        return dict(self._stats)
+
+# Общая очередь доставок для импорта
+delivery_job_queue = DeliveryJobQueue()
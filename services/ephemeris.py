@@ -1,12 +1,37 @@
 import swisseph as swe
+import numpy as np
 from datetime import datetime
+from collections import OrderedDict
 from tabulate import tabulate
 import logging
-from config import EPHE_PATH
+import threading
+from config import EPHE_PATH, EPHEMERIS_CACHE_RESOLUTION_MINUTES, EPHEMERIS_CACHE_SIZE
 
 # Инициализация пути к ephemeris
 swe.set_ephe_path(EPHE_PATH)
 
+# Рассчитываемые тела и их идентификаторы в Swiss Ephemeris
+PLANETS = {
+    "Sun": swe.SUN,
+    "Moon": swe.MOON,
+    "Mercury": swe.MERCURY,
+    "Venus": swe.VENUS,
+    "Mars": swe.MARS,
+    "Jupiter": swe.JUPITER,
+    "Saturn": swe.SATURN,
+    "Uranus": swe.URANUS,
+    "Neptune": swe.NEPTUNE,
+    "Pluto": swe.PLUTO,
+    "Lilith": swe.MEAN_APOG,
+    "North Node": swe.MEAN_NODE
+}
+
+# Порядок тел в массивах пакетного API: тела из PLANETS и производный Южный Узел
+BODY_NAMES = tuple(PLANETS) + ("South Node",)
+
+# Порядок точек в массиве домов пакетного API: куспиды 12 домов, Асцендент и MC
+HOUSE_POINT_NAMES = tuple(f"House {i}" for i in range(1, 13)) + ("Ascendant", "MC")
+
 # Словари для перевода планет и домов
 planet_names_ru = {
     "Sun": "Солнце",
@@ -74,44 +99,124 @@ def get_house(longitude, houses):
     
     return 1  # По умолчанию возвращаем 1-й дом, если не определено
 
+def julian_day(utc_dt):
+    """Переводит время UTC в юлианский день"""
+    return swe.julday(utc_dt.year, utc_dt.month, utc_dt.day, utc_dt.hour + utc_dt.minute / 60.0)
+
+def _calculate_planets_jd(jd):
+    """Вычисляет положения планет на указанный юлианский день"""
+    res = {}
+    for name, pid in PLANETS.items():
+        pos, _ = swe.calc_ut(jd, pid)
+        res[name] = {"longitude": pos[0], "latitude": pos[1], "speed": pos[3], "house": None}
+    
+    # Добавляем Южный Узел (противоположный Северному)
+    res["South Node"] = {"longitude": (res["North Node"]["longitude"] + 180) % 360,
+                         "latitude": -res["North Node"]["latitude"],
+                         "speed": res["North Node"]["speed"],
+                         "house": None}
+    return res
+
 def calculate_planet_positions_utc(utc_dt, lat, lon):
     """Вычисляет положения планет в UTC"""
     try:
-        jd = swe.julday(utc_dt.year, utc_dt.month, utc_dt.day, utc_dt.hour + utc_dt.minute / 60.0)
-        planets = {
-            "Sun": swe.SUN,
-            "Moon": swe.MOON,
-            "Mercury": swe.MERCURY,
-            "Venus": swe.VENUS,
-            "Mars": swe.MARS,
-            "Jupiter": swe.JUPITER,
-            "Saturn": swe.SATURN,
-            "Uranus": swe.URANUS,
-            "Neptune": swe.NEPTUNE,
-            "Pluto": swe.PLUTO,
-            "Lilith": swe.MEAN_APOG,
-            "North Node": swe.MEAN_NODE
-        }
-        res = {}
-        for name, pid in planets.items():
-            pos, _ = swe.calc_ut(jd, pid)
-            res[name] = {"longitude": pos[0], "latitude": pos[1], "house": None}
-        
-        # Добавляем Южный Узел (противоположный Северному)
-        res["South Node"] = {"longitude": (res["North Node"]["longitude"] + 180) % 360,
-                             "latitude": -res["North Node"]["latitude"],
-                             "house": None}
-        
+        res = _calculate_planets_jd(julian_day(utc_dt))
         logging.info("Расчёт планет выполнен успешно")
         return res
     except Exception as e:
         logging.error(f"Ошибка расчёта планет: {e}")
         return None
 
+class TransitCache:
+    """
+    Кэш транзитных положений планет.
+
+    Долготы планет зависят только от момента времени, поэтому положения
+    считаются один раз на интервал длиной resolution_minutes (ключ -
+    юлианский день, округленный до интервала) и переиспользуются для всех
+    пользователей. Размер кэша ограничен, вытесняются давно не
+    использованные интервалы.
+    """
+
+    def __init__(self, resolution_minutes=EPHEMERIS_CACHE_RESOLUTION_MINUTES, max_size=EPHEMERIS_CACHE_SIZE):
+        self.resolution_minutes = resolution_minutes
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _bucket(self, jd):
+        """Возвращает номер интервала для юлианского дня"""
+        return round(jd * 1440 / self.resolution_minutes)
+
+    def get_planets(self, utc_dt):
+        """Возвращает положения планет на момент utc_dt (копию, которую можно изменять)"""
+        key = self._bucket(julian_day(utc_dt))
+        
+        with self._lock:
+            planets = self._entries.get(key)
+            if planets is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        
+        if planets is None:
+            planets = _calculate_planets_jd(key * self.resolution_minutes / 1440)
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = planets
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        
+        # format_natal_chart записывает дома в словари планет, поэтому отдаем копию
+        return {name: dict(data) for name, data in planets.items()}
+
+    def get_stats(self):
+        """Возвращает статистику попаданий в кэш"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0,
+                "size": len(self._entries),
+                "max_size": self.max_size
+            }
+
+    def clear(self):
+        """Очищает кэш и счетчики"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+# Общий кэш транзитов для планировщика и обработчиков
+transit_cache = TransitCache()
+
+def calculate_transit_positions(utc_dt, lat, lon):
+    """
+    Вычисляет транзитные положения планет и дома для места наблюдения
+    
+    Положения планет берутся из общего кэша транзитов, дома рассчитываются
+    для каждого места отдельно.
+    
+    Returns:
+        tuple: (планеты, дома) или (None, None) в случае ошибки
+    """
+    try:
+        planets = transit_cache.get_planets(utc_dt)
+    except Exception as e:
+        logging.error(f"Ошибка расчёта транзитов: {e}")
+        return None, None
+    
+    houses = calculate_houses_utc(utc_dt, lat, lon)
+    return planets, houses
+
 def calculate_houses_utc(utc_dt, lat, lon):
     """Вычисляет положения домов в UTC"""
     try:
-        jd = swe.julday(utc_dt.year, utc_dt.month, utc_dt.day, utc_dt.hour + utc_dt.minute / 60.0)
+        jd = julian_day(utc_dt)
         houses, asc_mc = swe.houses(jd, lat, lon, b'P')
         asc = asc_mc[0]
         mc = asc_mc[1]
@@ -124,6 +229,60 @@ def calculate_houses_utc(utc_dt, lat, lon):
         logging.error(f"Ошибка расчёта домов: {e}")
         return None
 
+def calculate_positions_batch(jds, lats=None, lons=None):
+    """
+    Пакетно вычисляет положения планет (и, при наличии мест, домов) для массива моментов времени
+    
+    Args:
+        jds: Массив юлианских дней (UT)
+        lats: Широта или массив широт той же длины, что и jds
+        lons: Долгота или массив долгот той же длины, что и jds
+        
+    Returns:
+        tuple: (positions, houses)
+            positions - float64 массив (n_times, len(BODY_NAMES), 3): долгота, широта, скорость по долготе
+            houses - float64 массив (n_times, len(HOUSE_POINT_NAMES)) или None, если место не указано
+    """
+    jds = np.asarray(jds, dtype=np.float64).reshape(-1)
+    jd_list = jds.tolist()
+    flags = swe.FLG_SWIEPH | swe.FLG_SPEED
+    calc_ut = swe.calc_ut
+    
+    pids = list(PLANETS.values())
+    
+    # Все тела одного момента считаются подряд: Swiss Ephemeris переиспользует общие для момента расчеты
+    raw = np.array(
+        [calc_ut(jd, pid, flags)[0] for jd in jd_list for pid in pids],
+        dtype=np.float64
+    ).reshape(len(jd_list), len(pids), 6)
+    
+    positions = np.empty((len(jd_list), len(BODY_NAMES), 3), dtype=np.float64)
+    positions[:, :len(pids)] = raw[:, :, [0, 1, 3]]
+    
+    # Южный Узел противоположен Северному
+    north = BODY_NAMES.index("North Node")
+    south = BODY_NAMES.index("South Node")
+    positions[:, south, 0] = (positions[:, north, 0] + 180) % 360
+    positions[:, south, 1] = -positions[:, north, 1]
+    positions[:, south, 2] = positions[:, north, 2]
+    
+    houses = None
+    if lats is not None and lons is not None:
+        lat_list = np.broadcast_to(np.asarray(lats, dtype=np.float64), jds.shape).tolist()
+        lon_list = np.broadcast_to(np.asarray(lons, dtype=np.float64), jds.shape).tolist()
+        houses = np.empty((len(jd_list), len(HOUSE_POINT_NAMES)), dtype=np.float64)
+        for i, (jd, lat, lon) in enumerate(zip(jd_list, lat_list, lon_list)):
+            cusps, asc_mc = swe.houses(jd, lat, lon, b'P')
+            houses[i, :12] = cusps
+            houses[i, 12] = asc_mc[0]
+            houses[i, 13] = asc_mc[1]
+    
+    return positions, houses
+
+def julian_days(utc_datetimes):
+    """Переводит последовательность моментов времени UTC в массив юлианских дней"""
+    return np.fromiter((julian_day(dt) for dt in utc_datetimes), dtype=np.float64)
+
 def assign_houses_to_planets(planets, houses):
     """Присваивает планетам дома"""
     if not planets or not houses:
@@ -230,76 +389,116 @@ def format_natal_chart(planets, houses):
 
     return formatted_chart
 
-def get_aspects_between_charts(chart1, chart2):
-    """Вычисляет аспекты между двумя натальными картами"""
-    aspects = []
-    
-    # Определяем важные аспекты и их орбисы
-    aspect_types = {
-        0: {"name": "Соединение", "orb": 8, "influence": "сильное"},
-        60: {"name": "Секстиль", "orb": 4, "influence": "положительное"},
-        90: {"name": "Квадратура", "orb": 6, "influence": "напряженное"},
-        120: {"name": "Трин", "orb": 8, "influence": "положительное"},
-        180: {"name": "Оппозиция", "orb": 8, "influence": "напряженное"}
-    }
+# Аспекты: угол, название, орбис и характер влияния
+ASPECT_TYPES = (
+    (0, "Соединение", 8, "сильное"),
+    (60, "Секстиль", 4, "положительное"),
+    (90, "Квадратура", 6, "напряженное"),
+    (120, "Трин", 8, "положительное"),
+    (180, "Оппозиция", 8, "напряженное")
+)
+ASPECT_ANGLES = np.array([aspect[0] for aspect in ASPECT_TYPES], dtype=np.float64)
+ASPECT_ORBS = np.array([aspect[2] for aspect in ASPECT_TYPES], dtype=np.float64)
+
+# Наиболее важные точки карты для анализа аспектов
+ASPECT_POINT_NAMES = ("Sun", "Moon", "Mercury", "Venus", "Mars", "Jupiter", "Saturn", "Ascendant", "MC")
+
+# Найденный аспект: номер карты из списка сравниваемых, индексы точек в
+# ASPECT_POINT_NAMES, индекс аспекта в ASPECT_TYPES, отклонение от точного угла
+ASPECT_DTYPE = np.dtype([
+    ("chart", np.int32),
+    ("planet1", np.int8),
+    ("planet2", np.int8),
+    ("aspect", np.int8),
+    ("exact_diff", np.float64),
+    ("strong", np.bool_)
+])
+
+def _aspect_longitudes(chart):
+    """
+    Возвращает долготы точек ASPECT_POINT_NAMES (NaN для отсутствующих)
+
+    chart - NatalChart или словарь вида {"Sun": {"longitude": ...}, "Ascendant": ...},
+    где значения домов могут быть как словарями, так и числами
+    """
+    if hasattr(chart, "positions") and hasattr(chart, "houses"):
+        points = dict(zip(BODY_NAMES, chart.positions[:, 0].tolist()))
+        points.update(zip(HOUSE_POINT_NAMES, chart.houses.tolist()))
+        return np.array([points[name] for name in ASPECT_POINT_NAMES], dtype=np.float64)
     
-    # Определяем наиболее важные планеты для анализа
-    important_planets = ["Sun", "Moon", "Mercury", "Venus", "Mars", "Jupiter", "Saturn", "Ascendant", "MC"]
+    longitudes = np.full(len(ASPECT_POINT_NAMES), np.nan)
+    for i, name in enumerate(ASPECT_POINT_NAMES):
+        value = chart.get(name)
+        if isinstance(value, dict):
+            value = value.get("longitude")
+        if value is not None:
+            longitudes[i] = value
+    return longitudes
+
+def calculate_aspects(chart, other_charts):
+    """
+    Вычисляет аспекты между картой и одной или несколькими другими картами
     
-    for planet1_name in important_planets:
-        if planet1_name not in chart1:
-            continue
-            
-        for planet2_name in important_planets:
-            if planet2_name not in chart2:
-                continue
-                
-            # Избегаем сравнения планеты с самой собой в разных картах
-            if planet1_name == planet2_name:
-                continue
-                
-            planet1 = chart1[planet1_name]
-            planet2 = chart2[planet2_name]
-            
-            # Вычисляем разницу в долготе
-            diff = abs(planet1["longitude"] - planet2["longitude"])
-            if diff > 180:
-                diff = 360 - diff
-                
-            # Проверяем аспекты
-            for angle, aspect_info in aspect_types.items():
-                orb = aspect_info["orb"]
-                if angle - orb <= diff <= angle + orb:
-                    exact_diff = abs(diff - angle)
-                    strength = "сильный" if exact_diff <= orb/2 else "умеренный"
-                    
-                    aspects.append({
-                        "planet1": planet1_name,
-                        "planet2": planet2_name,
-                        "aspect_type": aspect_info["name"],
-                        "angle": angle,
-                        "exact_diff": exact_diff,
-                        "strength": strength,
-                        "influence": aspect_info["influence"]
-                    })
+    Для всех пар точек сразу строится матрица угловых расстояний и
+    сравнивается с углами и орбисами всех аспектов одной векторной операцией.
+    
+    Args:
+        chart: Карта пользователя (NatalChart или словарь положений)
+        other_charts: Список карт, например контактов пользователя
+        
+    Returns:
+        numpy.ndarray: Структурированный массив ASPECT_DTYPE, упорядоченный по
+            карте, первой точке, второй точке и углу аспекта
+    """
+    if not other_charts:
+        return np.empty(0, dtype=ASPECT_DTYPE)
+    
+    base = _aspect_longitudes(chart)
+    others = np.stack([_aspect_longitudes(other) for other in other_charts])
     
+    # (карта, точка первой карты, точка второй карты)
+    diff = np.abs(base[None, :, None] - others[:, None, :]) % 360
+    diff = np.minimum(diff, 360 - diff)
+    
+    # (карта, точка, точка, аспект); сравнения с NaN дают False
+    deviation = np.abs(diff[..., None] - ASPECT_ANGLES)
+    within = deviation <= ASPECT_ORBS
+    # Одноименные точки разных карт не сравниваем
+    points = len(ASPECT_POINT_NAMES)
+    within &= ~np.eye(points, dtype=bool)[None, :, :, None]
+    
+    chart_idx, planet1, planet2, aspect = np.nonzero(within)
+    exact_diff = deviation[chart_idx, planet1, planet2, aspect]
+    
+    aspects = np.empty(len(chart_idx), dtype=ASPECT_DTYPE)
+    aspects["chart"] = chart_idx
+    aspects["planet1"] = planet1
+    aspects["planet2"] = planet2
+    aspects["aspect"] = aspect
+    aspects["exact_diff"] = exact_diff
+    aspects["strong"] = exact_diff <= ASPECT_ORBS[aspect] / 2
     return aspects
 
+def get_aspects_between_charts(chart1, chart2):
+    """Вычисляет аспекты между двумя натальными картами"""
+    return calculate_aspects(chart1, [chart2])
+
 def format_aspects(aspects):
-    """Форматирует аспекты для вывода пользователю"""
-    if not aspects:
+    """Форматирует аспекты (результат calculate_aspects) для вывода пользователю"""
+    if not len(aspects):
         return "Нет значимых аспектов между картами."
         
     formatted_aspects = []
     for aspect in aspects:
-        planet1_ru = translate_to_russian(aspect["planet1"])
-        planet2_ru = translate_to_russian(aspect["planet2"])
+        planet1_ru = translate_to_russian(ASPECT_POINT_NAMES[aspect["planet1"]])
+        planet2_ru = translate_to_russian(ASPECT_POINT_NAMES[aspect["planet2"]])
+        _, aspect_name, _, influence = ASPECT_TYPES[aspect["aspect"]]
         formatted_aspects.append([
             f"{planet1_ru} - {planet2_ru}",
-            aspect["aspect_type"],
-            aspect["strength"],
-            aspect["influence"]
+            aspect_name,
+            "сильный" if aspect["strong"] else "умеренный",
+            influence
         ])
     
     result = tabulate(formatted_aspects, headers=["Планеты", "Аспект", "Сила", "Влияние"], tablefmt="pretty")
-    return result
\ No newline at end of file
+    return result
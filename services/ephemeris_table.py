@@ -0,0 +1,287 @@
+"""
+Предрасчитанная таблица эфемерид.
+
+Положения тел из PLANETS за 1900–2100 годы аппроксимируются отрезками
+рядов Чебышёва и сохраняются в компактный двоичный файл. Читатель
+отображает файл в память (np.memmap) и вычисляет долготу, широту и скорость
+за O(1) без вызовов swe.calc_ut, поэтому воркерам не нужно загружать файлы
+Swiss Ephemeris.
+
+Формат файла: заголовок HEADER_FORMAT, затем коэффициенты float64 (little-endian)
+формы (n_segments, n_bodies, 2, degree + 1) - долгота и широта для каждого тела.
+
+Сборка и проверка:
+    python -m services.ephemeris_table build
+    python -m services.ephemeris_table validate
+"""
+import argparse
+import logging
+import os
+import struct
+import threading
+from datetime import datetime
+
+import numpy as np
+from numpy.polynomial import chebyshev
+
+from config import EPHEMERIS_TABLE_PATH
+from services.ephemeris import PLANETS, BODY_NAMES, calculate_positions_batch, julian_day
+
+logger = logging.getLogger(__name__)
+
+TABLE_MAGIC = b"ASTRCHEB"
+TABLE_VERSION = 1
+
+# magic, версия, начальный юлианский день, длина отрезка в днях,
+# число отрезков, число тел, число компонент, степень ряда
+HEADER_FORMAT = "<8sIddIIII"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Параметры по умолчанию: 8-дневные отрезки и степень 12 повторяют гладкие
+# эфемериды с точностью до долей угловой секунды даже для Луны (~23 МБ на 1900–2100)
+DEFAULT_START_YEAR = 1900
+DEFAULT_END_YEAR = 2100
+DEFAULT_SEGMENT_DAYS = 8.0
+DEFAULT_DEGREE = 12
+
+# Допустимая ошибка таблицы относительно Swiss Ephemeris, угловые секунды.
+# Без файлов .se1 Swiss Ephemeris считает по Moshier, у которого есть скачки
+# в несколько секунд (заметнее всего у Нептуна) - их полином не повторяет
+DEFAULT_TOLERANCE_ARCSEC = 10.0
+
+# Число отрезков, рассчитываемых за один вызов пакетного API при сборке
+BUILD_CHUNK_SEGMENTS = 512
+
+def _chebyshev_nodes(degree):
+    """Узлы Чебышёва-Гаусса на отрезке [-1, 1]"""
+    k = np.arange(degree + 1)
+    return np.cos(np.pi * (k + 0.5) / (degree + 1))
+
+def build_ephemeris_table(path=EPHEMERIS_TABLE_PATH, start_year=DEFAULT_START_YEAR, end_year=DEFAULT_END_YEAR,
+                          segment_days=DEFAULT_SEGMENT_DAYS, degree=DEFAULT_DEGREE):
+    """
+    Строит таблицу коэффициентов Чебышёва по данным Swiss Ephemeris
+
+    Args:
+        path: Путь к создаваемому файлу
+        start_year: Первый год, покрываемый таблицей (с 1 января)
+        end_year: Последний год, покрываемый таблицей (по 31 декабря)
+        segment_days: Длина одного отрезка аппроксимации в днях
+        degree: Степень ряда Чебышёва на отрезке
+
+    Returns:
+        str: Путь к созданному файлу
+    """
+    jd_start = julian_day(datetime(start_year, 1, 1))
+    jd_end = julian_day(datetime(end_year + 1, 1, 1))
+    n_segments = int(np.ceil((jd_end - jd_start) / segment_days))
+    n_bodies = len(PLANETS)
+    nodes = _chebyshev_nodes(degree)
+
+    logger.info(f"Сборка таблицы эфемерид: {n_segments} отрезков по {segment_days} дн., степень {degree}")
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack(HEADER_FORMAT, TABLE_MAGIC, TABLE_VERSION, jd_start, segment_days,
+                            n_segments, n_bodies, 2, degree))
+
+        for first in range(0, n_segments, BUILD_CHUNK_SEGMENTS):
+            segments = np.arange(first, min(first + BUILD_CHUNK_SEGMENTS, n_segments))
+            jds = jd_start + (segments[:, None] + (nodes[None, :] + 1) / 2) * segment_days
+            positions, _ = calculate_positions_batch(jds.ravel())
+
+            # (отрезок, узел, тело, долгота/широта)
+            values = positions[:, :n_bodies, :2].reshape(len(segments), degree + 1, n_bodies, 2).copy()
+            # Убираем скачки долготы через 0°/360° внутри отрезка
+            values[..., 0] = np.degrees(np.unwrap(np.radians(values[..., 0]), axis=1))
+
+            samples = values.transpose(1, 0, 2, 3).reshape(degree + 1, -1)
+            coeffs = chebyshev.chebfit(nodes, samples, degree)
+            coeffs = coeffs.reshape(degree + 1, len(segments), n_bodies, 2).transpose(1, 2, 3, 0)
+            f.write(np.ascontiguousarray(coeffs, dtype="<f8").tobytes())
+
+    os.replace(tmp_path, path)
+    logger.info(f"Таблица эфемерид сохранена: {path} ({os.path.getsize(path) / 1024 / 1024:.1f} МБ)")
+    return path
+
+def _chebval(t, coeffs):
+    """
+    Вычисляет ряды Чебышёва схемой Кленшоу
+
+    Args:
+        t: Массив аргументов на [-1, 1] формы (n,)
+        coeffs: Коэффициенты формы (n, ..., degree + 1)
+    """
+    t = t.reshape(t.shape + (1,) * (coeffs.ndim - 2))
+    b1 = np.zeros(coeffs.shape[:-1])
+    b2 = np.zeros(coeffs.shape[:-1])
+    for k in range(coeffs.shape[-1] - 1, 0, -1):
+        b1, b2 = 2 * t * b1 - b2 + coeffs[..., k], b1
+    return t * b1 - b2 + coeffs[..., 0]
+
+class EphemerisTable:
+    """
+    Читатель предрасчитанной таблицы эфемерид.
+
+    Файл отображается в память и не копируется: при вычислении читаются
+    только коэффициенты отрезков, в которые попадают запрошенные моменты.
+    """
+
+    def __init__(self, path=EPHEMERIS_TABLE_PATH):
+        self.path = path
+        with open(path, "rb") as f:
+            header = f.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError(f"Файл таблицы эфемерид поврежден: {path}")
+
+        (magic, version, self.jd_start, self.segment_days,
+         self.n_segments, self.n_bodies, n_components, self.degree) = struct.unpack(HEADER_FORMAT, header)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            raise ValueError(f"Неподдерживаемый формат таблицы эфемерид: {path}")
+        if self.n_bodies != len(PLANETS) or n_components != 2:
+            raise ValueError(f"Таблица эфемерид собрана для другого набора тел: {path}")
+
+        self.jd_end = self.jd_start + self.n_segments * self.segment_days
+        self.coeffs = np.memmap(path, dtype="<f8", mode="r", offset=HEADER_SIZE,
+                                shape=(self.n_segments, self.n_bodies, 2, self.degree + 1))
+
+    def covers(self, jds):
+        """Проверяет, что все моменты попадают в диапазон таблицы"""
+        jds = np.asarray(jds, dtype=np.float64)
+        return bool(np.all((jds >= self.jd_start) & (jds < self.jd_end)))
+
+    def positions(self, jds):
+        """
+        Вычисляет положения тел по таблице
+
+        Args:
+            jds: Юлианский день (UT) или массив юлианских дней
+
+        Returns:
+            numpy.ndarray: float64 массив (n_times, len(BODY_NAMES), 3): долгота, широта,
+                скорость по долготе - в том же формате, что и calculate_positions_batch
+        """
+        jds = np.asarray(jds, dtype=np.float64).reshape(-1)
+        if not self.covers(jds):
+            raise ValueError("Момент времени вне диапазона таблицы эфемерид")
+
+        offset = (jds - self.jd_start) / self.segment_days
+        segments = np.minimum(offset.astype(np.int64), self.n_segments - 1)
+        t = 2 * (offset - segments) - 1
+
+        coeffs = self.coeffs[segments]
+        lon_coeffs = coeffs[:, :, 0]
+
+        positions = np.empty((len(jds), len(BODY_NAMES), 3), dtype=np.float64)
+        positions[:, :self.n_bodies, 0] = _chebval(t, lon_coeffs) % 360
+        positions[:, :self.n_bodies, 1] = _chebval(t, coeffs[:, :, 1])
+        # Производная по t переводится в градусы в сутки
+        positions[:, :self.n_bodies, 2] = (
+            _chebval(t, chebyshev.chebder(lon_coeffs, axis=-1)) * 2 / self.segment_days
+        )
+
+        # Южный Узел противоположен Северному
+        north = BODY_NAMES.index("North Node")
+        south = BODY_NAMES.index("South Node")
+        positions[:, south, 0] = (positions[:, north, 0] + 180) % 360
+        positions[:, south, 1] = -positions[:, north, 1]
+        positions[:, south, 2] = positions[:, north, 2]
+
+        return positions
+
+def validate_ephemeris_table(table, samples=20000, tolerance_arcsec=DEFAULT_TOLERANCE_ARCSEC, seed=0):
+    """
+    Сравнивает таблицу с прямым расчетом Swiss Ephemeris в случайных моментах
+
+    Returns:
+        dict: Максимальные ошибки по телам (угловые секунды; скорость - угловые секунды в сутки)
+            и признак ok, если ошибки долготы и широты не превышают tolerance_arcsec
+    """
+    rng = np.random.default_rng(seed)
+    jds = rng.uniform(table.jd_start, table.jd_end, samples)
+
+    expected, _ = calculate_positions_batch(jds)
+    actual = table.positions(jds)
+
+    lon_error = np.abs((actual[..., 0] - expected[..., 0] + 180) % 360 - 180) * 3600
+    lat_error = np.abs(actual[..., 1] - expected[..., 1]) * 3600
+    speed_error = np.abs(actual[..., 2] - expected[..., 2]) * 3600
+
+    bodies = {
+        name: {
+            "longitude": float(lon_error[:, i].max()),
+            "latitude": float(lat_error[:, i].max()),
+            "speed": float(speed_error[:, i].max())
+        }
+        for i, name in enumerate(BODY_NAMES)
+    }
+    max_error = float(max(lon_error.max(), lat_error.max()))
+
+    return {
+        "samples": samples,
+        "tolerance_arcsec": tolerance_arcsec,
+        "max_error_arcsec": max_error,
+        "ok": max_error <= tolerance_arcsec,
+        "bodies": bodies
+    }
+
+_table = None
+_table_lock = threading.Lock()
+
+def load_ephemeris_table(path=EPHEMERIS_TABLE_PATH):
+    """
+    Возвращает общий экземпляр таблицы эфемерид
+
+    Returns:
+        EphemerisTable или None, если файл таблицы не найден или поврежден
+    """
+    global _table
+    with _table_lock:
+        if _table is None or _table.path != path:
+            if not os.path.exists(path):
+                return None
+            try:
+                _table = EphemerisTable(path)
+                logger.info(f"Загружена таблица эфемерид {path}")
+            except Exception as e:
+                logger.error(f"Ошибка загрузки таблицы эфемерид: {e}")
+                return None
+        return _table
+
+def main():
+    parser = argparse.ArgumentParser(description="Сборка и проверка таблицы эфемерид")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="Собрать таблицу")
+    build_parser.add_argument("--path", default=EPHEMERIS_TABLE_PATH)
+    build_parser.add_argument("--start-year", type=int, default=DEFAULT_START_YEAR)
+    build_parser.add_argument("--end-year", type=int, default=DEFAULT_END_YEAR)
+    build_parser.add_argument("--segment-days", type=float, default=DEFAULT_SEGMENT_DAYS)
+    build_parser.add_argument("--degree", type=int, default=DEFAULT_DEGREE)
+
+    validate_parser = subparsers.add_parser("validate", help="Сравнить таблицу со Swiss Ephemeris")
+    validate_parser.add_argument("--path", default=EPHEMERIS_TABLE_PATH)
+    validate_parser.add_argument("--samples", type=int, default=20000)
+    validate_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE_ARCSEC)
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    if args.command == "build":
+        build_ephemeris_table(args.path, args.start_year, args.end_year, args.segment_days, args.degree)
+        return 0
+
+    report = validate_ephemeris_table(EphemerisTable(args.path), args.samples, args.tolerance)
+    for name, errors in report["bodies"].items():
+        print(f"{name:12} долгота {errors['longitude']:8.3f}\"  широта {errors['latitude']:8.3f}\"  "
+              f"скорость {errors['speed']:8.3f}\"/сут")
+    status = "OK" if report["ok"] else "ПРЕВЫШЕН ДОПУСК"
+    print(f"Максимальная ошибка: {report['max_error_arcsec']:.3f}\" (допуск {report['tolerance_arcsec']}\") - {status}")
+    return 0 if report["ok"] else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
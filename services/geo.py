@@ -99,6 +99,18 @@ def get_utc_datetime(date_str, time_str, tz_name):
         logging.error(f"Ошибка в get_utc_datetime: {e}")
         return None
 
+def get_timezone_name(lat, lon):
+    """
+    Определяет временную зону по координатам
+    Возвращает имя зоны (например, 'Europe/Moscow') или 'UTC', если определить не удалось
+    """
+    try:
+        tz_name = tfinder.timezone_at(lng=lon, lat=lat)
+    except Exception as e:
+        logging.error(f"Ошибка определения временной зоны для {lat}, {lon}: {e}")
+        tz_name = None
+    return tz_name or "UTC"
+
 def format_location_info(location_info):
     """
     Форматирует информацию о местоположении для вывода пользователю
@@ -0,0 +1,154 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from config import (
+    HOROSCOPE_DELIVERY_WINDOW_MINUTES,
+    HOROSCOPE_DELIVERY_BATCH_SIZE,
+    HOROSCOPE_DELIVERY_MAX_DELAY_HOURS
+)
+from database import async_operations
+from database.operations import DELIVERY_TIME_FORMAT
+from services.delivery_jobs import delivery_job_queue
+from services.geo import get_timezone_name
+
+logger = logging.getLogger(__name__)
+
+class HoroscopeDeliveryEngine:
+    """
+    Доставка ежедневных гороскопов в заданное пользователем время.
+
+    У каждого пользователя в users.next_delivery_at хранится момент
+    ближайшей доставки в UTC (по местному времени и временной зоне города
+    гороскопа). Движок подгружает по индексу доставки на
+    window_minutes вперед в кучу и спит до ближайшей из них. Когда время
+    наступает, пользователи забираются запросом next_delivery_at <= сейчас
+    (он же переносит их доставку на следующий день и ставит задание в
+    очередь доставок, см. services/delivery_jobs.py), поэтому куча служит
+    только для пробуждения, и устаревшие записи в ней безвредны. Доставки
+    возможны в любую минуту, без проверки всей таблицы на каждый слот.
+    """
+
+    def __init__(self, window_minutes=HOROSCOPE_DELIVERY_WINDOW_MINUTES, batch_size=HOROSCOPE_DELIVERY_BATCH_SIZE,
+                 max_delay_hours=HOROSCOPE_DELIVERY_MAX_DELAY_HOURS):
+        self.window = timedelta(minutes=window_minutes)
+        self.batch_size = batch_size
+        self.max_delay = timedelta(hours=max_delay_hours)
+        self._heap = []  # (время доставки в формате DELIVERY_TIME_FORMAT, user_id)
+        self._loaded_until = None  # Доставки раньше этого момента уже в куче
+        self._wakeup = None
+        self._task = None
+        self._bot = None
+
+    def start(self, bot: Bot):
+        """Запускает движок в текущем event loop"""
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        logger.info("Движок доставки ежедневных гороскопов запущен")
+
+    async def stop(self):
+        """Останавливает движок"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def reschedule(self, user):
+        """
+        Учитывает новое время доставки пользователя
+
+        Вызывается после update_user_horoscope_settings: если новая доставка
+        попадает в уже загруженное окно, она добавляется в кучу.
+        """
+        next_delivery_at = user.get("next_delivery_at") if user else None
+        if not next_delivery_at or self._loaded_until is None:
+            return
+        if next_delivery_at < self._loaded_until.strftime(DELIVERY_TIME_FORMAT):
+            heapq.heappush(self._heap, (next_delivery_at, user["user_id"]))
+            self._wakeup.set()
+
+    async def _run(self):
+        try:
+            scheduled = await async_operations.schedule_missing_horoscope_deliveries(get_timezone_name)
+            if scheduled:
+                logger.info(f"Запланирована доставка гороскопа для {scheduled} пользователей")
+        except Exception as e:
+            logger.error(f"Ошибка планирования доставок гороскопов: {e}")
+
+        self._loaded_until = datetime.utcnow()
+        while True:
+            try:
+                now = datetime.utcnow()
+                await self._deliver_due(now)
+                await self._load(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в движке доставки гороскопов: {e}")
+
+            # Спим до ближайшей доставки или до конца загруженного окна
+            wake_at = self._loaded_until
+            if self._heap:
+                wake_at = min(wake_at, datetime.strptime(self._heap[0][0], DELIVERY_TIME_FORMAT))
+            timeout = max(0.0, (wake_at - datetime.utcnow()).total_seconds())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _load(self, now):
+        """Подгружает доставки следующего окна, когда текущее подходит к концу"""
+        while self._loaded_until <= now + self.window / 2:
+            start = self._loaded_until
+            end = start + self.window
+            deliveries = await async_operations.get_horoscope_deliveries_between(
+                start.strftime(DELIVERY_TIME_FORMAT),
+                end.strftime(DELIVERY_TIME_FORMAT),
+                self.batch_size
+            )
+            for delivery in deliveries:
+                heapq.heappush(self._heap, (delivery["next_delivery_at"], delivery["user_id"]))
+            if len(deliveries) == self.batch_size:
+                # Окно не поместилось в одну выборку, остаток загрузим следующим запросом
+                end = datetime.strptime(deliveries[-1]["next_delivery_at"], DELIVERY_TIME_FORMAT)
+                if end <= start:
+                    end = start + timedelta(seconds=1)
+            self._loaded_until = end
+
+    async def _deliver_due(self, now):
+        """Забирает пользователей, которым пора отправить гороскоп, и ставит доставки в очередь"""
+        now_str = now.strftime(DELIVERY_TIME_FORMAT)
+        while self._heap and self._heap[0][0] <= now_str:
+            heapq.heappop(self._heap)
+
+        while True:
+            # Гороскоп, опоздавший больше чем на max_delay (бот был остановлен), не отправляем
+            result = await async_operations.claim_due_horoscope_deliveries(
+                now, self.batch_size, now - self.max_delay
+            )
+            if result["missed"]:
+                logger.warning(f"Пропущена доставка гороскопа {result['missed']} пользователям из-за простоя")
+            if result["enqueued"]:
+                delivery_job_queue.wake()
+
+            if result["claimed"] < self.batch_size:
+                return
+
+    def get_stats(self):
+        """Возвращает состояние движка"""
+        return {
+            "heap_size": len(self._heap),
+            "next_delivery_at": self._heap[0][0] if self._heap else None,
+            "loaded_until": self._loaded_until.strftime(DELIVERY_TIME_FORMAT) if self._loaded_until else None,
+            "jobs": delivery_job_queue.get_stats()
+        }
+
+# Общий движок доставки для импорта
+horoscope_delivery = HoroscopeDeliveryEngine()
@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from config import (
+    INTERPRETATION_CACHE_TTL_DAYS,
+    INTERPRETATION_CACHE_MEMORY_SIZE,
+    INTERPRETATION_CACHE_MAX_ROWS
+)
+from database import async_operations
+
+logger = logging.getLogger(__name__)
+
+class InterpretationCache:
+    """
+    Кэш интерпретаций натальных карт.
+
+    Интерпретация зависит только от текста карты, модели и версии промпта,
+    поэтому повторный просмотр той же карты не требует запроса к модели.
+    Записи хранятся в таблице interpretation_cache, перед ней стоит LRU в
+    памяти. Устаревшие (старше ttl_days) и лишние записи вытесняются.
+    """
+
+    def __init__(self, ttl_days=INTERPRETATION_CACHE_TTL_DAYS, memory_size=INTERPRETATION_CACHE_MEMORY_SIZE,
+                 max_rows=INTERPRETATION_CACHE_MAX_ROWS):
+        self.ttl_days = ttl_days
+        self.memory_size = memory_size
+        self.max_rows = max_rows
+        self._entries = OrderedDict()  # ключ -> (время сохранения, интерпретация)
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(natal_chart, model, prompt_version):
+        """
+        Вычисляет ключ кэша
+
+        Текст карты приводится к каноническому виду (без концевых пробелов и
+        пустых строк), чтобы косметические отличия не давали промахов.
+        """
+        lines = [line.rstrip() for line in natal_chart.strip().splitlines()]
+        canonical = "\n".join(line for line in lines if line)
+        payload = f"{model}\x00{prompt_version}\x00{canonical}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, interpretation, stored_at):
+        with self._lock:
+            self._entries[key] = (stored_at, interpretation)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.memory_size:
+                self._entries.popitem(last=False)
+
+    async def get(self, key):
+        """Возвращает интерпретацию или None"""
+        ttl_seconds = self.ttl_days * 86400
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, interpretation = entry
+                if time.time() - stored_at < ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.memory_hits += 1
+                    return interpretation
+                del self._entries[key]
+
+        try:
+            row = await async_operations.get_cached_interpretation(key, self.ttl_days)
+        except Exception as e:
+            logger.error(f"Ошибка чтения кэша интерпретаций: {e}")
+            row = None
+
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.db_hits += 1
+        # Запись в памяти истекает одновременно с записью в базе
+        stored_at = datetime.strptime(row["created_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+        self._remember(key, row["interpretation"], stored_at)
+        return row["interpretation"]
+
+    async def set(self, key, interpretation):
+        """Сохраняет интерпретацию в памяти и в базе"""
+        self._remember(key, interpretation, time.time())
+        try:
+            await async_operations.save_cached_interpretation(key, interpretation, self.ttl_days, self.max_rows)
+        except Exception as e:
+            logger.error(f"Ошибка записи в кэш интерпретаций: {e}")
+
+    def get_stats(self):
+        """Возвращает статистику попаданий в кэш с момента запуска"""
+        with self._lock:
+            hits = self.memory_hits + self.db_hits
+            total = hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "db_hits": self.db_hits,
+                "misses": self.misses,
+                "hit_rate": hits / total if total else 0,
+                "memory_size": len(self._entries)
+            }
+
+    def clear_memory(self):
+        """Очищает кэш в памяти и счетчики"""
+        with self._lock:
+            self._entries.clear()
+            self.memory_hits = 0
+            self.db_hits = 0
+            self.misses = 0
+
+# Создаем экземпляр кэша для импорта
+interpretation_cache = InterpretationCache()
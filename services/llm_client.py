@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import time
+
+import aiohttp
+import openai
+
+from config import (
+    OPENAI_API_KEY,
+    OPENAI_MODEL,
+    LLM_MAX_CONCURRENCY,
+    LLM_REQUEST_TIMEOUT,
+    LLM_POOL_SIZE,
+    LLM_KEEPALIVE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+# Устанавливаем API ключ
+openai.api_key = OPENAI_API_KEY
+
+class LLMClient:
+    """
+    Асинхронный клиент OpenAI API.
+
+    Все запросы идут через одну aiohttp-сессию с пулом keep-alive соединений,
+    каждый вызов ограничен таймаутом, а число одновременных генераций -
+    семафором, поэтому долгие ответы модели не блокируют event loop бота.
+    """
+
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, request_timeout=LLM_REQUEST_TIMEOUT,
+                 pool_size=LLM_POOL_SIZE, keepalive_timeout=LLM_KEEPALIVE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session = None
+        self._in_flight = 0
+        self._waiting = 0
+        self._total_requests = 0
+        self._failed_requests = 0
+        self._total_latency = 0.0
+
+    def _get_session(self):
+        """Возвращает общую HTTP-сессию, создавая её при первом обращении"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            logger.info(f"Создана HTTP-сессия OpenAI (пул: {self.pool_size} соединений)")
+        return self._session
+
+    async def chat_completion(self, messages, max_tokens, model=None, timeout=None):
+        """
+        Выполняет запрос ChatCompletion без блокировки event loop
+
+        Args:
+            messages: Список сообщений для модели
+            max_tokens: Максимальное количество токенов ответа
+            model: Модель (по умолчанию OPENAI_MODEL)
+            timeout: Таймаут запроса в секундах (по умолчанию LLM_REQUEST_TIMEOUT)
+
+        Returns:
+            OpenAIObject: Ответ API в том же формате, что и openai.ChatCompletion.create
+        """
+        self._waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self._waiting -= 1
+
+        self._in_flight += 1
+        started = time.monotonic()
+        try:
+            # openai 0.28 берет aiohttp-сессию из ContextVar, иначе создает новую на каждый запрос
+            openai.aiosession.set(self._get_session())
+            response = await openai.ChatCompletion.acreate(
+                model=model or OPENAI_MODEL,
+                messages=messages,
+                max_tokens=max_tokens,
+                request_timeout=timeout or self.request_timeout
+            )
+            return response
+        except Exception:
+            self._failed_requests += 1
+            raise
+        finally:
+            self._in_flight -= 1
+            self._total_requests += 1
+            self._total_latency += time.monotonic() - started
+            self._semaphore.release()
+
+    def stream_chat_completion(self, messages, max_tokens, model=None, timeout=None):
+        """
+        Выполняет потоковый запрос ChatCompletion
+
+        Returns:
+            ChatCompletionStream: Асинхронный итератор по фрагментам текста ответа
+        """
+        return ChatCompletionStream(self, messages, max_tokens, model, timeout)
+
+    def get_stats(self):
+        """Возвращает статистику использования клиента"""
+        avg_latency = self._total_latency / self._total_requests if self._total_requests else 0
+        return {
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "max_concurrency": self.max_concurrency,
+            "total_requests": self._total_requests,
+            "failed_requests": self._failed_requests,
+            "avg_latency": avg_latency
+        }
+
+    async def close(self):
+        """Закрывает HTTP-сессию"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("HTTP-сессия OpenAI закрыта")
+        self._session = None
+
+class ChatCompletionStream:
+    """
+    Потоковый ответ модели.
+
+    Итерация возвращает фрагменты текста по мере их генерации. После
+    завершения в атрибутах text и usage доступны полный ответ и статистика
+    токенов, которую API присылает последним чанком.
+    """
+
+    def __init__(self, client, messages, max_tokens, model=None, timeout=None):
+        self._client = client
+        self._messages = messages
+        self._max_tokens = max_tokens
+        self._model = model
+        self._timeout = timeout
+        self._parts = []
+        self.usage = {}
+
+    @property
+    def text(self):
+        return "".join(self._parts)
+
+    async def __aiter__(self):
+        client = self._client
+        client._waiting += 1
+        try:
+            await client._semaphore.acquire()
+        finally:
+            client._waiting -= 1
+
+        client._in_flight += 1
+        started = time.monotonic()
+        try:
+            openai.aiosession.set(client._get_session())
+            chunks = await openai.ChatCompletion.acreate(
+                model=self._model or OPENAI_MODEL,
+                messages=self._messages,
+                max_tokens=self._max_tokens,
+                request_timeout=self._timeout or client.request_timeout,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            async for chunk in chunks:
+                if chunk.get("usage"):
+                    self.usage = chunk["usage"]
+                for choice in chunk.get("choices", []):
+                    delta = choice.get("delta", {}).get("content")
+                    if delta:
+                        self._parts.append(delta)
+                        yield delta
+        except Exception:
+            client._failed_requests += 1
+            raise
+        finally:
+            client._in_flight -= 1
+            client._total_requests += 1
+            client._total_latency += time.monotonic() - started
+            client._semaphore.release()
+
+# Создаем экземпляр клиента для импорта
+llm_client = LLMClient()
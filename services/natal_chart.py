@@ -0,0 +1,193 @@
+"""
+Двоичное представление натальной карты.
+
+Рядом с текстом из format_natal_chart в базе хранится компактная запись
+карты: заголовок NATAL_CHART_HEADER и массивы float64 (little-endian) -
+долгота, широта и скорость для каждого тела из BODY_NAMES, затем куспиды
+домов, Асцендент и MC в порядке HOUSE_POINT_NAMES. По ней транзиты,
+аспекты и синастрия считаются без повторного расчета по данным рождения.
+
+Заполнение записей для существующих пользователей и контактов:
+    python -m services.natal_chart
+"""
+import logging
+import struct
+
+import numpy as np
+
+from database import operations
+from services.ephemeris import BODY_NAMES, HOUSE_POINT_NAMES, calculate_positions_batch, julian_days
+from services.geo import get_utc_datetime
+
+logger = logging.getLogger(__name__)
+
+NATAL_CHART_MAGIC = b"NCHT"
+NATAL_CHART_VERSION = 1
+
+# magic, версия формата, число тел, число компонент на тело, число точек домов
+NATAL_CHART_HEADER = "<4sHHHH"
+NATAL_CHART_HEADER_SIZE = struct.calcsize(NATAL_CHART_HEADER)
+
+# Компоненты положения тела в записи
+POSITION_COMPONENTS = ("longitude", "latitude", "speed")
+
+class NatalChart:
+    """
+    Натальная карта в виде массивов NumPy.
+
+    positions - массив (len(BODY_NAMES), 3): долгота, широта, скорость по долготе;
+    houses - массив (len(HOUSE_POINT_NAMES),): куспиды 12 домов, Асцендент и MC.
+    """
+
+    __slots__ = ("positions", "houses")
+
+    def __init__(self, positions, houses):
+        self.positions = np.asarray(positions, dtype=np.float64).reshape(len(BODY_NAMES), len(POSITION_COMPONENTS))
+        self.houses = np.asarray(houses, dtype=np.float64).reshape(len(HOUSE_POINT_NAMES))
+
+    @classmethod
+    def from_positions(cls, planets, houses):
+        """
+        Создает карту из словарей calculate_planet_positions_utc и calculate_houses_utc
+        """
+        positions = np.array(
+            [[planets[name]["longitude"], planets[name]["latitude"], planets[name].get("speed", 0.0)]
+             for name in BODY_NAMES],
+            dtype=np.float64
+        )
+        cusps = np.array([houses[name] for name in HOUSE_POINT_NAMES], dtype=np.float64)
+        return cls(positions, cusps)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Восстанавливает карту из двоичной записи"""
+        magic, version, n_bodies, n_components, n_houses = struct.unpack_from(NATAL_CHART_HEADER, data)
+        if magic != NATAL_CHART_MAGIC:
+            raise ValueError("Неизвестный формат записи натальной карты")
+        if version != NATAL_CHART_VERSION:
+            raise ValueError(f"Неподдерживаемая версия записи натальной карты: {version}")
+        if (n_bodies, n_components, n_houses) != (len(BODY_NAMES), len(POSITION_COMPONENTS), len(HOUSE_POINT_NAMES)):
+            raise ValueError("Запись натальной карты не соответствует текущему набору тел")
+
+        values = np.frombuffer(data, dtype="<f8", offset=NATAL_CHART_HEADER_SIZE)
+        split = n_bodies * n_components
+        return cls(values[:split], values[split:split + n_houses])
+
+    def to_bytes(self):
+        """Упаковывает карту в двоичную запись для хранения в базе"""
+        header = struct.pack(NATAL_CHART_HEADER, NATAL_CHART_MAGIC, NATAL_CHART_VERSION,
+                             len(BODY_NAMES), len(POSITION_COMPONENTS), len(HOUSE_POINT_NAMES))
+        return header + self.positions.astype("<f8").tobytes() + self.houses.astype("<f8").tobytes()
+
+    @property
+    def longitudes(self):
+        return self.positions[:, 0]
+
+    @property
+    def latitudes(self):
+        return self.positions[:, 1]
+
+    @property
+    def speeds(self):
+        return self.positions[:, 2]
+
+    @property
+    def cusps(self):
+        return self.houses[:12]
+
+    @property
+    def ascendant(self):
+        return float(self.houses[12])
+
+    @property
+    def mc(self):
+        return float(self.houses[13])
+
+    def to_planets(self):
+        """Возвращает положения в формате словаря calculate_planet_positions_utc"""
+        return {
+            name: {"longitude": float(lon), "latitude": float(lat), "speed": float(speed), "house": None}
+            for name, (lon, lat, speed) in zip(BODY_NAMES, self.positions.tolist())
+        }
+
+    def to_houses(self):
+        """Возвращает дома в формате словаря calculate_houses_utc"""
+        return dict(zip(HOUSE_POINT_NAMES, self.houses.tolist()))
+
+def load_natal_chart(row):
+    """
+    Возвращает NatalChart из строки users или contacts
+
+    Returns:
+        NatalChart или None, если двоичной записи нет или она повреждена
+    """
+    data = row.get("natal_chart_data") if row else None
+    if not data:
+        return None
+    try:
+        return NatalChart.from_bytes(data)
+    except (ValueError, struct.error) as e:
+        logger.error(f"Не удалось прочитать запись натальной карты: {e}")
+        return None
+
+def load_user_natal_chart(user_id):
+    """Загружает натальную карту пользователя"""
+    return load_natal_chart(operations.get_user(user_id))
+
+def load_contact_natal_chart(contact_id):
+    """Загружает натальную карту контакта"""
+    return load_natal_chart(operations.get_contact(contact_id))
+
+def backfill_natal_chart_data(table):
+    """
+    Заполняет двоичные записи карт для строк, сохраненных до их появления
+
+    Карты пересчитываются по данным рождения одним пакетным вызовом.
+
+    Args:
+        table: 'users' или 'contacts'
+
+    Returns:
+        int: Количество заполненных записей
+    """
+    rows = operations.get_rows_without_natal_chart_data(table)
+    if not rows:
+        return 0
+
+    valid_rows = []
+    utc_datetimes = []
+    for row in rows:
+        utc_dt = get_utc_datetime(row["birth_date"], row["birth_time"], row["tz_name"] or "UTC")
+        if utc_dt is None:
+            logger.warning(f"Пропуск {table}/{row['row_id']}: некорректные дата или время рождения")
+            continue
+        valid_rows.append(row)
+        utc_datetimes.append(utc_dt)
+
+    if not valid_rows:
+        return 0
+
+    positions, houses = calculate_positions_batch(
+        julian_days(utc_datetimes),
+        [row["latitude"] for row in valid_rows],
+        [row["longitude"] for row in valid_rows]
+    )
+    records = [
+        (row["row_id"], NatalChart(positions[i], houses[i]).to_bytes())
+        for i, row in enumerate(valid_rows)
+    ]
+    return operations.set_natal_chart_data(table, records)
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    from database.models import init_db
+
+    if not init_db():
+        return 1
+    for table in ("users", "contacts"):
+        count = backfill_natal_chart_data(table)
+        logger.info(f"Заполнено записей натальных карт в {table}: {count}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
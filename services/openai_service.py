@@ -1,15 +1,44 @@
-import openai
 import logging
-from config import OPENAI_API_KEY, OPENAI_MODEL, MAX_TOKENS, COST_PER_1000_TOKENS
-from database import operations
+from config import OPENAI_MODEL, MAX_TOKENS, COST_PER_1000_TOKENS
+from database import async_operations
+from services.llm_client import llm_client
+from services.interpretation_cache import interpretation_cache
 
-# Устанавливаем API ключ
-openai.api_key = OPENAI_API_KEY
+# Версия промпта интерпретации натальной карты: входит в ключ кэша интерпретаций,
+# поэтому при изменении промпта её нужно увеличить
+NATAL_PROMPT_VERSION = 1
 
-async def generate_natal_chart_interpretation(natal_chart, user_id):
+async def _stream_completion(messages, max_tokens, stream_writer):
+    """
+    Получает ответ модели в потоковом режиме, выводя его через stream_writer
+
+    Returns:
+        tuple: (полный текст ответа, статистика токенов)
+    """
+    stream = llm_client.stream_chat_completion(messages=messages, max_tokens=max_tokens)
+    async for delta in stream:
+        await stream_writer.write(delta)
+    await stream_writer.finish()
+    return stream.text, stream.usage
+
+async def generate_natal_chart_interpretation(natal_chart, user_id, stream_writer=None):
     """
     Генерирует интерпретацию натальной карты с помощью OpenAI API
+
+    Если передан stream_writer (TelegramStreamWriter), ответ выводится
+    пользователю по мере генерации. Интерпретации кэшируются по карте,
+    модели и версии промпта, повторный запрос той же карты не обращается к модели.
     """
+    cache_key = interpretation_cache.make_key(natal_chart, OPENAI_MODEL, NATAL_PROMPT_VERSION)
+    cached = await interpretation_cache.get(cache_key)
+    if cached is not None:
+        await async_operations.add_message(user_id, "out", cached)
+        logging.info(f"Интерпретация натальной карты взята из кэша для пользователя {user_id}")
+        if stream_writer:
+            await stream_writer.write(cached)
+            await stream_writer.finish()
+        return cached
+    
     prompt = (
         "Ты профессиональный астролог с многолетним опытом. Проанализируй натальную карту пользователя и дай детальный разбор. "
         "Опиши основные черты личности, сильные стороны, возможные вызовы и рекомендации для развития. "
@@ -17,33 +46,41 @@ async def generate_natal_chart_interpretation(natal_chart, user_id):
         "Данные натальной карты:\n"
     )
     
+    messages = [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": f"Натальная карта:\n{natal_chart}"}
+    ]
+    
     try:
-        response = openai.ChatCompletion.create(
-            model=OPENAI_MODEL,
-            messages=[
-                {"role": "system", "content": prompt},
-                {"role": "user", "content": f"Натальная карта:\n{natal_chart}"}
-            ],
-            max_tokens=MAX_TOKENS
-        )
-        
-        interpretation = response.choices[0].message.content
+        if stream_writer:
+            interpretation, usage = await _stream_completion(messages, MAX_TOKENS, stream_writer)
+        else:
+            response = await llm_client.chat_completion(
+                messages=messages,
+                max_tokens=MAX_TOKENS
+            )
+            interpretation = response.choices[0].message.content
+            usage = response.get("usage", {})
         
         # Сохраняем статистику использования токенов
-        usage = response.get("usage", {})
         input_tokens = usage.get("prompt_tokens", 0)
         output_tokens = usage.get("completion_tokens", 0)
         total_tokens = usage.get("total_tokens", 0)
         cost = total_tokens / 1000 * COST_PER_1000_TOKENS
         
-        operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
-        operations.add_message(user_id, "out", interpretation, output_tokens, cost)
+        await async_operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
+        await async_operations.add_message(user_id, "out", interpretation, output_tokens, cost)
+        
+        await interpretation_cache.set(cache_key, interpretation)
         
         logging.info(f"Интерпретация натальной карты сгенерирована. Токены: {total_tokens}, Стоимость: ${cost:.4f}")
         return interpretation
     except Exception as e:
         logging.error(f"Ошибка при генерации интерпретации натальной карты: {e}")
-        return "Извините, произошла ошибка при анализе вашей натальной карты. Пожалуйста, попробуйте позже."
+        error_text = "Извините, произошла ошибка при анализе вашей натальной карты. Пожалуйста, попробуйте позже."
+        if stream_writer:
+            await stream_writer.finish(error_text)
+        return error_text
 
 async def generate_compatibility_analysis(user_chart, partner_chart, relationship_type, user_id):
     """
@@ -61,8 +98,7 @@ async def generate_compatibility_analysis(user_chart, partner_chart, relationshi
     )
     
     try:
-        response = openai.ChatCompletion.create(
-            model=OPENAI_MODEL,
+        response = await llm_client.chat_completion(
             messages=[{"role": "system", "content": prompt}],
             max_tokens=MAX_TOKENS
         )
@@ -76,8 +112,8 @@ async def generate_compatibility_analysis(user_chart, partner_chart, relationshi
         total_tokens = usage.get("total_tokens", 0)
         cost = total_tokens / 1000 * COST_PER_1000_TOKENS
         
-        operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
-        operations.add_message(user_id, "out", analysis, output_tokens, cost)
+        await async_operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
+        await async_operations.add_message(user_id, "out", analysis, output_tokens, cost)
         
         logging.info(f"Анализ совместимости сгенерирован. Токены: {total_tokens}, Стоимость: ${cost:.4f}")
         return analysis
@@ -85,9 +121,13 @@ async def generate_compatibility_analysis(user_chart, partner_chart, relationshi
         logging.error(f"Ошибка при генерации анализа совместимости: {e}")
         return "Извините, произошла ошибка при анализе совместимости. Пожалуйста, попробуйте позже."
 
-async def generate_daily_horoscope(natal_chart, current_planets, user_id, is_premium=False):
+async def generate_daily_horoscope(natal_chart, current_planets, user_id, is_premium=False, fallback_on_error=True):
     """
     Генерирует ежедневный гороскоп с помощью OpenAI API
+
+    При ошибке возвращается текст с извинением, а если fallback_on_error=False,
+    исключение пробрасывается (для заблаговременной подготовки, где текст
+    ошибки не должен сохраняться как гороскоп).
     """
     prompt = (
         "Ты профессиональный астролог. На основе текущего положения планет и натальной карты пользователя, "
@@ -115,8 +155,7 @@ async def generate_daily_horoscope(natal_chart, current_planets, user_id, is_pre
     )
     
     try:
-        response = openai.ChatCompletion.create(
-            model=OPENAI_MODEL,
+        response = await llm_client.chat_completion(
             messages=[{"role": "system", "content": prompt}],
             max_tokens=MAX_TOKENS if is_premium else MAX_TOKENS // 2  # Для базового гороскопа используем меньше токенов
         )
@@ -130,17 +169,22 @@ async def generate_daily_horoscope(natal_chart, current_planets, user_id, is_pre
         total_tokens = usage.get("total_tokens", 0)
         cost = total_tokens / 1000 * COST_PER_1000_TOKENS
         
-        operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
+        await async_operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
         
         logging.info(f"Ежедневный гороскоп сгенерирован. Токены: {total_tokens}, Стоимость: ${cost:.4f}")
         return horoscope
     except Exception as e:
         logging.error(f"Ошибка при генерации ежедневного гороскопа: {e}")
+        if not fallback_on_error:
+            raise
         return "Извините, произошла ошибка при генерации гороскопа. Пожалуйста, попробуйте позже."
 
-async def generate_monthly_horoscope(natal_chart, forecast_planets, user_id, is_premium=False):
+async def generate_monthly_horoscope(natal_chart, forecast_planets, user_id, is_premium=False, fallback_on_error=True):
     """
     Генерирует месячный гороскоп с помощью OpenAI API
+
+    При ошибке возвращается текст с извинением, а если fallback_on_error=False,
+    исключение пробрасывается (как в generate_daily_horoscope).
     """
     prompt = (
         "Ты профессиональный астролог. На основе положения планет и натальной карты пользователя, "
@@ -167,8 +211,7 @@ async def generate_monthly_horoscope(natal_chart, forecast_planets, user_id, is_
     )
     
     try:
-        response = openai.ChatCompletion.create(
-            model=OPENAI_MODEL,
+        response = await llm_client.chat_completion(
             messages=[{"role": "system", "content": prompt}],
             max_tokens=MAX_TOKENS if is_premium else MAX_TOKENS // 2
         )
@@ -182,17 +225,22 @@ async def generate_monthly_horoscope(natal_chart, forecast_planets, user_id, is_
         total_tokens = usage.get("total_tokens", 0)
         cost = total_tokens / 1000 * COST_PER_1000_TOKENS
         
-        operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
+        await async_operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
         
         logging.info(f"Месячный гороскоп сгенерирован. Токены: {total_tokens}, Стоимость: ${cost:.4f}")
         return horoscope
     except Exception as e:
         logging.error(f"Ошибка при генерации месячного гороскопа: {e}")
+        if not fallback_on_error:
+            raise
         return "Извините, произошла ошибка при генерации гороскопа. Пожалуйста, попробуйте позже."
 
-async def process_user_dialog(user_id, user_message, natal_chart, contacts, message_history):
+async def process_user_dialog(user_id, user_message, natal_chart, contacts, message_history, stream_writer=None):
     """
     Обрабатывает диалог пользователя с учетом контекста
+
+    Если передан stream_writer (TelegramStreamWriter), ответ выводится
+    пользователю по мере генерации.
     """
     # Ищем упоминания контактов в сообщении
     additional_info = ""
@@ -230,29 +278,30 @@ async def process_user_dialog(user_id, user_message, natal_chart, contacts, mess
     
     try:
         # Сохраняем входящее сообщение в базу
-        operations.add_message(user_id, "in", user_message)
+        await async_operations.add_message(user_id, "in", user_message)
         
         # Отправляем запрос к API
-        response = openai.ChatCompletion.create(
-            model=OPENAI_MODEL,
-            messages=messages,
-            max_tokens=MAX_TOKENS
-        )
-        
-        reply = response.choices[0].message.content
+        if stream_writer:
+            reply, usage = await _stream_completion(messages, MAX_TOKENS, stream_writer)
+        else:
+            response = await llm_client.chat_completion(
+                messages=messages,
+                max_tokens=MAX_TOKENS
+            )
+            reply = response.choices[0].message.content
+            usage = response.get("usage", {})
         
         # Сохраняем статистику использования токенов
-        usage = response.get("usage", {})
         input_tokens = usage.get("prompt_tokens", 0)
         output_tokens = usage.get("completion_tokens", 0)
         total_tokens = usage.get("total_tokens", 0)
         cost = total_tokens / 1000 * COST_PER_1000_TOKENS
         
-        operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
-        operations.add_message(user_id, "out", reply, output_tokens, cost)
+        await async_operations.update_user_tokens(user_id, input_tokens, output_tokens, cost)
+        await async_operations.add_message(user_id, "out", reply, output_tokens, cost)
         
         # Уменьшаем счетчик бесплатных сообщений, если пользователь на бесплатном плане
-        operations.decrement_free_messages(user_id)
+        await async_operations.decrement_free_messages(user_id)
         
         logging.info(f"Ответ сгенерирован. Токены: {total_tokens}, Стоимость: ${cost:.4f}")
         
@@ -264,8 +313,11 @@ async def process_user_dialog(user_id, user_message, natal_chart, contacts, mess
         }
     except Exception as e:
         logging.error(f"Ошибка при обработке диалога: {e}")
+        error_text = "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже."
+        if stream_writer:
+            await stream_writer.finish(error_text)
         return {
-            "reply": "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, попробуйте позже.",
+            "reply": error_text,
             "mentioned_contacts": [],
             "tokens": 0,
             "cost": 0
@@ -5,7 +5,7 @@ import uuid
 import time
 import random
 from datetime import datetime, timedelta
-from database import operations
+from database import async_operations
 from config import SUBSCRIPTION_PRICES, TG_STARS_MULTIPLIER
 from aiogram.exceptions import TelegramAPIError
 
@@ -42,7 +42,7 @@ async def create_payment(user_id, plan, payment_method, bot=None):
             stars_amount = int(price * TG_STARS_MULTIPLIER)
             
             # Создаем запись о транзакции в базе данных со статусом "pending"
-            transaction_id = operations.add_subscription_transaction(
+            transaction_id = await async_operations.add_subscription_transaction(
                 user_id,
                 plan,
                 price,
@@ -155,11 +155,11 @@ class TelegramStarsPayment:
                 
             # Обновляем статус транзакции, если ID указан
             if transaction_id:
-                success = operations.update_transaction_status(transaction_id, "completed")
+                success = await async_operations.update_transaction_status(transaction_id, "completed")
                 
                 if success:
                     # Активируем подписку пользователю
-                    operations.update_user_subscription(user_id, plan, months)
+                    await async_operations.update_user_subscription(user_id, plan, months)
                     
                     return {
                         "success": True,
@@ -173,7 +173,7 @@ class TelegramStarsPayment:
             else:
                 # Если ID транзакции не указан, создаем новую транзакцию
                 price = SUBSCRIPTION_PRICES.get(plan, 0)
-                transaction_id = operations.add_subscription_transaction(
+                transaction_id = await async_operations.add_subscription_transaction(
                     user_id,
                     plan,
                     price,
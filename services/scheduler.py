@@ -1,39 +1,76 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
+import hashlib
 import logging
 
 from aiogram import Bot
-from database import operations
-from services.ephemeris import calculate_planet_positions_utc, calculate_houses_utc, format_natal_chart
+from config import (
+    HOROSCOPE_PREGENERATION_TIME,
+    HOROSCOPE_PREGENERATION_PAGE_SIZE,
+    DELIVERY_JOB_RETENTION_DAYS,
+    MESSAGE_RETENTION_DAYS,
+    MESSAGE_ARCHIVE_BATCH_SIZE,
+    MESSAGE_ARCHIVE_VACUUM_PAGES,
+    MONTHLY_ROLLOUT_WINDOW_HOURS,
+    MONTHLY_ROLLOUT_CONCURRENCY,
+    MONTHLY_ROLLOUT_PAGE_SIZE
+)
+from database import async_operations
+from services.delivery import DeliveryPipeline, delivery_pipeline
+from utils.date_parser import local_time_to_utc, utc_to_local
+from services.subscription_expiry import remind_expiring_subscriptions
+from services.ephemeris import calculate_transit_positions, format_natal_chart, transit_cache
 from services.openai_service import generate_daily_horoscope, generate_monthly_horoscope
 
 logger = logging.getLogger(__name__)
 
+# Месячные гороскопы длиннее и дороже ежедневных, поэтому генерируются с меньшим параллелизмом
+monthly_pipeline = DeliveryPipeline(llm_concurrency=MONTHLY_ROLLOUT_CONCURRENCY)
+
 def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
     """Настраивает и возвращает планировщик для отправки гороскопов"""
     scheduler = AsyncIOScheduler()
     
-    # Добавляем задачи для отправки гороскопов в каждый час
-    for hour in range(24):
-        for minute in [0, 30]:  # Проверяем каждые 30 минут
-            time_str = f"{hour:02d}:{minute:02d}"
-            scheduler.add_job(
-                send_daily_horoscopes,
-                CronTrigger(hour=hour, minute=minute),
-                kwargs={"bot": bot, "time_str": time_str}
-            )
+    # Ежедневные гороскопы отправляет services/horoscope_delivery.py по времени каждого пользователя
     
-    # Добавляем задачу для отправки месячных гороскопов (последний день месяца в 12:00)
+    # Заблаговременная подготовка гороскопов на завтра в часы низкой нагрузки
+    pregeneration_hour, pregeneration_minute = map(int, HOROSCOPE_PREGENERATION_TIME.split(":"))
     scheduler.add_job(
-        send_monthly_horoscopes,
-        CronTrigger(day="last", hour=12, minute=0),
-        kwargs={"bot": bot}
+        pregenerate_daily_horoscopes,
+        CronTrigger(hour=pregeneration_hour, minute=pregeneration_minute)
+    )
+    
+    # Месячные гороскопы распределяются по окну в конце месяца; планирование проверяется
+    # ежечасно и продолжается с сохраненного курсора, если было прервано
+    scheduler.add_job(
+        plan_monthly_rollout,
+        CronTrigger(minute=5)
+    )
+    
+    # Сверка счетчиков статистики и снимок за прошедший день (в 00:05)
+    scheduler.add_job(
+        reconcile_stats,
+        CronTrigger(hour=0, minute=5)
+    )
+    
+    # Очистка завершенных заданий очереди доставок (в 00:45)
+    scheduler.add_job(
+        cleanup_delivery_jobs,
+        CronTrigger(hour=0, minute=45)
+    )
+    
+    # Перенос старых сообщений в сжатый архив после подготовки гороскопов (в 04:30)
+    scheduler.add_job(
+        archive_old_messages,
+        CronTrigger(hour=4, minute=30)
     )
     
-    # Планируем ежедневную проверку истекших подписок (в 00:30)
+    # Ежедневное напоминание о скором окончании подписки (в 00:30). Истекшие подписки
+    # переводит на бесплатный план services/subscription_expiry.py в момент окончания
     scheduler.add_job(
-        check_expired_subscriptions,
+        remind_expiring_subscriptions,
         CronTrigger(hour=0, minute=30),
         kwargs={"bot": bot}
     )
@@ -41,220 +78,438 @@ def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
     logger.info("Планировщик гороскопов и проверки подписок настроен")
     return scheduler
 
-async def send_daily_horoscopes(bot: Bot, time_str: str):
-    """Отправляет ежедневные гороскопы пользователям, у которых настроена доставка на указанное время"""
+def horoscope_settings_hash(user):
+    """
+    Отпечаток настроек, от которых зависит текст ежедневного гороскопа
+
+    Если пользователь изменил натальную карту, город, время доставки или
+    тариф после подготовки гороскопа, отпечатки не совпадут и гороскоп
+    будет сгенерирован заново.
+    """
+    payload = "\x00".join([
+        user.get("natal_chart") or "",
+        f"{user.get('horoscope_latitude') or 0:.4f}",
+        f"{user.get('horoscope_longitude') or 0:.4f}",
+        user.get("horoscope_time") or "",
+        user.get("horoscope_tz_name") or "",
+        "premium" if user.get("subscription_type") != "free" else "free"
+    ])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def _render_daily_horoscope(user, moment, fallback_on_error=True):
+    """
+    Генерирует ежедневный гороскоп пользователя для транзитов на момент moment
+
+    Returns:
+        str: Текст гороскопа или None, если у пользователя не хватает данных
+    """
+    user_id = user["user_id"]
+    
+    # Проверяем наличие натальной карты и координат
+    natal_chart = user.get("natal_chart")
+    if not natal_chart:
+        logger.warning(f"У пользователя {user_id} нет натальной карты")
+        return None
+    
+    lat = user.get("horoscope_latitude")
+    lon = user.get("horoscope_longitude")
+    if not lat or not lon:
+        logger.warning(f"У пользователя {user_id} не указаны координаты для гороскопа")
+        return None
+    
+    # Положение планет общее для всего слота, дома рассчитываются для места пользователя
+    planets, houses = calculate_transit_positions(moment, lat, lon)
+    
+    if not planets or not houses:
+        logger.error(f"Ошибка расчёта положения планет для пользователя {user_id}")
+        return None
+    
+    formatted_planets = format_natal_chart(planets, houses)
+    
+    # Определяем, является ли пользователь премиум-подписчиком
+    is_premium = user.get("subscription_type") != "free"
+    
+    return await generate_daily_horoscope(
+        natal_chart,
+        formatted_planets,
+        user_id,
+        is_premium,
+        fallback_on_error=fallback_on_error
+    )
+
+async def pregenerate_daily_horoscopes(target_date=None):
+    """
+    Заранее готовит ежедневные гороскопы на target_date (по умолчанию на завтра по UTC)
+
+    target_date - местная дата пользователя: гороскоп готовится на доставку
+    в его время horoscope_time этой даты в зоне horoscope_tz_name.
+
+    Гороскопы сохраняются со статусом pending_delivery и отправляются
+    send_daily_horoscopes в слот пользователя без обращения к модели.
+    Пользователи, для которых уже подготовлен гороскоп с актуальными
+    настройками, пропускаются.
+    """
     try:
-        logger.info(f"Начинаем отправку ежедневных гороскопов на время {time_str}")
+        if target_date is None:
+            target_date = datetime.utcnow().date() + timedelta(days=1)
+        target_date_str = target_date.isoformat()
+        logger.info(f"Начинаем подготовку ежедневных гороскопов на {target_date_str}")
+        
+        # Неотправленные гороскопы на прошедшие даты больше не понадобятся. Местная дата
+        # может отставать от даты UTC на сутки, поэтому вчерашние пока остаются
+        expired = await async_operations.delete_expired_pending_horoscopes(
+            (datetime.utcnow().date() - timedelta(days=1)).isoformat()
+        )
+        if expired:
+            logger.info(f"Удалено неотправленных подготовленных гороскопов: {expired}")
         
-        # Получаем пользователей, которые должны получить гороскоп в это время
-        users = operations.get_users_with_horoscope_at_time(time_str)
+        async def generate(user):
+            # Транзиты рассчитываются на время доставки пользователю
+            moment = local_time_to_utc(target_date, user["horoscope_time"], user.get("horoscope_tz_name"))
+            
+            horoscope_text = await _render_daily_horoscope(user, moment, fallback_on_error=False)
+            if horoscope_text is None:
+                return None
+            
+            await async_operations.save_pending_horoscope(
+                user["user_id"],
+                horoscope_text,
+                target_date_str,
+                horoscope_settings_hash(user)
+            )
+            return horoscope_text
+        
+        # Пользователи читаются страницами, чтобы не держать в памяти всю таблицу
+        cursor = None
+        prepared = 0
+        while True:
+            page = await async_operations.get_users_for_horoscope_pregeneration(
+                target_date_str, cursor, HOROSCOPE_PREGENERATION_PAGE_SIZE
+            )
+            if not page:
+                break
+            cursor = page[-1]["user_id"]
+            
+            users = [user for user in page if user["pending_settings_hash"] != horoscope_settings_hash(user)]
+            if users:
+                report = await delivery_pipeline.run(f"pregenerate {target_date_str}", users, generate)
+                prepared += report["delivered"]
+        
+        logger.info(f"Подготовлено гороскопов на {target_date_str}: {prepared}")
+    except Exception as e:
+        logger.error(f"Ошибка в функции pregenerate_daily_horoscopes: {e}")
+
+async def send_daily_horoscopes(bot: Bot, users, now=None, on_result=None):
+    """
+    Отправляет ежедневные гороскопы пользователям, для которых наступило время доставки
+
+    now - запланированный момент доставки (наивное время UTC). Используются
+    гороскопы, подготовленные pregenerate_daily_horoscopes на местную дату
+    пользователя. Если подготовленного гороскопа нет или он устарел
+    (пользователь изменил настройки), гороскоп генерируется на месте и тоже
+    сохраняется как подготовленный до отправки, чтобы повтор доставки после
+    ошибки не обращался к модели снова. on_result передается в конвейер
+    (см. DeliveryPipeline.run). Ошибка вне конвейера пробрасывается вызывающему.
+    """
+    try:
         if not users:
-            logger.info(f"Нет пользователей для отправки гороскопа на время {time_str}")
             return
         
-        logger.info(f"Найдено {len(users)} пользователей для отправки гороскопа на время {time_str}")
+        now = now or datetime.utcnow()
+        logger.info(f"Начинаем отправку ежедневных гороскопов {len(users)} пользователям")
+        
+        # Местная дата пользователя: для заголовка и поиска подготовленного гороскопа
+        local_dates = {
+            user["user_id"]: utc_to_local(now, user.get("horoscope_tz_name")).date()
+            for user in users
+        }
         
-        # Текущая дата для заголовка гороскопа
-        today = datetime.now().strftime("%d.%m.%Y")
+        pending = {
+            (horoscope["user_id"], horoscope["target_date"]): horoscope
+            for horoscope in await async_operations.get_pending_horoscopes([user["user_id"] for user in users])
+        }
+        sources = {"pregenerated": 0, "on_demand": 0}
         
-        # Отправляем гороскоп каждому пользователю
-        for user in users:
+        async def generate(user):
             user_id = user["user_id"]
+            key = (user_id, local_dates[user_id].isoformat())
             
-            try:
-                # Проверяем наличие натальной карты и координат
-                natal_chart = user.get("natal_chart")
-                if not natal_chart:
-                    logger.warning(f"У пользователя {user_id} нет натальной карты")
-                    continue
-                
-                lat = user.get("horoscope_latitude")
-                lon = user.get("horoscope_longitude")
-                if not lat or not lon:
-                    logger.warning(f"У пользователя {user_id} не указаны координаты для гороскопа")
-                    continue
-                
-                # Рассчитываем текущее положение планет
-                now = datetime.now()
-                planets = calculate_planet_positions_utc(now, lat, lon)
-                houses = calculate_houses_utc(now, lat, lon)
-                
-                if not planets or not houses:
-                    logger.error(f"Ошибка расчёта положения планет для пользователя {user_id}")
-                    continue
+            prepared = pending.get(key)
+            if prepared is not None:
+                if prepared["settings_hash"] == horoscope_settings_hash(user):
+                    sources["pregenerated"] += 1
+                    return prepared["horoscope_text"]
                 
-                formatted_planets = format_natal_chart(planets, houses)
-                
-                # Определяем, является ли пользователь премиум-подписчиком
-                is_premium = user.get("subscription_type") != "free"
-                
-                # Генерируем гороскоп
-                horoscope_text = await generate_daily_horoscope(
-                    natal_chart,
-                    formatted_planets,
-                    user_id,
-                    is_premium
-                )
-                
-                # Сохраняем гороскоп в базу
-                operations.add_horoscope(user_id, horoscope_text)
-                
-                # Отправляем гороскоп
-                await bot.send_message(
-                    user_id,
-                    f"🌟 Ваш персональный гороскоп на {today}:\n\n{horoscope_text}"
-                )
-                
-                logger.info(f"Отправлен ежедневный гороскоп пользователю {user_id}")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке гороскопа пользователю {user_id}: {e}")
+                logger.info(f"Подготовленный гороскоп пользователя {user_id} устарел, генерируем заново")
+                del pending[key]
+                await async_operations.delete_pending_horoscope(prepared["horoscope_id"])
+            
+            # Ошибка модели передается конвейеру (доставка будет повторена), а не сохраняется как гороскоп
+            horoscope_text = await _render_daily_horoscope(user, now, fallback_on_error=False)
+            if horoscope_text is None:
+                return None
+            
+            # Сохраняем гороскоп в базу, отправленным он будет отмечен после доставки
+            settings_hash = horoscope_settings_hash(user)
+            horoscope_id = await async_operations.save_pending_horoscope(
+                user_id, horoscope_text, key[1], settings_hash
+            )
+            pending[key] = {"horoscope_id": horoscope_id, "settings_hash": settings_hash}
+            sources["on_demand"] += 1
+            return horoscope_text
+        
+        async def send(user, horoscope_text):
+            local_date = local_dates[user["user_id"]]
+            await bot.send_message(
+                user["user_id"],
+                f"🌟 Ваш персональный гороскоп на {local_date.strftime('%d.%m.%Y')}:\n\n{horoscope_text}"
+            )
+            
+            prepared = pending.get((user["user_id"], local_date.isoformat()))
+            if prepared is not None:
+                await async_operations.mark_horoscope_delivered(prepared["horoscope_id"])
+            logger.info(f"Отправлен ежедневный гороскоп пользователю {user['user_id']}")
         
-        logger.info(f"Завершена отправка ежедневных гороскопов на время {time_str}")
+        # Пользователи обрабатываются параллельно с ограничением на генерации и отправки
+        await delivery_pipeline.run(f"daily {now.strftime('%H:%M')} UTC", users, generate, send, on_result)
+        
+        logger.info(
+            f"Завершена отправка ежедневных гороскопов на {now.strftime('%H:%M')} UTC. "
+            f"Подготовленных: {sources['pregenerated']}, сгенерировано на месте: {sources['on_demand']}. "
+            f"Кэш транзитов: {transit_cache.get_stats()}"
+        )
     except Exception as e:
         logger.error(f"Ошибка в функции send_daily_horoscopes: {e}")
+        # Пользователи без результата доставки будут повторены по правилам очереди
+        raise
+
+MONTH_NAMES = {
+    1: "январь", 2: "февраль", 3: "март", 4: "апрель",
+    5: "май", 6: "июнь", 7: "июль", 8: "август",
+    9: "сентябрь", 10: "октябрь", 11: "ноябрь", 12: "декабрь"
+}
+
+def _next_month(moment):
+    """Год и номер месяца, следующего за moment"""
+    if moment.month == 12:
+        return moment.year + 1, 1
+    return moment.year, moment.month + 1
+
+def monthly_rollout_window(now, window_hours=MONTHLY_ROLLOUT_WINDOW_HOURS):
+    """
+    Окно рассылки месячного гороскопа на месяц, следующий за now
 
-async def send_monthly_horoscopes(bot: Bot):
-    """Отправляет месячные гороскопы всем пользователям с подпиской"""
+    Returns:
+        tuple: (месяц гороскопа "YYYY-MM", начало окна, конец окна - полночь UTC 1-го числа)
+    """
+    year, month = _next_month(now)
+    window_end = datetime(year, month, 1)
+    return f"{year}-{month:02d}", window_end - timedelta(hours=window_hours), window_end
+
+def _rollout_offset(user_id, target_month):
+    """Детерминированная доля окна (0..1) для пользователя: одна и та же при повторном планировании"""
+    digest = hashlib.sha256(f"{user_id}:{target_month}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+async def plan_monthly_rollout(now=None):
+    """
+    Ставит в очередь доставок месячные гороскопы пользователям с подпиской
+
+    Доставка каждого пользователя назначается в момент окна
+    MONTHLY_ROLLOUT_WINDOW_HOURS до конца месяца, определяемый хешем его id,
+    поэтому генерации и отправки распределены по окну, а не приходятся на
+    одну минуту. Пользователи обходятся страницами, курсор сохраняется
+    в scheduler_state вместе с заданиями страницы: прерванное планирование
+    продолжается со следующей страницы. Если планирование началось с
+    опозданием, оставшиеся доставки распределяются по остатку окна.
+    """
     try:
-        logger.info("Начинаем отправку месячных гороскопов")
+        now = now or datetime.utcnow()
+        target_month, window_start, window_end = monthly_rollout_window(now)
+        if now < window_start:
+            return
         
-        # Получаем всех пользователей с активной подпиской
-        users = operations.get_all_users()
-        if not users:
-            logger.info("Нет пользователей для отправки месячного гороскопа")
+        state_name = f"monthly_rollout:{target_month}"
+        cursor = await async_operations.get_scheduler_state(state_name)
+        if cursor == "done":
             return
         
-        # Следующий месяц для заголовка гороскопа
-        now = datetime.now()
-        next_month = now.month + 1 if now.month < 12 else 1
-        next_month_year = now.year if now.month < 12 else now.year + 1
-        next_month_name = {
-            1: "январь", 2: "февраль", 3: "март", 4: "апрель",
-            5: "май", 6: "июнь", 7: "июль", 8: "август",
-            9: "сентябрь", 10: "октябрь", 11: "ноябрь", 12: "декабрь"
-        }[next_month]
+        logger.info(f"Планирование месячных гороскопов на {target_month} (курсор: {cursor or 'начало'})")
         
-        # Отправляем гороскоп пользователям с подпиской
-        for user in users:
-            user_id = user["user_id"]
-            
-            # Отправляем месячный гороскоп только пользователям с подпиской
-            if user.get("subscription_type") == "free":
-                continue
+        spread_start = max(window_start, now)
+        spread = (window_end - spread_start).total_seconds()
+        enqueued = 0
+        while True:
+            user_ids = await async_operations.get_paid_user_ids_after(cursor, MONTHLY_ROLLOUT_PAGE_SIZE)
+            if not user_ids:
+                break
             
-            try:
-                # Проверяем наличие натальной карты и координат
-                natal_chart = user.get("natal_chart")
-                if not natal_chart:
-                    logger.warning(f"У пользователя {user_id} нет натальной карты")
-                    continue
-                
-                lat = user.get("horoscope_latitude") or user.get("latitude")
-                lon = user.get("horoscope_longitude") or user.get("longitude")
-                if not lat or not lon:
-                    logger.warning(f"У пользователя {user_id} не указаны координаты для гороскопа")
-                    continue
-                
-                # Рассчитываем положение планет на 1-е число следующего месяца
-                forecast_date = datetime(next_month_year, next_month, 1, 12, 0)
-                planets = calculate_planet_positions_utc(forecast_date, lat, lon)
-                houses = calculate_houses_utc(forecast_date, lat, lon)
-                
-                if not planets or not houses:
-                    logger.error(f"Ошибка расчёта положения планет для пользователя {user_id}")
-                    continue
-                
-                formatted_planets = format_natal_chart(planets, houses)
-                
-                # Генерируем месячный гороскоп
-                horoscope_text = await generate_monthly_horoscope(
-                    natal_chart,
-                    formatted_planets,
-                    user_id,
-                    is_premium=True
-                )
-                
-                # Сохраняем гороскоп в базу
-                operations.add_horoscope(user_id, horoscope_text, "monthly")
-                
-                # Отправляем гороскоп
-                await bot.send_message(
+            jobs = [
+                (
                     user_id,
-                    f"🌙 Ваш персональный гороскоп на {next_month_name} {next_month_year}:\n\n{horoscope_text}"
+                    spread_start + timedelta(seconds=int(_rollout_offset(user_id, target_month) * spread))
                 )
-                
-                logger.info(f"Отправлен месячный гороскоп пользователю {user_id}")
-            except Exception as e:
-                logger.error(f"Ошибка при отправке месячного гороскопа пользователю {user_id}: {e}")
+                for user_id in user_ids
+            ]
+            cursor = user_ids[-1]
+            enqueued += await async_operations.enqueue_delivery_jobs(
+                "monthly", target_month, jobs, (state_name, cursor)
+            )
         
-        logger.info("Завершена отправка месячных гороскопов")
+        await async_operations.set_scheduler_state(state_name, "done")
+        logger.info(
+            f"Месячный гороскоп на {target_month} поставлен в очередь для {enqueued} пользователей "
+            f"с {spread_start.strftime('%d.%m %H:%M')} до {window_end.strftime('%d.%m %H:%M')} UTC"
+        )
     except Exception as e:
-        logger.error(f"Ошибка в функции send_monthly_horoscopes: {e}")
+        logger.error(f"Ошибка в функции plan_monthly_rollout: {e}")
 
-async def check_expired_subscriptions(bot: Bot):
-    """Проверяет истекшие подписки и отправляет уведомления пользователям"""
+async def send_monthly_horoscopes(bot: Bot, users, now=None, on_result=None):
+    """
+    Отправляет месячные гороскопы на месяц, следующий за now
+
+    Как и ежедневный, гороскоп сохраняется неотправленным до доставки и
+    используется повторно, если доставка повторяется после ошибки.
+    """
     try:
-        logger.info("Начинаем проверку истекших подписок")
-        
-        # Получаем всех пользователей
-        users = operations.get_all_users()
         if not users:
-            logger.info("Нет пользователей для проверки подписок")
             return
         
-        now = datetime.now()
+        logger.info(f"Начинаем отправку месячных гороскопов {len(users)} пользователям")
+        
+        # Следующий месяц для заголовка гороскопа
+        next_month_year, next_month = _next_month(now or datetime.utcnow())
+        next_month_name = MONTH_NAMES[next_month]
+        target_month = f"{next_month_year}-{next_month:02d}"
+        
+        # Положение планет на 1-е число следующего месяца
+        forecast_date = datetime(next_month_year, next_month, 1, 12, 0)
         
-        # Проверяем подписки, которые истекают скоро или уже истекли
-        for user in users:
+        pending = {
+            horoscope["user_id"]: horoscope
+            for horoscope in await async_operations.get_pending_horoscopes(
+                [user["user_id"] for user in users], "monthly"
+            )
+            if horoscope["target_date"] == target_month
+        }
+        
+        async def generate(user):
             user_id = user["user_id"]
             
-            # Пропускаем пользователей с бесплатным планом
-            if user.get("subscription_type") == "free":
-                continue
+            prepared = pending.get(user_id)
+            if prepared is not None:
+                if prepared["settings_hash"] == horoscope_settings_hash(user):
+                    return prepared["horoscope_text"]
+                del pending[user_id]
+                await async_operations.delete_pending_horoscope(prepared["horoscope_id"])
             
-            # Проверяем дату окончания подписки
-            if user.get("subscription_end_date"):
-                end_date = datetime.fromisoformat(user.get("subscription_end_date"))
-                days_left = (end_date - now).days
-                
-                # Если подписка истекает в течение 3 дней или уже истекла
-                if 0 <= days_left <= 3:
-                    # Отправляем уведомление о скором истечении подписки
-                    await bot.send_message(
-                        user_id,
-                        f"⚠️ Ваша Premium подписка истекает через {days_left} дней.\n\n"
-                        "Не забудьте продлить её, чтобы продолжить пользоваться всеми преимуществами!",
-                        reply_markup=bot.types.InlineKeyboardMarkup(
-                            inline_keyboard=[
-                                [bot.types.InlineKeyboardButton(
-                                    text="🔄 Продлить подписку", 
-                                    callback_data="subscribe_menu"
-                                )]
-                            ]
-                        )
-                    )
-                    logger.info(f"Отправлено уведомление о скором истечении подписки пользователю {user_id}")
-                elif days_left < 0:
-                    # Подписка истекла, обновляем статус
-                    operations.update_user_subscription(user_id, "free")
-                    
-                    # Отправляем уведомление об истечении подписки
-                    await bot.send_message(
-                        user_id,
-                        "⚠️ Ваша Premium подписка истекла.\n\n"
-                        "Вы переведены на бесплатный план. Для продолжения использования всех функций "
-                        "бота, пожалуйста, обновите подписку.",
-                        reply_markup=bot.types.InlineKeyboardMarkup(
-                            inline_keyboard=[
-                                [bot.types.InlineKeyboardButton(
-                                    text="💎 Обновить Premium", 
-                                    callback_data="subscribe_menu"
-                                )]
-                            ]
-                        )
-                    )
-                    logger.info(f"Отправлено уведомление об истечении подписки пользователю {user_id}")
+            # Проверяем наличие натальной карты и координат
+            natal_chart = user.get("natal_chart")
+            if not natal_chart:
+                logger.warning(f"У пользователя {user_id} нет натальной карты")
+                return None
+            
+            lat = user.get("horoscope_latitude") or user.get("latitude")
+            lon = user.get("horoscope_longitude") or user.get("longitude")
+            if not lat or not lon:
+                logger.warning(f"У пользователя {user_id} не указаны координаты для гороскопа")
+                return None
+            
+            planets, houses = calculate_transit_positions(forecast_date, lat, lon)
+            
+            if not planets or not houses:
+                logger.error(f"Ошибка расчёта положения планет для пользователя {user_id}")
+                return None
+            
+            formatted_planets = format_natal_chart(planets, houses)
+            
+            # Генерируем месячный гороскоп; ошибка модели передается конвейеру, и задание
+            # доставки будет повторено, а не отмечено выполненным с текстом ошибки
+            horoscope_text = await generate_monthly_horoscope(
+                natal_chart,
+                formatted_planets,
+                user_id,
+                is_premium=True,
+                fallback_on_error=False
+            )
+            
+            # Сохраняем гороскоп в базу, отправленным он будет отмечен после доставки
+            settings_hash = horoscope_settings_hash(user)
+            horoscope_id = await async_operations.save_pending_horoscope(
+                user_id, horoscope_text, target_month, settings_hash, "monthly"
+            )
+            pending[user_id] = {"horoscope_id": horoscope_id, "settings_hash": settings_hash}
+            return horoscope_text
+        
+        async def send(user, horoscope_text):
+            await bot.send_message(
+                user["user_id"],
+                f"🌙 Ваш персональный гороскоп на {next_month_name} {next_month_year}:\n\n{horoscope_text}"
+            )
+            
+            prepared = pending.get(user["user_id"])
+            if prepared is not None:
+                await async_operations.mark_horoscope_delivered(prepared["horoscope_id"])
+            logger.info(f"Отправлен месячный гороскоп пользователю {user['user_id']}")
+        
+        await monthly_pipeline.run(f"monthly {target_month}", users, generate, send, on_result)
+        
+        logger.info("Завершена отправка месячных гороскопов")
+    except Exception as e:
+        logger.error(f"Ошибка в функции send_monthly_horoscopes: {e}")
+        # Пользователи без результата доставки будут повторены по правилам очереди
+        raise
+
+async def cleanup_delivery_jobs():
+    """Удаляет завершенные задания очереди доставок старше DELIVERY_JOB_RETENTION_DAYS дней"""
+    try:
+        deleted = await async_operations.delete_finished_delivery_jobs(
+            datetime.utcnow() - timedelta(days=DELIVERY_JOB_RETENTION_DAYS)
+        )
+        if deleted:
+            logger.info(f"Удалено завершенных заданий доставки: {deleted}")
+    except Exception as e:
+        logger.error(f"Ошибка в функции cleanup_delivery_jobs: {e}")
+
+async def reconcile_stats():
+    """Исправляет расхождения счетчиков статистики и сохраняет их снимок за вчерашний день"""
+    try:
+        drift = await async_operations.reconcile_stats_counters()
+        for name, (stored, actual) in drift.items():
+            logger.warning(f"Счетчик статистики {name} расходился с данными: {stored} вместо {actual}")
+        
+        await async_operations.rollup_daily_stats((datetime.now().date() - timedelta(days=1)).isoformat())
+        logger.info("Счетчики статистики сверены")
+    except Exception as e:
+        logger.error(f"Ошибка в функции reconcile_stats: {e}")
+
+async def archive_old_messages():
+    """
+    Переносит сообщения старше MESSAGE_RETENTION_DAYS дней в сжатый архив
+
+    Каждая порция - отдельная короткая транзакция, между порциями запись
+    доступна обработчикам. Освободившиеся страницы возвращаются системе
+    через incremental_vacuum, тоже небольшими шагами.
+    """
+    try:
+        before = datetime.utcnow() - timedelta(days=MESSAGE_RETENTION_DAYS)
+        archived = 0
+        while True:
+            count = await async_operations.archive_old_messages(before, MESSAGE_ARCHIVE_BATCH_SIZE)
+            archived += count
+            if count < MESSAGE_ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(0.1)
+        
+        free_pages = await async_operations.incremental_vacuum(MESSAGE_ARCHIVE_VACUUM_PAGES)
+        while free_pages:
+            await asyncio.sleep(0.1)
+            remaining = await async_operations.incremental_vacuum(MESSAGE_ARCHIVE_VACUUM_PAGES)
+            if remaining >= free_pages:
+                break
+            free_pages = remaining
         
-        logger.info("Завершена проверка истекших подписок")
+        if archived:
+            logger.info(f"Перенесено в архив сообщений: {archived}")
     except Exception as e:
-        logger.error(f"Ошибка в функции check_expired_subscriptions: {e}")
\ No newline at end of file
+        logger.error(f"Ошибка в функции archive_old_messages: {e}")
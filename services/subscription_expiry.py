@@ -0,0 +1,152 @@
+import asyncio
+import heapq
+import logging
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+from config import SUBSCRIPTION_EXPIRY_WINDOW_HOURS, SUBSCRIPTION_EXPIRY_BATCH_SIZE
+from database import async_operations
+from middleware.rate_limit import bulk_priority
+
+logger = logging.getLogger(__name__)
+
+def _renewal_keyboard(text):
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text=text, callback_data="subscribe_menu")]]
+    )
+
+class SubscriptionExpiryTracker:
+    """
+    Перевод истекших подписок на бесплатный план в момент окончания.
+
+    Окончания платных подписок на window_hours вперед подгружаются по
+    индексу idx_users_subscription_end_date в кучу, и трекер спит до
+    ближайшего из них. Когда время наступает, подписки переводятся одним
+    запросом subscription_end_date <= сейчас, поэтому продление подписки
+    после загрузки в кучу безвредно: устаревшая запись ничего не изменит.
+    При запуске сразу обрабатываются подписки, истекшие во время простоя.
+    """
+
+    def __init__(self, window_hours=SUBSCRIPTION_EXPIRY_WINDOW_HOURS, batch_size=SUBSCRIPTION_EXPIRY_BATCH_SIZE):
+        self.window = timedelta(hours=window_hours)
+        self.batch_size = batch_size
+        self._heap = []  # (subscription_end_date, user_id)
+        self._loaded_until = None
+        self._task = None
+        self._bot = None
+        self.expired = 0
+
+    def start(self, bot: Bot):
+        """Запускает трекер в текущем event loop"""
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+        logger.info("Трекер окончания подписок запущен")
+
+    async def stop(self):
+        """Останавливает трекер"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                now = datetime.now()
+                await self._expire_due(now)
+                await self._load(now)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в трекере окончания подписок: {e}")
+
+            wake_at = self._loaded_until or datetime.now() + self.window
+            if self._heap:
+                wake_at = min(wake_at, datetime.fromisoformat(self._heap[0][0]))
+            await asyncio.sleep(max(1.0, (wake_at - datetime.now()).total_seconds()))
+
+    async def _load(self, now):
+        """Подгружает окончания подписок следующего окна"""
+        if self._loaded_until is None:
+            self._loaded_until = now
+        if self._loaded_until > now + self.window / 2:
+            return
+        start = self._loaded_until
+        end = now + self.window
+        users = await async_operations.get_subscriptions_expiring_between(start, end, self.batch_size)
+        for user in users:
+            heapq.heappush(self._heap, (user["subscription_end_date"], user["user_id"]))
+        if len(users) == self.batch_size:
+            # Остаток окна загрузим после обработки загруженных окончаний
+            end = datetime.fromisoformat(users[-1]["subscription_end_date"])
+        self._loaded_until = end
+
+    async def _expire_due(self, now):
+        """Переводит истекшие подписки на бесплатный план и уведомляет пользователей"""
+        now_str = now.isoformat()
+        while self._heap and self._heap[0][0] <= now_str:
+            heapq.heappop(self._heap)
+
+        while True:
+            users = await async_operations.expire_subscriptions(now, self.batch_size)
+            if users:
+                self.expired += len(users)
+                logger.info(f"Подписка истекла у {len(users)} пользователей")
+                with bulk_priority():
+                    await asyncio.gather(*(self._notify_expired(user) for user in users))
+            if len(users) < self.batch_size:
+                return
+
+    async def _notify_expired(self, user):
+        try:
+            await self._bot.send_message(
+                user["user_id"],
+                "⚠️ Ваша Premium подписка истекла.\n\n"
+                "Вы переведены на бесплатный план. Для продолжения использования всех функций "
+                "бота, пожалуйста, обновите подписку.",
+                reply_markup=_renewal_keyboard("💎 Обновить Premium")
+            )
+            logger.info(f"Отправлено уведомление об истечении подписки пользователю {user['user_id']}")
+        except Exception as e:
+            logger.error(f"Ошибка уведомления об истечении подписки пользователя {user['user_id']}: {e}")
+
+    def get_stats(self):
+        """Возвращает состояние трекера"""
+        return {
+            "heap_size": len(self._heap),
+            "next_expiry": self._heap[0][0] if self._heap else None,
+            "expired": self.expired
+        }
+
+# Общий трекер для импорта
+subscription_expiry = SubscriptionExpiryTracker()
+
+async def remind_expiring_subscriptions(bot: Bot):
+    """Напоминает о продлении пользователям, чья подписка заканчивается в ближайшие 3 дня"""
+    try:
+        now = datetime.now()
+        # days_left от 0 до 3 включительно: до окончания меньше 4 суток
+        users = await async_operations.get_subscriptions_expiring_between(now, now + timedelta(days=4))
+        logger.info(f"Напоминание о продлении подписки для {len(users)} пользователей")
+
+        async def remind(user):
+            days_left = (datetime.fromisoformat(user["subscription_end_date"]) - now).days
+            try:
+                await bot.send_message(
+                    user["user_id"],
+                    f"⚠️ Ваша Premium подписка истекает через {days_left} дней.\n\n"
+                    "Не забудьте продлить её, чтобы продолжить пользоваться всеми преимуществами!",
+                    reply_markup=_renewal_keyboard("🔄 Продлить подписку")
+                )
+                logger.info(f"Отправлено уведомление о скором истечении подписки пользователю {user['user_id']}")
+            except Exception as e:
+                logger.error(f"Ошибка напоминания о подписке пользователю {user['user_id']}: {e}")
+
+        with bulk_priority():
+            await asyncio.gather(*(remind(user) for user in users))
+    except Exception as e:
+        logger.error(f"Ошибка в функции remind_expiring_subscriptions: {e}")
@@ -1,7 +1,8 @@
-from datetime import datetime
+from datetime import datetime, time, timedelta
 import re
 import dateparser
 import logging
+import pytz
 
 def parse_date_input(date_str):
     """
@@ -125,4 +126,46 @@ def parse_time_input(time_str):
         return "12:00"
     except Exception as e:
         logging.error(f"Ошибка при парсинге времени '{time_str}': {e}")
-        return "12:00"  # Возвращаем время по умолчанию в случае ошибки
\ No newline at end of file
+        return "12:00"  # Возвращаем время по умолчанию в случае ошибки
+
+def _get_timezone(tz_name):
+    try:
+        return pytz.timezone(tz_name or "UTC")
+    except pytz.UnknownTimeZoneError:
+        logging.warning(f"Неизвестная временная зона {tz_name}, используем UTC")
+        return pytz.utc
+
+def local_time_to_utc(local_date, time_str, tz_name):
+    """
+    Переводит местное время time_str (HH:MM) даты local_date в зоне tz_name в UTC
+    
+    Время, пропущенное при переходе на летнее время, сдвигается вперед на
+    величину перехода, из повторяющегося при переходе на зимнее берется
+    первое. Возвращает наивный datetime в UTC.
+    """
+    tz = _get_timezone(tz_name)
+    hours, minutes = map(int, time_str.split(":"))
+    local_dt = datetime.combine(local_date, time(hours, minutes))
+    try:
+        localized_dt = tz.localize(local_dt, is_dst=None)
+    except pytz.NonExistentTimeError:
+        localized_dt = tz.normalize(tz.localize(local_dt, is_dst=False))
+    except pytz.AmbiguousTimeError:
+        localized_dt = tz.localize(local_dt, is_dst=True)
+    return localized_dt.astimezone(pytz.utc).replace(tzinfo=None)
+
+def utc_to_local(utc_dt, tz_name):
+    """Переводит наивное время UTC в местное время зоны tz_name"""
+    return pytz.utc.localize(utc_dt).astimezone(_get_timezone(tz_name))
+
+def next_local_time_utc(time_str, tz_name, after):
+    """
+    Ближайший после after (наивное время UTC) момент, когда в зоне tz_name наступает местное время time_str
+    Возвращает наивный datetime в UTC
+    """
+    local_date = utc_to_local(after, tz_name).date()
+    for days in range(3):
+        utc_dt = local_time_to_utc(local_date + timedelta(days=days), time_str, tz_name)
+        if utc_dt > after:
+            return utc_dt
+    return utc_dt
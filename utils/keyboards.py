@@ -227,4 +227,13 @@ def get_admin_user_actions(user_id):
             ]
         ]
     )
-    return kb
\ No newline at end of file
+    return kb
+
+def get_admin_users_pagination(has_prev, has_next):
+    """Создает инлайн клавиатуру для перехода по страницам списка пользователей"""
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin_users:prev"))
+    if has_next:
+        buttons.append(InlineKeyboardButton(text="Вперед ➡️", callback_data="admin_users:next"))
+    return InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
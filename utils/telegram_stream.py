@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from config import STREAM_EDIT_INTERVAL, STREAM_MIN_CHARS
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Индикатор того, что ответ еще генерируется
+STREAM_CURSOR = " ▌"
+
+class TelegramStreamWriter:
+    """
+    Постепенно выводит генерируемый текст в сообщения Telegram.
+
+    Первый фрагмент отправляется новым сообщением сразу, дальше сообщение
+    редактируется не чаще одного раза в edit_interval секунд. Когда текст
+    перестает помещаться в 4096 символов, текущее сообщение фиксируется и
+    продолжение выводится в новом.
+    """
+
+    def __init__(self, bot: Bot, chat_id, prefix="", edit_interval=STREAM_EDIT_INTERVAL,
+                 min_chars=STREAM_MIN_CHARS, max_length=TELEGRAM_MESSAGE_LIMIT):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.prefix = prefix
+        self.edit_interval = edit_interval
+        self.min_chars = min_chars
+        self.max_length = max_length
+        self.messages = []  # Отправленные сообщения (все, кроме последнего, уже заполнены)
+        self._text = ""  # Текст, относящийся к текущему (последнему) сообщению
+        self._sent_text = None  # Что сейчас отображается в текущем сообщении
+        self._next_edit_at = 0.0
+        self._pending_chars = 0
+
+    async def write(self, delta):
+        """Добавляет фрагмент текста и при необходимости обновляет сообщение"""
+        if not self.messages and not self._text:
+            self._text = self.prefix
+        self._text += delta
+        self._pending_chars += len(delta)
+
+        # Переносим переполнение в новое сообщение
+        while len(self._text) + len(STREAM_CURSOR) > self.max_length:
+            await self._rollover()
+
+        now = time.monotonic()
+        is_new_message = not self.messages or self.messages[-1] is None
+        if now >= self._next_edit_at and (is_new_message or self._pending_chars >= self.min_chars):
+            await self._flush(final=False)
+
+    async def finish(self, text=None):
+        """
+        Завершает вывод и показывает окончательный текст без индикатора
+
+        Args:
+            text: Если указан, заменяет весь выведенный ранее текст (например, сообщением об ошибке)
+        """
+        if text is not None:
+            await self._replace(text)
+            return
+
+        if not self.messages and not self._text:
+            return
+        await self._flush(final=True)
+
+    async def _replace(self, text):
+        """Заменяет содержимое всех сообщений новым текстом"""
+        for message in self.messages[1:]:
+            try:
+                await self.bot.delete_message(self.chat_id, message.message_id)
+            except Exception as e:
+                logger.warning(f"Не удалось удалить сообщение потокового ответа: {e}")
+        self.messages = self.messages[:1]
+        self.prefix = ""
+        self._sent_text = None
+        self._text = ""
+        self._pending_chars = 0
+        await self.write(text)
+        await self._flush(final=True)
+
+    async def _rollover(self):
+        """Фиксирует текущее сообщение и переносит остаток текста в новое"""
+        limit = self.max_length - len(STREAM_CURSOR)
+        split_at = self._text.rfind("\n", 0, limit)
+        if split_at <= 0:
+            split_at = self._text.rfind(" ", 0, limit)
+        if split_at <= 0:
+            split_at = limit
+
+        head = self._text[:split_at]
+        tail = self._text[split_at:].lstrip()
+
+        self._text = head
+        await self._flush(final=True)
+
+        # Следующая запись отправит новое сообщение
+        self.messages.append(None)
+        self._text = tail
+        self._sent_text = None
+
+    async def _flush(self, final):
+        """Отправляет или редактирует текущее сообщение"""
+        text = self._text if final else self._text + STREAM_CURSOR
+        if not text.strip() or text == self._sent_text:
+            return
+
+        while True:
+            try:
+                if not self.messages or self.messages[-1] is None:
+                    message = await self.bot.send_message(self.chat_id, text)
+                    if self.messages:
+                        self.messages[-1] = message
+                    else:
+                        self.messages.append(message)
+                else:
+                    await self.bot.edit_message_text(
+                        text,
+                        chat_id=self.chat_id,
+                        message_id=self.messages[-1].message_id
+                    )
+                break
+            except TelegramRetryAfter as e:
+                if not final:
+                    # Промежуточное обновление можно пропустить, текст догонит следующее
+                    self._next_edit_at = time.monotonic() + e.retry_after
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" in str(e):
+                    break
+                raise
+
+        self._sent_text = text
+        self._pending_chars = 0
+        self._next_edit_at = time.monotonic() + self.edit_interval